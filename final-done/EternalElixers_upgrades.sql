@@ -0,0 +1,214 @@
+-- EternalElixers_upgrades.sql  (idempotent schema additions)
+-- Run by db.init_db() on every start, after EternalElixers.sql has
+-- created a fresh database. Everything here must be safe to re-run
+-- against a database that already has live data in it.
+
+-------------------------------------------------
+-- PAYMENT IDEMPOTENCY TOKENS
+-------------------------------------------------
+-- One row per payment page shown. Status goes
+-- 'issued' -> 'processing' -> 'done' (BillID set).
+CREATE TABLE IF NOT EXISTS PaymentToken_T (
+    Token      TEXT     PRIMARY KEY,
+    UserID     INTEGER  NOT NULL,
+    Status     TEXT     NOT NULL DEFAULT 'issued',
+    BillID     INTEGER,
+    CreatedAt  REAL     NOT NULL,
+    FOREIGN KEY (UserID) REFERENCES User_T(UserID),
+    FOREIGN KEY (BillID) REFERENCES Bill_T(BillID)
+);
+
+CREATE INDEX IF NOT EXISTS idx_paymenttoken_createdat ON PaymentToken_T(CreatedAt);
+
+-------------------------------------------------
+-- BACKGROUND JOB QUEUE
+-------------------------------------------------
+-- Post-order work (receipts, rollups, notifications) is queued here
+-- in the checkout transaction and run by jobs.py workers.
+-- Finished jobs are deleted; Status is 'queued', 'running' or 'dead'.
+CREATE TABLE IF NOT EXISTS Job_T (
+    JobID        INTEGER  PRIMARY KEY,
+    Kind         TEXT     NOT NULL,
+    Payload      TEXT     NOT NULL,
+    Status       TEXT     NOT NULL DEFAULT 'queued',
+    Attempts     INTEGER  NOT NULL DEFAULT 0,
+    MaxAttempts  INTEGER  NOT NULL DEFAULT 5,
+    RunAfter     REAL     NOT NULL,
+    LockedBy     TEXT,
+    LockedAt     REAL,
+    LastError    TEXT,
+    CreatedAt    REAL     NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_job_status_runafter ON Job_T(Status, RunAfter);
+
+-------------------------------------------------
+-- SETTINGS + CACHE VERSIONS
+-------------------------------------------------
+-- Store-wide settings that used to be hard-coded in the Python files.
+CREATE TABLE IF NOT EXISTS Setting_T (
+    SettingKey   TEXT  PRIMARY KEY,
+    SettingValue TEXT  NOT NULL
+);
+
+INSERT OR IGNORE INTO Setting_T (SettingKey, SettingValue) VALUES
+('tax_rate', '0.06');
+
+-- One counter per cached data set (see refdata.py). Anything that
+-- changes Shipping_T, Setting_T or the catalog bumps its counter so
+-- every worker reloads its in-memory copy.
+CREATE TABLE IF NOT EXISTS CacheVersion_T (
+    Name     TEXT     PRIMARY KEY,
+    Version  INTEGER  NOT NULL DEFAULT 0
+);
+
+INSERT OR IGNORE INTO CacheVersion_T (Name, Version) VALUES
+('shipping', 0),
+('settings', 0),
+('catalog',  0);
+
+-------------------------------------------------
+-- CHECKOUT INTEGRITY
+-------------------------------------------------
+-- A potion can be in a given cart once (drop any duplicates first).
+DELETE FROM ShoppingCart_T
+WHERE ShoppingCartID NOT IN (
+    SELECT MIN(ShoppingCartID) FROM ShoppingCart_T GROUP BY UserID, ItemID
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_cart_user_item ON ShoppingCart_T(UserID, ItemID);
+CREATE INDEX IF NOT EXISTS idx_cart_item ON ShoppingCart_T(ItemID);
+
+-- A potion can only ever be sold once. Older checkouts could sell one
+-- twice; those bills need a person to sort out, so db.init_db() stops
+-- with their BillIDs before this runs instead of deleting anything.
+CREATE UNIQUE INDEX IF NOT EXISTS idx_billitem_item ON BillInventoryItem_T(ItemID);
+CREATE INDEX IF NOT EXISTS idx_billitem_bill ON BillInventoryItem_T(BillID);
+
+-------------------------------------------------
+-- CASE-INSENSITIVE USERNAME LOOKUPS
+-------------------------------------------------
+-- Login / register look up `Username = ? COLLATE NOCASE`, which uses
+-- this index instead of scanning User_T. UNIQUE also stops two
+-- workers registering "Bob" and "bob" at the same moment.
+CREATE UNIQUE INDEX IF NOT EXISTS idx_user_username_nocase ON User_T(Username COLLATE NOCASE);
+
+-------------------------------------------------
+-- SERVER-SIDE SESSIONS
+-------------------------------------------------
+-- One row per browser session (see sessions.py). Data is the
+-- serialized session, including the cached User_T row; UserID lets
+-- us log a user out of every session at once.
+CREATE TABLE IF NOT EXISTS Session_T (
+    SessionID  TEXT     PRIMARY KEY,
+    UserID     INTEGER,
+    Data       TEXT     NOT NULL,
+    ExpiresAt  REAL     NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_session_user ON Session_T(UserID);
+CREATE INDEX IF NOT EXISTS idx_session_expires ON Session_T(ExpiresAt);
+
+-------------------------------------------------
+-- ORDER HISTORY
+-------------------------------------------------
+-- The account page pages through a user's bills newest first on
+-- (SalesDate, SaleTime, BillID); this index serves it directly.
+CREATE INDEX IF NOT EXISTS idx_bill_user_date ON Bill_T(UserID, SalesDate, SaleTime, BillID);
+
+-------------------------------------------------
+-- RUNNING STATS
+-------------------------------------------------
+-- Per-user order totals, updated in the checkout transaction
+-- (stats.record_order). `flask stats rebuild` recomputes them.
+CREATE TABLE IF NOT EXISTS UserStats_T (
+    UserID         INTEGER  PRIMARY KEY,
+    OrderCount     INTEGER  NOT NULL DEFAULT 0,
+    LifetimeSpend  REAL     NOT NULL DEFAULT 0,
+    LastOrderDate  TEXT,
+    FOREIGN KEY (UserID) REFERENCES User_T(UserID)
+);
+
+-- First run on an existing database: backfill from Bill_T once.
+INSERT INTO UserStats_T (UserID, OrderCount, LifetimeSpend, LastOrderDate)
+SELECT UserID, COUNT(*), COALESCE(SUM(Total), 0), MAX(SalesDate)
+FROM Bill_T
+WHERE UserID IS NOT NULL
+  AND NOT EXISTS (SELECT 1 FROM UserStats_T)
+GROUP BY UserID;
+
+-- Shop-wide counters for the admin dashboard: a single row,
+-- bumped in the checkout transaction. Seeded from Bill_T the first
+-- time it's created; `flask stats reconcile --fix` repairs drift.
+CREATE TABLE IF NOT EXISTS ShopStats_T (
+    StatsID     INTEGER  PRIMARY KEY CHECK (StatsID = 1),
+    OrderCount  INTEGER  NOT NULL DEFAULT 0,
+    Revenue     REAL     NOT NULL DEFAULT 0,
+    ItemsSold   INTEGER  NOT NULL DEFAULT 0
+);
+
+INSERT OR IGNORE INTO ShopStats_T (StatsID, OrderCount, Revenue, ItemsSold)
+SELECT 1,
+       (SELECT COUNT(*) FROM Bill_T),
+       (SELECT COALESCE(SUM(Total), 0) FROM Bill_T),
+       (SELECT COUNT(*) FROM BillInventoryItem_T)
+WHERE NOT EXISTS (SELECT 1 FROM ShopStats_T);
+
+-------------------------------------------------
+-- SALES REPORT / EXPORT
+-------------------------------------------------
+-- Bills newest first without a sort step, and date-range filters,
+-- for the streamed CSV export.
+CREATE INDEX IF NOT EXISTS idx_bill_date ON Bill_T(SalesDate, SaleTime, BillID);
+
+-------------------------------------------------
+-- SALES ROLLUPS
+-------------------------------------------------
+-- Orders / items / revenue per 'day' and 'week' bucket, by
+-- PotionCategory and shipping State (see stats.py). PotionCategory
+-- '*' rows hold whole-order totals. Maintained in the checkout
+-- transaction; on a database that already has sales, db.init_db()
+-- fills it once with stats.rebuild_sales_rollup.
+CREATE TABLE IF NOT EXISTS SalesRollup_T (
+    Period          TEXT     NOT NULL,
+    PeriodStart     TEXT     NOT NULL,
+    PotionCategory  TEXT     NOT NULL,
+    State           TEXT     NOT NULL,
+    Orders          INTEGER  NOT NULL DEFAULT 0,
+    ItemsSold       INTEGER  NOT NULL DEFAULT 0,
+    Revenue         REAL     NOT NULL DEFAULT 0,
+    PRIMARY KEY (Period, PeriodStart, PotionCategory, State)
+);
+
+-------------------------------------------------
+-- ADMIN USER SEARCH
+-------------------------------------------------
+-- Prefix search on name / email (Username already has
+-- idx_user_username_nocase), and the role filter paged by UserID.
+CREATE INDEX IF NOT EXISTS idx_user_name_nocase ON User_T(Name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS idx_user_email_nocase ON User_T(Email COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS idx_user_type_id ON User_T(UserType, UserID);
+
+-------------------------------------------------
+-- BACKGROUND REPORTS
+-------------------------------------------------
+-- One row per report an admin asked for (see reports.py). Params is
+-- canonical JSON, so identical requests can reuse a fresh report;
+-- the file lives in reports/ until ExpiresAt.
+CREATE TABLE IF NOT EXISTS Report_T (
+    ReportID     INTEGER  PRIMARY KEY,
+    Kind         TEXT     NOT NULL,
+    Params       TEXT     NOT NULL,
+    Status       TEXT     NOT NULL DEFAULT 'queued',
+    RowsDone     INTEGER  NOT NULL DEFAULT 0,
+    RowsTotal    INTEGER,
+    FileName     TEXT,
+    FileSize     INTEGER,
+    Error        TEXT,
+    RequestedBy  INTEGER,
+    CreatedAt    REAL     NOT NULL,
+    FinishedAt   REAL,
+    ExpiresAt    REAL
+);
+
+CREATE INDEX IF NOT EXISTS idx_report_params ON Report_T(Kind, Params, CreatedAt);
+CREATE INDEX IF NOT EXISTS idx_report_expires ON Report_T(ExpiresAt);
@@ -1,18 +1,57 @@
 """
 admin.py
 Admin-only routes:
-- Admin dashboard
+- Admin dashboard (live totals over Server-Sent Events)
 - Sales report (list of sales per bill)
 - CSV export of sales report
-- Inventory management (view/add/delete)
+- Sales analytics (rollups by day/week, category and state)
+- Background reports (built by a job worker, downloaded later)
+- Inventory management (view/add/delete, bulk import, bulk edits)
 - User management (promote user to admin)
 """
 
-from flask import Blueprint, render_template, session, redirect, url_for, flash, request, Response
-
-from db import get_connection, get_all_inventory, add_inventory_item, delete_inventory_item, get_all_users, promote_user_to_admin
-import csv
-import io
+import math
+
+from flask import (
+    Blueprint,
+    render_template,
+    session,
+    redirect,
+    url_for,
+    flash,
+    request,
+    Response,
+    stream_with_context,
+    send_file,
+    jsonify,
+)
+
+from db import (
+    get_connection,
+    get_all_inventory,
+    add_inventory_item,
+    delete_inventory_item,
+    delete_inventory_items,
+    reprice_inventory,
+    recategorize_inventory,
+    search_users,
+    promote_user_to_admin,
+)
+from sessions import revoke_user_sessions
+from stats import get_shop_stats, sales_rollup, pivot_rollup
+import events
+from importers import import_inventory, detect_format, open_upload, InventoryImportError
+from reports import (
+    sales_filters,
+    sales_csv_chunks,
+    analytics_options,
+    request_report,
+    get_report,
+    recent_reports,
+    report_file,
+    download_name,
+    REPORT_KINDS,
+)
 
 admin_bp = Blueprint("admin", __name__, url_prefix="/admin")
 
@@ -21,6 +60,8 @@ admin_bp = Blueprint("admin", __name__, url_prefix="/admin")
 def _require_admin():
     """
     Simple helper to check if current user is an admin.
+    Reads the role cached in the session at login (no DB read);
+    role changes revoke the user's sessions so this stays current.
     Returns True if admin, otherwise False.
     Callers handle redirects.
     """
@@ -39,65 +80,83 @@ def dashboard():
     - total revenue
     - number of orders
     - total items sold
+    The page then keeps them current from /admin/events.
     """
     if not _require_admin():
         return redirect(url_for("shop.shop_home"))
 
-    conn = get_connection()
-    cur = conn.cursor()
+    # Running counters kept by checkout (stats.record_order): one row
+    totals = get_shop_stats()
 
-    # 1) Total revenue & number of orders
-    cur.execute(
-        """
-        SELECT
-            COUNT(*) AS order_count,
-            COALESCE(SUM(Total), 0) AS total_revenue
-        FROM Bill_T
-        """
+    return render_template(
+        "admin_dashboard.html",
+        order_count=totals["OrderCount"],
+        total_revenue=float(totals["Revenue"]),
+        items_sold=totals["ItemsSold"],
     )
-    row = cur.fetchone()
-    order_count = row["order_count"]
-    total_revenue = float(row["total_revenue"])
 
-    # 2) Total items sold (count rows in BillInventoryItem_T)
-    cur.execute(
-        """
-        SELECT COUNT(*) AS items_sold
-        FROM BillInventoryItem_T
-        """
-    )
-    row = cur.fetchone()
-    items_sold = row["items_sold"]
 
-    conn.close()
+@admin_bp.route("/events", methods=["GET"])
+def dashboard_events():
+    """
+    Server-Sent Events stream for the dashboard: a "snapshot" of the
+    totals, then an "order" event (deltas) for every order placed.
+    Open dashboards share one broadcast instead of each re-querying.
+    """
+    if session.get("user_type") != "Admin":
+        return Response("Admin access required.\n", status=403, mimetype="text/plain")
 
-    return render_template(
-        "admin_dashboard.html",
-        order_count=order_count,
-        total_revenue=total_revenue,
-        items_sold=items_sold,
+    updates = events.stream(get_shop_stats())
+    if updates is None:
+        return Response("Too many live dashboards open.\n", status=503, mimetype="text/plain",
+                        headers={"Retry-After": "30"})
+    return Response(
+        stream_with_context(updates),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
 
 # SALES REPORT (LIST OF SALES) <<<<<<<<<<
+SALES_PER_PAGE = 50
+
+
 @admin_bp.route("/sales-report", methods=["GET"])
 def sales_report():
     """
-    Shows a list of all sales (bills), including:
+    Shows sales (bills), newest first, one page at a time, including:
     - BillID
     - date + time
     - username / customer name
     - subtotal, tax, shipping, total
     - item_count (how many items in that bill)
     - item names (comma-separated)
+    Filters: start, end, user, min_total (see sales_filters).
+    Paging: ?before=<cursor> (keyset on SalesDate, SaleTime, BillID).
     """
     if not _require_admin():
         return redirect(url_for("shop.shop_home"))
 
+    try:
+        where_sql, params, filters = sales_filters(request.args)
+    except ValueError:
+        flash("Dates must look like YYYY-MM-DD and the minimum total must be a number.")
+        return redirect(url_for("admin.sales_report"))
+
+    before = request.args.get("before", "")
+    parts = before.split("_")
+    if len(parts) == 3 and parts[2].isdigit():
+        where_sql += " AND " if where_sql else "WHERE "
+        where_sql += "(b.SalesDate, b.SaleTime, b.BillID) < (?, ?, ?)"
+        params = params + [parts[0], parts[1], int(parts[2])]
+
     conn = get_connection()
     cur = conn.cursor()
 
-    cur.execute("""
+    # One page of bills, walked in index order (idx_bill_date, or
+    # idx_bill_user_date with a user filter); one extra row = more pages
+    cur.execute(
+        f"""
         SELECT
             b.BillID,
             b.SalesDate,
@@ -107,21 +166,42 @@ def sales_report():
             b.ShippingCost,
             b.Total,
             u.Username,
-            u.Name,
-            COUNT(bi.ItemID) AS ItemCount,
-            COALESCE(GROUP_CONCAT(i.PotionName, ', '), '') AS ItemNames
+            u.Name
         FROM Bill_T b
         JOIN User_T u ON b.UserID = u.UserID
-        LEFT JOIN BillInventoryItem_T bi ON b.BillID = bi.BillID
-        LEFT JOIN Inventory_T i ON bi.ItemID = i.ItemID
-        GROUP BY b.BillID
-        ORDER BY b.SalesDate DESC, b.SaleTime DESC
-    """)
+        {where_sql}
+        ORDER BY b.SalesDate DESC, b.SaleTime DESC, b.BillID DESC
+        LIMIT ?
+        """,
+        params + [SALES_PER_PAGE + 1],
+    )
     rows = cur.fetchall()
+    has_more = len(rows) > SALES_PER_PAGE
+    rows = rows[:SALES_PER_PAGE]
+
+    # Item counts + names for just these bills
+    items = {}
+    if rows:
+        placeholders = ", ".join("?" for _ in rows)
+        cur.execute(
+            f"""
+            SELECT
+                bi.BillID,
+                COUNT(*) AS ItemCount,
+                GROUP_CONCAT(i.PotionName, ', ') AS ItemNames
+            FROM BillInventoryItem_T bi
+            LEFT JOIN Inventory_T i ON bi.ItemID = i.ItemID
+            WHERE bi.BillID IN ({placeholders})
+            GROUP BY bi.BillID
+            """,
+            [row["BillID"] for row in rows],
+        )
+        items = {row["BillID"]: (row["ItemCount"], row["ItemNames"]) for row in cur.fetchall()}
     conn.close()
 
     sales = []
     for row in rows:
+        item_count, item_names = items.get(row["BillID"], (0, None))
         sales.append(
             {
                 "bill_id": row["BillID"],
@@ -129,8 +209,8 @@ def sales_report():
                 "time": row["SaleTime"],
                 "username": row["Username"],
                 "name": row["Name"],
-                "item_count": row["ItemCount"],
-                "items": row["ItemNames"] or "—",
+                "item_count": item_count,
+                "items": item_names or "—",
                 "subtotal": float(row["SubTotal"]),
                 # stored SalesTax is the rate (0.06), we want dollar amount:
                 "tax": round(float(row["SubTotal"]) * float(row["SalesTax"]), 2),
@@ -139,92 +219,155 @@ def sales_report():
             }
         )
 
-    return render_template("sales_report.html", sales=sales)
+    next_cursor = None
+    if has_more:
+        last = sales[-1]
+        next_cursor = f"{last['date']}_{last['time']}_{last['bill_id']}"
 
+    return render_template(
+        "sales_report.html",
+        sales=sales,
+        filters=filters,
+        next_cursor=next_cursor,
+        first_page=not before,
+    )
 
 
 @admin_bp.route("/sales-report/export", methods=["GET"])
 def sales_report_export_csv():
     """
-    Exports the sales report to CSV.
+    Exports the sales report to CSV, streamed.
     Columns:
     BillID, Date, Time, Username, Name, Items, ItemCount, Subtotal, Tax, Shipping, Total
+    Query string: start, end, user (see sales_filters), gzip=1 for .csv.gz
     """
     if not _require_admin():
         return redirect(url_for("shop.shop_home"))
 
-    conn = get_connection()
-    cur = conn.cursor()
+    try:
+        where_sql, params, _ = sales_filters(request.args)
+    except ValueError:
+        flash("Dates must look like YYYY-MM-DD.")
+        return redirect(url_for("admin.sales_report"))
 
-    cur.execute("""
-        SELECT
-            b.BillID,
-            b.SalesDate,
-            b.SaleTime,
-            b.SubTotal,
-            b.SalesTax,
-            b.ShippingCost,
-            b.Total,
-            u.Username,
-            u.Name,
-            COUNT(bi.ItemID) AS ItemCount,
-            COALESCE(GROUP_CONCAT(i.PotionName, ', '), '') AS ItemNames
-        FROM Bill_T b
-        JOIN User_T u ON b.UserID = u.UserID
-        LEFT JOIN BillInventoryItem_T bi ON b.BillID = bi.BillID
-        LEFT JOIN Inventory_T i ON bi.ItemID = i.ItemID
-        GROUP BY b.BillID
-        ORDER BY b.SalesDate DESC, b.SaleTime DESC
-    """)
-    rows = cur.fetchall()
-    conn.close()
+    compress = request.args.get("gzip") == "1"
+    filename = "sales_report.csv.gz" if compress else "sales_report.csv"
 
-    output = io.StringIO()
-    writer = csv.writer(output)
-
-    # header
-    writer.writerow([
-        "BillID",
-        "Date",
-        "Time",
-        "Username",
-        "Name",
-        "Items",
-        "ItemCount",
-        "Subtotal",
-        "Tax",
-        "Shipping",
-        "Total",
-    ])
+    return Response(
+        stream_with_context(sales_csv_chunks(where_sql, params, compress)),
+        mimetype="application/gzip" if compress else "text/csv",
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
 
-    for row in rows:
-        subtotal = float(row["SubTotal"])
-        tax_amount = round(subtotal * float(row["SalesTax"]), 2)
-
-        writer.writerow([
-            row["BillID"],
-            row["SalesDate"],
-            row["SalesTime"] if "SalesTime" in row.keys() else row["SaleTime"],
-            row["Username"],
-            row["Name"],
-            row["ItemNames"],
-            row["ItemCount"],
-            subtotal,
-            tax_amount,
-            float(row["ShippingCost"]),
-            float(row["Total"]),
-        ])
-
-    csv_data = output.getvalue()
-    output.close()
 
-    return Response(
-        csv_data,
-        mimetype="text/csv",
-        headers={"Content-Disposition": "attachment; filename=sales_report.csv"},
+# SALES ANALYTICS (ROLLUPS) <<<<<<<<<<
+@admin_bp.route("/analytics", methods=["GET"])
+def analytics():
+    """
+    Revenue / orders / items per day or week, broken down by potion
+    category or shipping state. Reads SalesRollup_T only.
+    Query string: period=day|week, by=category|state,
+    measure=Revenue|Orders|ItemsSold, start, end (YYYY-MM-DD).
+    """
+    if not _require_admin():
+        return redirect(url_for("shop.shop_home"))
+
+    try:
+        options = analytics_options(request.args)
+    except ValueError as exc:
+        flash(str(exc))
+        return redirect(url_for("admin.analytics"))
+
+    rows = sales_rollup(options["period"], options["by"], options["start"] or None, options["end"] or None)
+    columns, buckets, column_totals = pivot_rollup(rows, options["measure"])
+
+    return render_template(
+        "admin_analytics.html",
+        **options,
+        columns=columns,
+        buckets=buckets,
+        column_totals=column_totals,
+        grand_total=sum(column_totals),
     )
 
 
+# BACKGROUND REPORTS <<<<<<<<<<
+@admin_bp.route("/reports", methods=["GET"])
+def reports():
+    """
+    Lists recent reports with their progress; the page refreshes
+    itself while any of them is still queued or running.
+    """
+    if not _require_admin():
+        return redirect(url_for("shop.shop_home"))
+
+    rows = recent_reports()
+    return render_template(
+        "admin_reports.html",
+        reports=rows,
+        kinds=REPORT_KINDS,
+        building=any(row["Status"] in ("queued", "running") for row in rows),
+    )
+
+
+@admin_bp.route("/reports", methods=["POST"])
+def reports_start():
+    """
+    Starts a report in the background (or reuses a fresh identical one).
+    Form: kind (see reports.REPORT_KINDS) plus that report's filters.
+    """
+    if not _require_admin():
+        return redirect(url_for("shop.shop_home"))
+
+    kind = request.form.get("kind", "")
+    if kind not in REPORT_KINDS:
+        flash("Unknown report.")
+        return redirect(url_for("admin.reports"))
+    try:
+        report_id, reused = request_report(kind, request.form, session.get("user_id"))
+    except ValueError as exc:
+        flash(str(exc))
+        return redirect(url_for("admin.reports"))
+
+    if reused:
+        flash(f"An identical report (#{report_id}) is recent enough; reusing it.")
+    else:
+        flash(f"Report #{report_id} started. It will be ready to download here.")
+    return redirect(url_for("admin.reports"))
+
+
+@admin_bp.route("/reports/<int:report_id>", methods=["GET"])
+def report_status(report_id):
+    """
+    Report status as JSON, for polling:
+    {"status", "rows_done", "rows_total", "error", "download_url"}
+    """
+    if not _require_admin():
+        return jsonify(error="admin access required"), 403
+
+    report = get_report(report_id)
+    if report is None:
+        return jsonify(error="no such report"), 404
+    return jsonify(
+        status=report["Status"],
+        rows_done=report["RowsDone"],
+        rows_total=report["RowsTotal"],
+        error=report["Error"],
+        download_url=url_for("admin.report_download", report_id=report_id) if report_file(report) else None,
+    )
+
+
+@admin_bp.route("/reports/<int:report_id>/download", methods=["GET"])
+def report_download(report_id):
+    if not _require_admin():
+        return redirect(url_for("shop.shop_home"))
+
+    report = get_report(report_id)
+    path = report_file(report)
+    if path is None:
+        flash("That report isn't available (still building, failed, or expired).")
+        return redirect(url_for("admin.reports"))
+    return send_file(path, as_attachment=True, download_name=download_name(report))
 
 
 # INVENTORY MANAGEMENT <<<<<<<<<<
@@ -275,6 +418,40 @@ def inventory_add():
     return redirect(url_for("admin.inventory_admin"))
 
 
+@admin_bp.route("/inventory/import", methods=["POST"])
+def inventory_import():
+    """
+    Bulk-adds potions from an uploaded CSV or NDJSON file
+    (see importers.import_inventory). Reports counts and the
+    first few rejected rows.
+    """
+    if not _require_admin():
+        return redirect(url_for("shop.shop_home"))
+
+    upload = request.files.get("file")
+    if upload is None or not upload.filename:
+        flash("Choose a CSV or NDJSON file to import.")
+        return redirect(url_for("admin.inventory_admin"))
+
+    errors = []
+
+    def reject(line_no, raw, reason):
+        if len(errors) < 5:
+            errors.append(f"Line {line_no}: {reason}")
+
+    try:
+        progress = import_inventory(open_upload(upload), detect_format(upload.filename), reject=reject)
+    except InventoryImportError as exc:
+        # Earlier transactions are committed; say how far it got
+        flash(f"{exc} Imported {exc.progress.imported} potion(s) before that.")
+        return redirect(url_for("admin.inventory_admin"))
+
+    flash(f"Imported {progress.imported} potion(s); {progress.rejected} row(s) rejected.")
+    for error in errors:
+        flash(error)
+    return redirect(url_for("admin.inventory_admin"))
+
+
 @admin_bp.route("/inventory/delete/<int:item_id>", methods=["POST"])
 def inventory_delete(item_id):
     """
@@ -288,18 +465,109 @@ def inventory_delete(item_id):
     return redirect(url_for("admin.inventory_admin"))
 
 
+@admin_bp.route("/inventory/bulk", methods=["POST"])
+def inventory_bulk():
+    """
+    Bulk actions on unsold potions. Form fields:
+      - action: delete | reprice | recategorize
+      - scope:  selected (the checked item_ids) | filter
+      - filter_category / filter_name: the filter (empty = whole catalog)
+      - mode (percent | absolute) + amount: for reprice
+      - new_category: for recategorize
+    Delete only works on selected potions.
+    """
+    if not _require_admin():
+        return redirect(url_for("shop.shop_home"))
+
+    action = request.form.get("action", "")
+    scope = request.form.get("scope", "selected")
+
+    if scope == "selected":
+        try:
+            item_ids = [int(i) for i in request.form.getlist("item_ids")]
+        except ValueError:
+            item_ids = []
+        if not item_ids:
+            flash("Select at least one potion first.")
+            return redirect(url_for("admin.inventory_admin"))
+        target = {"item_ids": item_ids}
+    elif action == "delete":
+        flash("Bulk delete only works on selected potions.")
+        return redirect(url_for("admin.inventory_admin"))
+    else:
+        target = {
+            "category": request.form.get("filter_category", "").strip() or None,
+            "name_contains": request.form.get("filter_name", "").strip() or None,
+        }
+
+    if action == "delete":
+        count = delete_inventory_items(target["item_ids"])
+        flash(f"Deleted {count} potion(s).")
+
+    elif action == "reprice":
+        mode = request.form.get("mode", "percent")
+        try:
+            amount = float(request.form.get("amount", ""))
+        except ValueError:
+            amount = 0
+        # not math.isfinite: "nan" would null every price, "inf" make them infinite
+        if mode not in ("percent", "absolute") or not amount or not math.isfinite(amount):
+            flash("Enter a non-zero percentage or amount.")
+            return redirect(url_for("admin.inventory_admin"))
+        count = reprice_inventory(mode, amount, **target)
+        flash(f"Repriced {count} potion(s).")
+
+    elif action == "recategorize":
+        new_category = request.form.get("new_category", "").strip()
+        if not new_category:
+            flash("Enter the new category.")
+            return redirect(url_for("admin.inventory_admin"))
+        count = recategorize_inventory(new_category, **target)
+        flash(f"Moved {count} potion(s) to {new_category}.")
+
+    else:
+        flash("Unknown bulk action.")
+
+    return redirect(url_for("admin.inventory_admin"))
+
+
 # USER MANAGEMENT (PROMOTE TO ADMIN) <<<<<<<<<<
 @admin_bp.route("/users", methods=["GET"])
 def manage_users():
     """
-    Shows all users so an admin can see who is Admin/User
-    and promote regular users.
+    Shows users a page at a time so an admin can see who is
+    Admin/User and promote regular users.
+    Query string: q (prefix of username / name / email),
+    type (Admin | User), after (last UserID of the previous page).
     """
     if not _require_admin():
         return redirect(url_for("shop.shop_home"))
 
-    users = get_all_users()
-    return render_template("admin_users.html", users=users)
+    filters = _user_filters(request.args)
+    after_id = request.args.get("after", "0")
+    after_id = int(after_id) if after_id.isdigit() else 0
+
+    users, has_more = search_users(filters.get("q", ""), filters.get("type"), after_id)
+    return render_template(
+        "admin_users.html",
+        users=users,
+        filters=filters,
+        next_after=users[-1]["UserID"] if has_more else None,
+        first_page=not after_id,
+    )
+
+
+def _user_filters(values):
+    """
+    The user-list filters that were actually given (for links/forms).
+    """
+    filters = {}
+    query = values.get("q", "").strip()
+    if query:
+        filters["q"] = query
+    if values.get("type") in ("Admin", "User"):
+        filters["type"] = values["type"]
+    return filters
 
 
 @admin_bp.route("/users/promote/<int:user_id>", methods=["POST"])
@@ -311,5 +579,8 @@ def promote_user(user_id):
         return redirect(url_for("shop.shop_home"))
 
     promote_user_to_admin(user_id)
+    # Their cached session still says 'User': make them log in again
+    revoke_user_sessions(user_id)
     flash("User promoted to admin.")
-    return redirect(url_for("admin.manage_users"))
+    # back to the same search
+    return redirect(url_for("admin.manage_users", **_user_filters(request.form)))
@@ -1,27 +1,148 @@
+"""
+app.py
+Application factory. Importing this module is cheap: blueprints,
+CLI groups and subsystems are imported inside create_app(), and the
+database / caches are only touched there, each step idempotent.
+
+    python serve.py                   (production: prefork workers)
+    flask --app app run               (Flask finds create_app)
+    python app.py                     (development server)
+    create_app({"DATABASE": path, "JOB_WORKERS": 0})   (tests, scripts)
+"""
+
+import threading
+import time
+
 from flask import Flask, redirect, url_for
-from auth import auth_bp
-from shop import shop_bp
-from cart import cart_bp
-from checkout import checkout_bp
-from admin import admin_bp
-from db import init_db   # import
-
-app = Flask(__name__)
-app.secret_key = "CHANGE_THIS_SECRET_KEY"
-
-# initialize DB once at startup
-init_db()
-
-# register blueprints
-app.register_blueprint(auth_bp)
-app.register_blueprint(shop_bp)
-app.register_blueprint(cart_bp)
-app.register_blueprint(checkout_bp)
-app.register_blueprint(admin_bp)
-
-@app.route("/")
-def home():
-    return redirect(url_for("shop.shop_home"))
+
+import config
+
+
+def create_app(overrides=None):
+    """
+    Builds a configured app: config.from_env() plus `overrides`.
+    Logs how long startup took, with a warning past STARTUP_BUDGET_MS
+    (profile with `python bench_startup.py`).
+    """
+    started = time.perf_counter()
+
+    app = Flask(__name__)
+    app.config.from_mapping(config.from_env())
+    app.config.update(overrides or {})
+
+    import db
+
+    # request / SQL / cache counters at /metrics; first, so it times everything below
+    import metrics
+    metrics.init_app(app)
+
+    # job workers + events poller, once the app serves a request
+    # (never for one-off `flask ...` commands)
+    _start_background_on_first_request(app)
+
+    # sessions live server-side (EE_SESSION_BACKEND); the cookie only holds an id
+    import sessions
+    sessions.init_app(app)
+
+    # per-route token buckets + load shedding (checkout first, reports last)
+    import ratelimit
+    ratelimit.init_app(app)
+
+    # create / upgrade the schema (a header read when already current),
+    # then load shipping/tax/categories into memory; in an app context
+    # so both use this app's DATABASE (see db.database_path)
+    with app.app_context():
+        if app.config["INIT_DB"]:
+            db.init_db()
+        if app.config["WARM_CACHES"]:
+            import refdata
+            refdata.warm()
+
+    _register_blueprints(app)
+    _register_cli(app)
+
+    @app.route("/")
+    def home():
+        return redirect(url_for("shop.shop_home"))
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if elapsed_ms > app.config["STARTUP_BUDGET_MS"]:
+        app.logger.warning("create_app took %.0f ms (budget %.0f ms)", elapsed_ms, app.config["STARTUP_BUDGET_MS"])
+    else:
+        app.logger.info("create_app took %.0f ms", elapsed_ms)
+    return app
+
+
+def _start_background_on_first_request(app):
+    """
+    Starts this app's background threads when it handles its first
+    request (serve.py, `flask run`, python app.py), so CLI commands
+    like `flask jobs work` or `flask stats rebuild` don't start
+    workers of their own next to the ones they run:
+    - JOB_WORKERS in-process workers for post-order jobs and reports
+    - the live dashboard poller (EE_EVENTS_FANOUT=sqlite)
+    """
+    lock = threading.Lock()
+    started = threading.Event()
+
+    @app.before_request
+    def start_background():
+        if started.is_set():
+            return
+        with lock:
+            if started.is_set():
+                return
+            import events
+            events.init_app(app)
+            if app.config["JOB_WORKERS"]:
+                from jobs import start_workers
+                start_workers(app, app.config["JOB_WORKERS"])
+            started.set()
+
+
+def _register_blueprints(app):
+    from auth import auth_bp
+    from shop import shop_bp
+    from cart import cart_bp
+    from checkout import checkout_bp
+    from admin import admin_bp
+
+    app.register_blueprint(auth_bp)
+    app.register_blueprint(shop_bp)
+    app.register_blueprint(cart_bp)
+    app.register_blueprint(checkout_bp)
+    app.register_blueprint(admin_bp)
+
+
+def _register_cli(app):
+    """
+    CLI commands: `flask jobs ...`, `flask refdata ...`, `flask stats ...`,
+    `flask import ...`, `flask reports ...`, `flask init-db`
+    (`flask sessions ...` is added by sessions.init_app)
+    """
+    import click
+    import db
+    import refdata
+    import reports
+    import stats
+    from importers import import_cli
+    from jobs import jobs_cli
+
+    app.cli.add_command(jobs_cli)
+    app.cli.add_command(refdata.refdata_cli)
+    app.cli.add_command(stats.stats_cli)
+    app.cli.add_command(import_cli)
+    app.cli.add_command(reports.reports_cli)
+
+    @app.cli.command("init-db")
+    def init_db_command():
+        """Create or upgrade the database schema (safe to repeat)."""
+        try:
+            db.init_db()
+        except db.SchemaUpgradeError as exc:
+            raise click.ClickException(str(exc))
+        click.echo(f"Database ready: {db.database_path()}")
+
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    create_app().run(debug=True)
@@ -1,6 +1,11 @@
 import sqlite3
-from flask import Blueprint, render_template, request, redirect, url_for, session, flash
+from flask import Blueprint, render_template, request, redirect, url_for, session, flash, jsonify
 from db import get_connection
+import metrics
+from passwords import hash_password, verify_password, PasswordBusy
+from usernames import is_taken, mark_taken
+from sessions import revoke_user_sessions
+from stats import get_user_stats
 
 # Blueprint so you can keep auth routes in a separate file
 auth_bp = Blueprint("auth", __name__)
@@ -33,31 +38,37 @@ def register():
             flash("Password must be at least 6 characters long.")
             return redirect(url_for("auth.register"))
 
-        # Open DB connection
-        conn = get_connection()
-        cur = conn.cursor()
-
-        # 1) Check if username already exists
-        cur.execute("SELECT 1 FROM User_T WHERE LOWER(Username) = LOWER(?)", (username,))
-        if cur.fetchone() is not None:
-            conn.close()
+        # 1) Check if username already exists (Bloom filter first;
+        #    only "maybe taken" names hit the NOCASE index)
+        if is_taken(username):
             flash("That username is already taken.")
             return redirect(url_for("auth.register"))
 
-        # 2) Get next UserID (MAX + 1)
-        cur.execute("SELECT COALESCE(MAX(UserID), 0) + 1 AS NextID FROM User_T")
-        next_id = cur.fetchone()["NextID"]
+        # 2) Hash the password (runs on the bounded hashing pool)
+        try:
+            password_hash = hash_password(password)
+        except PasswordBusy as e:
+            flash(str(e))
+            return redirect(url_for("auth.register"))
 
-        # 3) Insert new user as regular 'User'
+        # 3) Insert new user as regular 'User' (SQLite assigns UserID).
+        #    The unique NOCASE index catches a name another worker just took.
+        conn = get_connection()
+        cur = conn.cursor()
         insert_sql = """
-            INSERT INTO User_T (UserID, Username, Password, Name, UserType, Email)
-            VALUES (?, ?, ?, ?, 'User', ?)
+            INSERT INTO User_T (Username, Password, Name, UserType, Email)
+            VALUES (?, ?, ?, 'User', ?)
         """
-        cur.execute(insert_sql, (next_id, username, password, name, email))
-
-        # Save changes
-        conn.commit()
+        try:
+            cur.execute(insert_sql, (username, password_hash, name, email))
+            conn.commit()
+        except sqlite3.IntegrityError:
+            conn.close()
+            mark_taken(username)
+            flash("That username is already taken.")
+            return redirect(url_for("auth.register"))
         conn.close()
+        mark_taken(username)
 
         flash("Registration successful! You can now log in.")
         return redirect(url_for("auth.login"))
@@ -67,6 +78,19 @@ def register():
     # Make sure you have templates/register.html
 
 
+@auth_bp.route("/register/check", methods=["GET"])
+def check_username():
+    """
+    Live availability check for the register form.
+    ?username=... -> {"available": true/false}
+    Mostly answered from the in-memory Bloom filter.
+    """
+    username = request.args.get("username", "").strip()
+    if not username:
+        return jsonify(available=False)
+    return jsonify(available=not is_taken(username))
+
+
 # Login
 @auth_bp.route("/login", methods=["GET", "POST"])
 def login():
@@ -86,22 +110,38 @@ def login():
         conn = get_connection()
         cur = conn.cursor()
 
-        # Look for matching username + password
+        # Look up the user, then check the password hash (off the request
+        # thread, on the bounded hashing pool)
         query = """
-            SELECT UserID, Username, UserType
+            SELECT UserID, Username, Name, Email, UserType, Password
             FROM User_T
-            WHERE LOWER(Username) = LOWER(?) AND Password = ?
+            WHERE Username = ? COLLATE NOCASE
         """
-        cur.execute(query, (username, password))
+        cur.execute(query, (username,))
         row = cur.fetchone()
         conn.close()
 
+        try:
+            ok, needs_rehash = verify_password(row["Password"], password) if row else (False, False)
+        except PasswordBusy as e:
+            flash(str(e))
+            return redirect(url_for("auth.login"))
+
+        if ok and needs_rehash:
+            _rehash_password(row["UserID"], row["Password"], password)
+        if not ok:
+            row = None
+
         if row:
+            # Fresh session id on login (no session fixation)
+            session.rotate()
+
             # Store user info in session so the rest of the app knows who is logged in
             session["user_id"] = row["UserID"]
             session["username"] = row["Username"]
             session["user_type"] = row["UserType"]  # 'Admin' or 'User'
             session["is_admin"] = (row["UserType"] == "Admin")
+            _cache_user(row)
 
             flash("Login successful!")
 
@@ -120,6 +160,90 @@ def login():
     # Make sure you have templates/login.html
 
 
+# SESSION USER CACHE <<<<<<<<<<
+def _cache_user(row):
+    """
+    Keeps the User_T row (minus the password) in the server-side
+    session so pages like /account don't re-read it every request.
+    """
+    session["user"] = {
+        "UserID": row["UserID"],
+        "Username": row["Username"],
+        "Name": row["Name"],
+        "Email": row["Email"],
+        "UserType": row["UserType"],
+    }
+
+
+def current_user():
+    """
+    The logged-in user's cached User_T row, or None.
+    Sessions from before the cache existed load it once.
+    Returns None (and clears the session) if the user is gone.
+    """
+    user_id = session.get("user_id")
+    if not user_id:
+        return None
+
+    user = session.get("user")
+    if user is not None:
+        metrics.CACHE_REQUESTS.inc("session_user", "hit")
+        return user
+    metrics.CACHE_REQUESTS.inc("session_user", "miss")
+
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(
+        """
+        SELECT UserID, Username, Name, Email, UserType
+        FROM User_T
+        WHERE UserID = ?
+        """,
+        (user_id,),
+    )
+    row = cur.fetchone()
+    conn.close()
+
+    if row is None:
+        session.clear()
+        return None
+    _cache_user(row)
+    return session["user"]
+
+
+# PASSWORD HELPERS <<<<<<<<<<
+def _password_matches(stored, candidate):
+    """
+    True if candidate is the user's password. Treats a busy hashing
+    pool as a mismatch (the caller shows a generic error).
+    """
+    try:
+        ok, _ = verify_password(stored, candidate)
+    except PasswordBusy:
+        return False
+    return ok
+
+
+def _rehash_password(user_id, old_stored, password):
+    """
+    Upgrades a legacy plaintext (or old-cost) password to a fresh hash
+    after a successful login. Only replaces the exact value we checked,
+    so a concurrent password change wins. Failure here never blocks login.
+    """
+    try:
+        new_stored = hash_password(password)
+    except PasswordBusy:
+        return
+
+    conn = get_connection()
+    conn.execute(
+        "UPDATE User_T SET Password = ? WHERE UserID = ? AND Password = ?",
+        (new_stored, user_id, old_stored),
+    )
+    conn.commit()
+    conn.close()
+
+
 # LOGOUT
 @auth_bp.route("/logout")
 def logout():
@@ -130,107 +254,153 @@ def logout():
     session.pop("username", None)
     session.pop("user_type", None)
     session.pop("is_admin", None)
+    session.pop("user", None)
     flash("You have been logged out.")
     return redirect(url_for("shop.shop_home"))  # or home page
 
+ORDERS_PER_PAGE = 20
+
+
 @auth_bp.route("/account", methods=["GET", "POST"])
 def account():
     """
     Account page:
     - Shows basic user info
-    - Shows past orders
+    - Shows past orders, one page at a time (?before=<cursor> for older ones)
     - (Optional) Handles password change on POST
     """
-    user_id = session.get("user_id")
-    if not user_id:
-        flash("Please log in to view your account.")
+    # User info comes from the session cache (set at login)
+    user = current_user()
+
+    # If no matching user (e.g., DB was reset), force logout
+    if user is None:
+        flash("Your session has expired. Please log in again.")
         return redirect(url_for("auth.login"))
 
+    user_id = user["UserID"]
+
+    # Change password, then back to the page (no order history needed here)
+    if request.method == "POST":
+        _change_password(user_id)
+        return redirect(url_for("auth.account"))
+
+    orders, next_cursor = _order_history_page(user_id, request.args.get("before", ""))
+
+    return render_template(
+        "account.html",
+        user=user,
+        orders=orders,
+        stats=get_user_stats(user_id),
+        next_cursor=next_cursor,
+        first_page=not request.args.get("before"),
+    )
+
+
+def _change_password(user_id):
+    current_password = request.form.get("current_password", "").strip()
+    new_password = request.form.get("new_password", "").strip()
+    confirm_password = request.form.get("confirm_password", "").strip()
+
+    if not current_password or not new_password or not confirm_password:
+        flash("Please fill out all password fields.")
+        return
+
     conn = get_connection()
     cur = conn.cursor()
 
-    # Get user info
+    # Fetch current password from DB
     cur.execute(
-        """
-        SELECT UserID, Username, Name, Email, UserType
-        FROM User_T
-        WHERE UserID = ?
-        """,
+        "SELECT Password FROM User_T WHERE UserID = ?",
         (user_id,),
     )
-    user = cur.fetchone()
+    row = cur.fetchone()
+    db_password = row["Password"] if row else None
+
+    if not _password_matches(db_password, current_password):
+        flash("Current password is incorrect.")
+    elif new_password != confirm_password:
+        flash("New passwords do not match.")
+    else:
+        try:
+            cur.execute(
+                "UPDATE User_T SET Password = ? WHERE UserID = ?",
+                (hash_password(new_password), user_id),
+            )
+            conn.commit()
+            # Log out every other session of this user
+            revoke_user_sessions(user_id, keep_sid=session.sid)
+            flash("Password updated successfully.")
+        except PasswordBusy as e:
+            flash(str(e))
 
-    # If no matching user (e.g., DB was reset), force logout
-    if user is None:
-        conn.close()
-        session.clear()
-        flash("Your session has expired. Please log in again.")
-        return redirect(url_for("auth.login"))
+    conn.close()
 
-    # Get order history from Bill_T, with:
-    # - computed TaxAmount = SubTotal * SalesTax
-    # - comma-separated item names for each bill
+
+# ORDER HISTORY <<<<<<<<<<
+def _order_history_page(user_id, before):
+    """
+    One page of the user's bills, newest first, using keyset
+    pagination on (SalesDate, SaleTime, BillID) so deep pages cost
+    the same as the first (idx_bill_user_date).
+    `before` is the cursor of the last row of the previous page
+    ("" = newest). Returns (orders, next_cursor or None).
+    Item names are only looked up for the bills on this page.
+    """
+    params = [user_id]
+    where = "b.UserID = ?"
+
+    parts = before.split("_")
+    if len(parts) == 3 and parts[2].isdigit():
+        where += " AND (b.SalesDate, b.SaleTime, b.BillID) < (?, ?, ?)"
+        params += [parts[0], parts[1], int(parts[2])]
+
+    conn = get_connection()
+    cur = conn.cursor()
+
+    # One extra row tells us whether there is an older page
     cur.execute(
-        """
+        f"""
         SELECT b.BillID,
                b.SalesDate,
                b.SaleTime,
                b.SubTotal,
                b.SalesTax,
-               (b.SubTotal * b.SalesTax)        AS TaxAmount,
+               (b.SubTotal * b.SalesTax) AS TaxAmount,
                b.ShippingCost,
-               b.Total,
-               GROUP_CONCAT(i.PotionName, ', ') AS Items
+               b.Total
         FROM Bill_T b
-        LEFT JOIN BillInventoryItem_T bi ON bi.BillID = b.BillID
-        LEFT JOIN Inventory_T i ON i.ItemID = bi.ItemID
-        WHERE b.UserID = ?
-        GROUP BY b.BillID,
-                 b.SalesDate,
-                 b.SaleTime,
-                 b.SubTotal,
-                 b.SalesTax,
-                 b.ShippingCost,
-                 b.Total
-        ORDER BY b.SalesDate DESC, b.SaleTime DESC
+        WHERE {where}
+        ORDER BY b.SalesDate DESC, b.SaleTime DESC, b.BillID DESC
+        LIMIT ?
         """,
-        (user_id,),
+        params + [ORDERS_PER_PAGE + 1],
     )
-    orders = cur.fetchall()
+    rows = cur.fetchall()
 
-    # If you want change-password in same page:
-    if request.method == "POST":
-        current_password = request.form.get("current_password", "").strip()
-        new_password = request.form.get("new_password", "").strip()
-        confirm_password = request.form.get("confirm_password", "").strip()
+    has_more = len(rows) > ORDERS_PER_PAGE
+    orders = [dict(row) for row in rows[:ORDERS_PER_PAGE]]
 
-        # Fetch current password from DB
+    # Comma-separated item names, just for the visible bills
+    if orders:
+        placeholders = ", ".join("?" for _ in orders)
         cur.execute(
-            "SELECT Password FROM User_T WHERE UserID = ?",
-            (user_id,),
+            f"""
+            SELECT bi.BillID, GROUP_CONCAT(i.PotionName, ', ') AS Items
+            FROM BillInventoryItem_T bi
+            JOIN Inventory_T i ON i.ItemID = bi.ItemID
+            WHERE bi.BillID IN ({placeholders})
+            GROUP BY bi.BillID
+            """,
+            [o["BillID"] for o in orders],
         )
-        row = cur.fetchone()
-        db_password = row["Password"] if row else None
-
-        if not current_password or not new_password or not confirm_password:
-            flash("Please fill out all password fields.")
-        elif db_password != current_password:
-            flash("Current password is incorrect.")
-        elif new_password != confirm_password:
-            flash("New passwords do not match.")
-        else:
-            # Update password (plain text for now to match the rest of your app)
-            cur.execute(
-                "UPDATE User_T SET Password = ? WHERE UserID = ?",
-                (new_password, user_id),
-            )
-            conn.commit()
-            flash("Password updated successfully.")
+        items = {row["BillID"]: row["Items"] for row in cur.fetchall()}
+        for o in orders:
+            o["Items"] = items.get(o["BillID"])
 
     conn.close()
 
-    return render_template(
-        "account.html",
-        user=user,
-        orders=orders,
-    )
\ No newline at end of file
+    next_cursor = None
+    if has_more:
+        last = orders[-1]
+        next_cursor = f"{last['SalesDate']}_{last['SaleTime']}_{last['BillID']}"
+    return orders, next_cursor
@@ -0,0 +1,162 @@
+"""
+bench_checkout.py
+Concurrent-buyer checkout race benchmark + correctness check.
+N buyer threads race through add_to_cart -> checkout -> payment for an
+overlapping pool of potions (each potion can only be sold once), against
+the Flask test client and a scratch DB. Reports orders/sec, p50/p99
+latency and lock-wait errors, then verifies that no ItemID was sold twice.
+
+    python bench_checkout.py --buyers 16 --potions 500 --per-order 2
+
+Exits with status 1 if the correctness check fails.
+"""
+
+import argparse
+import logging
+import random
+import sqlite3
+import sys
+import threading
+import time
+
+import benchutil  # must come before app: switches to a scratch DB
+from app import create_app
+from db import get_connection
+
+app = create_app()
+
+
+class _ErrorCounter(logging.Handler):
+    """
+    Counts exceptions Flask logs for failed requests, split into
+    SQLite lock waits ("database is locked") and everything else.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.lock_waits = 0
+        self.other = 0
+        self.samples = []
+
+    def emit(self, record):
+        exc = record.exc_info[1] if record.exc_info else None
+        if isinstance(exc, sqlite3.OperationalError) and "locked" in str(exc):
+            self.lock_waits += 1
+        else:
+            self.other += 1
+            if len(self.samples) < 5:
+                self.samples.append(repr(exc))
+
+
+def verify():
+    """
+    Returns a list of problems found in the scratch DB (empty = OK).
+    """
+    conn = get_connection()
+    problems = []
+
+    for row in conn.execute(
+        """
+        SELECT ItemID, COUNT(*) AS N
+        FROM BillInventoryItem_T
+        GROUP BY ItemID
+        HAVING COUNT(*) > 1
+        """
+    ):
+        problems.append(f"ItemID {row['ItemID']} appears in {row['N']} BillInventoryItem_T rows")
+
+    for row in conn.execute(
+        """
+        SELECT i.ItemID
+        FROM Inventory_T i
+        WHERE i.IsSold = 1
+          AND NOT EXISTS (SELECT 1 FROM BillInventoryItem_T bi WHERE bi.ItemID = i.ItemID)
+        """
+    ):
+        problems.append(f"ItemID {row['ItemID']} is marked sold but is on no bill")
+
+    # Running counters must match the rows they count
+    row = conn.execute(
+        """
+        SELECT s.OrderCount, s.ItemsSold,
+               (SELECT COUNT(*) FROM Bill_T) AS Bills,
+               (SELECT COUNT(*) FROM BillInventoryItem_T) AS Items
+        FROM ShopStats_T s
+        """
+    ).fetchone()
+    if (row["OrderCount"], row["ItemsSold"]) != (row["Bills"], row["Items"]):
+        problems.append(
+            f"ShopStats_T says {row['OrderCount']} orders / {row['ItemsSold']} items, "
+            f"tables have {row['Bills']} / {row['Items']}"
+        )
+
+    conn.close()
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--buyers", type=int, default=16)
+    parser.add_argument("--potions", type=int, default=500, help="size of the shared potion pool")
+    parser.add_argument("--per-order", type=int, default=2, help="potions per order")
+    parser.add_argument("--seconds", type=float, default=10.0, help="how long to run")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    usernames, item_ids = benchutil.seed(args.buyers, args.potions)
+
+    errors = _ErrorCounter()
+    app.logger.handlers[:] = [errors]
+    app.logger.propagate = False
+
+    outcomes = {}
+    latencies = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.seconds
+
+    def buyer(n):
+        client = benchutil.login(app, usernames[n])
+        while time.monotonic() < deadline and outcomes.get("ok", 0) * args.per_order < args.potions:
+            with lock:
+                picks = rng.sample(item_ids, args.per_order)
+            start = time.perf_counter()
+            outcome, _ = benchutil.buy(client, picks)
+            elapsed = time.perf_counter() - start
+            with lock:
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+                if outcome == "ok":
+                    latencies.append(elapsed)
+
+    threads = [threading.Thread(target=buyer, args=(n,)) for n in range(args.buyers)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+
+    conn = get_connection()
+    sold = conn.execute("SELECT COUNT(*) FROM Inventory_T WHERE IsSold = 1").fetchone()[0]
+    conn.close()
+
+    print(f"buyers={args.buyers} potions={args.potions} per_order={args.per_order} wall={wall:.2f}s")
+    print(f"orders/sec={outcomes.get('ok', 0) / wall:.1f}  potions sold={sold}/{args.potions}")
+    print(f"purchase p50={benchutil.percentile(latencies, 50) * 1000:.0f}ms "
+          f"p99={benchutil.percentile(latencies, 99) * 1000:.0f}ms")
+    print("outcomes:", ", ".join(f"{k}={v}" for k, v in sorted(outcomes.items())))
+    print(f"lock-wait errors={errors.lock_waits} other errors={errors.other}")
+    for sample in errors.samples:
+        print("  e.g.", sample)
+
+    problems = verify()
+    if problems:
+        print(f"CORRECTNESS FAILED ({len(problems)} problems):")
+        for p in problems[:20]:
+            print("  " + p)
+        sys.exit(1)
+    print("correctness OK: no ItemID sold twice")
+
+
+if __name__ == "__main__":
+    main()
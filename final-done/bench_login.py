@@ -0,0 +1,98 @@
+"""
+bench_login.py
+Login throughput microbenchmark for password hashing.
+Runs N threads logging in as hashed-password users for a few seconds
+while one more thread keeps hitting /shop, and reports login rate,
+login p50/p99, and /shop p50/p99. Exits 1 if logins/sec drops below
+--min-logins or /shop p99 goes over --shop-budget-ms (i.e. hashing
+starved the other requests).
+
+    python bench_login.py --threads 16 --seconds 5 --min-logins 5 --shop-budget-ms 100
+"""
+
+import argparse
+import sys
+import threading
+import time
+
+import benchutil  # must come before app: switches to a scratch DB
+from app import create_app
+from db import get_connection
+import passwords
+
+app = create_app()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--min-logins", type=float, default=5.0, help="min acceptable logins/sec")
+    parser.add_argument("--shop-budget-ms", type=float, default=100.0, help="max acceptable /shop p99")
+    args = parser.parse_args()
+
+    usernames, _ = benchutil.seed(args.threads, 10)
+
+    # Every bench user gets the same (already hashed) password
+    stored = passwords.hash_password(benchutil.BENCH_PASSWORD)
+    conn = get_connection()
+    conn.execute("UPDATE User_T SET Password = ? WHERE Username LIKE 'bench%'", (stored,))
+    conn.commit()
+    conn.close()
+
+    login_times = []
+    shop_times = []
+    failures = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.seconds
+
+    def login_loop(n):
+        while time.monotonic() < deadline:
+            client = app.test_client()
+            start = time.perf_counter()
+            resp = client.post("/login", data={"username": usernames[n], "password": benchutil.BENCH_PASSWORD})
+            elapsed = time.perf_counter() - start
+            with lock:
+                if resp.status_code == 302 and resp.location.endswith("/shop"):
+                    login_times.append(elapsed)
+                else:
+                    failures[0] += 1
+
+    def shop_loop():
+        client = app.test_client()
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            client.get("/shop")
+            shop_times.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=login_loop, args=(n,)) for n in range(args.threads)]
+    threads.append(threading.Thread(target=shop_loop))
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+
+    login_rate = len(login_times) / wall
+    shop_p99 = benchutil.percentile(shop_times, 99) * 1000
+    print(f"threads={args.threads} hash_workers={passwords.HASH_WORKERS} "
+          f"scrypt n={passwords.SCRYPT_N} r={passwords.SCRYPT_R} p={passwords.SCRYPT_P}")
+    print(f"logins/sec={login_rate:.1f} failed={failures[0]}")
+    print(f"login p50={benchutil.percentile(login_times, 50) * 1000:.0f}ms "
+          f"p99={benchutil.percentile(login_times, 99) * 1000:.0f}ms")
+    print(f"/shop during storm p50={benchutil.percentile(shop_times, 50) * 1000:.0f}ms p99={shop_p99:.0f}ms")
+
+    over = []
+    if login_rate < args.min_logins:
+        over.append(f"logins/sec {login_rate:.1f} < {args.min_logins:.1f}")
+    if shop_p99 > args.shop_budget_ms:
+        over.append(f"/shop p99 {shop_p99:.0f}ms > {args.shop_budget_ms:.0f}ms")
+    if over:
+        print("OVER BUDGET: " + "; ".join(over))
+        sys.exit(1)
+    print("within budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+bench_payment.py
+Load test for checkout while the payment gateway is slow or failing.
+Runs N buyer threads through add_to_cart -> checkout -> payment against
+the Flask test client, with the stub provider's latency / error rate
+dialed up, and reports throughput, payment latency and outcomes.
+
+    python bench_payment.py --buyers 32 --latency 2 --timeout 1
+"""
+
+import argparse
+import threading
+import time
+
+import benchutil  # must come before app: switches to a scratch DB
+from app import create_app
+from payments import CircuitBreaker, PaymentGateway, StubProvider, set_gateway
+
+app = create_app()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--buyers", type=int, default=16)
+    parser.add_argument("--orders", type=int, default=5, help="orders per buyer")
+    parser.add_argument("--latency", type=float, default=0.5, help="stub seconds per authorization")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=1.0, help="gateway timeout")
+    parser.add_argument("--pool", type=int, default=8, help="gateway worker threads")
+    args = parser.parse_args()
+
+    usernames, item_ids = benchutil.seed(args.buyers, args.buyers * args.orders)
+
+    gateway = PaymentGateway(
+        StubProvider(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate),
+        timeout=args.timeout,
+        max_workers=args.pool,
+        breaker=CircuitBreaker(failure_threshold=5, reset_timeout=2.0),
+    )
+    set_gateway(gateway)
+    app.logger.disabled = True  # failed requests are counted as "error" below
+
+    outcomes = {}
+    latencies = []
+    lock = threading.Lock()
+
+    def buyer(n):
+        client = benchutil.login(app, usernames[n])
+        mine = item_ids[n * args.orders:(n + 1) * args.orders]
+        for iid in mine:
+            outcome, seconds = benchutil.buy(client, [iid])
+            with lock:
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+                latencies.append(seconds)
+
+    threads = [threading.Thread(target=buyer, args=(n,)) for n in range(args.buyers)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+
+    attempts = sum(outcomes.values())
+    print(f"buyers={args.buyers} attempts={attempts} wall={wall:.2f}s")
+    print(f"gateway latency={args.latency}s timeout={args.timeout}s pool={args.pool} "
+          f"error_rate={args.error_rate}")
+    print(f"orders/sec={outcomes.get('ok', 0) / wall:.1f}  attempts/sec={attempts / wall:.1f}")
+    print(f"payment p50={benchutil.percentile(latencies, 50) * 1000:.0f}ms "
+          f"p99={benchutil.percentile(latencies, 99) * 1000:.0f}ms "
+          f"max={max(latencies, default=0) * 1000:.0f}ms")
+    print("outcomes:", ", ".join(f"{k}={v}" for k, v in sorted(outcomes.items())))
+    print(f"breaker state at end: {gateway.breaker.state}")
+
+
+if __name__ == "__main__":
+    main()
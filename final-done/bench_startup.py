@@ -0,0 +1,108 @@
+"""
+bench_startup.py
+Cold-start budget check for a worker process.
+Starts fresh interpreters (python -X importtime) that import app,
+call create_app() and serve one /shop request, against a scratch DB
+that a first run has already created (so it measures a worker
+booting next to a live database). Reports the time to the first
+response and the slowest imports, and exits 1 if the median run
+is over --budget-ms.
+
+    python bench_startup.py --runs 5 --budget-ms 600 --top 15
+"""
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+import benchutil  # sets EE_DB_PATH etc.; the child processes inherit them
+
+CHILD = """
+import time
+started = time.perf_counter()
+import json
+from app import create_app
+imported = time.perf_counter()
+app = create_app({"JOB_WORKERS": 0})
+created = time.perf_counter()
+status = app.test_client().get("/shop").status_code
+served = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "create_ms": (created - imported) * 1000,
+    "first_request_ms": (served - created) * 1000,
+    "status": status,
+}))
+"""
+
+# python -X importtime lines: "import time:  self [us] | cumulative | name"
+_IMPORT_RE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def run_child():
+    """
+    Runs one cold worker. Returns (timings dict, total wall ms, importtime rows).
+    """
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", CHILD],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    wall_ms = (time.perf_counter() - start) * 1000
+
+    imports = []
+    for line in proc.stderr.splitlines():
+        m = _IMPORT_RE.match(line)
+        if m:
+            imports.append((int(m.group(2)) / 1000, int(m.group(1)) / 1000, len(m.group(3)), m.group(4)))
+    return json.loads(proc.stdout.strip().splitlines()[-1]), wall_ms, imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=600.0,
+                        help="max median ms from process start to the first response")
+    parser.add_argument("--top", type=int, default=15, help="slowest imports to list")
+    args = parser.parse_args()
+
+    # First boot creates the scratch schema; not counted
+    run_child()
+
+    walls = []
+    timings = []
+    imports = None
+    for _ in range(args.runs):
+        timing, wall_ms, imports = run_child()
+        walls.append(wall_ms)
+        timings.append(timing)
+
+    def median(key):
+        return statistics.median(t[key] for t in timings)
+
+    print(f"runs={args.runs} status={timings[-1]['status']}")
+    print(f"process start -> first response: median={statistics.median(walls):.0f}ms max={max(walls):.0f}ms")
+    print(f"  import app={median('import_ms'):.0f}ms create_app={median('create_ms'):.0f}ms "
+          f"first request={median('first_request_ms'):.0f}ms")
+
+    # By cumulative time, from the last run
+    print("slowest imports (cumulative ms, self ms):")
+    for cumulative, self_ms, depth, name in sorted(imports, reverse=True)[:args.top]:
+        print(f"  {cumulative:7.1f} {self_ms:7.1f}  {' ' * (depth // 2)}{name}")
+
+    if statistics.median(walls) > args.budget_ms:
+        print(f"STARTUP BUDGET EXCEEDED: {statistics.median(walls):.0f}ms > {args.budget_ms:.0f}ms")
+        sys.exit(1)
+    print("startup budget OK")
+
+
+if __name__ == "__main__":
+    main()
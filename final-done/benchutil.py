@@ -0,0 +1,120 @@
+"""
+benchutil.py
+Shared setup for the bench_*.py load tests:
+- points the app at a scratch SQLite database (EE_DB_PATH)
+  and receipt directory (EE_RECEIPT_DIR), with rate limiting off
+- seeds buyers and potions in bulk
+- drives one buyer through add_to_cart -> checkout -> payment
+- latency percentile helper
+Import this BEFORE importing app so the scratch DB is used.
+"""
+
+import os
+import re
+import tempfile
+import time
+
+_SCRATCH_DIR = tempfile.mkdtemp(prefix="ee-bench-")
+os.environ.setdefault("EE_DB_PATH", os.path.join(_SCRATCH_DIR, "bench.db"))
+os.environ.setdefault("EE_RECEIPT_DIR", os.path.join(_SCRATCH_DIR, "receipts"))
+os.environ.setdefault("EE_RATELIMIT", "off")  # every bench client shares one IP
+
+BENCH_PASSWORD = "benchpass"
+FIRST_BUYER_ID = 1000
+FIRST_POTION_ID = 100000
+
+ADDRESS = {
+    "street": "1 Cauldron Way",
+    "city": "Salem",
+    "state": "MA",
+    "zip": "01970",
+    "shipping_id": "4003",
+}
+CARD = {"card_number": "4111 1111 1111 1111", "exp_date": "12/30", "cvv": "123"}
+
+_TOKEN_RE = re.compile(r'name="payment_token" value="([^"]*)"')
+
+
+def seed(buyers, potions):
+    """
+    Adds `buyers` users (bench0, bench1, ...) and `potions`
+    unsold items to the scratch DB. Returns (usernames, item_ids).
+    """
+    from db import get_connection, init_db
+
+    init_db()
+    usernames = [f"bench{n}" for n in range(buyers)]
+    item_ids = list(range(FIRST_POTION_ID, FIRST_POTION_ID + potions))
+
+    conn = get_connection()
+    conn.executemany(
+        """
+        INSERT INTO User_T (UserID, Username, Password, Name, UserType, Email)
+        VALUES (?, ?, ?, ?, 'User', ?)
+        """,
+        [
+            (FIRST_BUYER_ID + n, name, BENCH_PASSWORD, name, f"{name}@example.com")
+            for n, name in enumerate(usernames)
+        ],
+    )
+    conn.executemany(
+        """
+        INSERT INTO Inventory_T (ItemID, PotionName, PotionCategory, PotionDescription, PotionCost, PotionPhoto)
+        VALUES (?, ?, 'Mystic', 'Bench potion', 10.00, '')
+        """,
+        [(iid, f"Bench Potion {iid}") for iid in item_ids],
+    )
+    conn.commit()
+    conn.close()
+    return usernames, item_ids
+
+
+def login(app, username):
+    """
+    Returns a test client logged in as `username`.
+    """
+    client = app.test_client()
+    client.post("/login", data={"username": username, "password": BENCH_PASSWORD})
+    return client
+
+
+def buy(client, item_ids, card=CARD):
+    """
+    Runs one full purchase. Returns (outcome, payment_seconds):
+    outcome is "ok", "empty" (nothing made it into the cart),
+    "sold_out" (lost a race for a potion), "rejected" (stayed on
+    the payment page) or "error".
+    """
+    for iid in item_ids:
+        client.post("/cart/add", data={"item_id": str(iid)})
+
+    page = client.post("/checkout", data=ADDRESS)
+    if page.status_code != 200:
+        return "empty", 0.0
+    match = _TOKEN_RE.search(page.get_data(as_text=True))
+    if match is None:
+        return "empty", 0.0
+
+    form = dict(ADDRESS, **card, payment_token=match.group(1))
+    start = time.perf_counter()
+    resp = client.post("/payment", data=form)
+    elapsed = time.perf_counter() - start
+
+    if resp.status_code == 302 and "/confirmation/" in (resp.location or ""):
+        return "ok", elapsed
+    if resp.status_code == 302 and (resp.location or "").endswith("/cart"):
+        return "sold_out", elapsed
+    if resp.status_code in (200, 302):
+        return "rejected", elapsed
+    return "error", elapsed
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of a list of numbers (0 if empty).
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
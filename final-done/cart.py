@@ -8,11 +8,10 @@ Handles:
 
 from flask import Blueprint, render_template, request, redirect, url_for, session, flash
 from db import get_connection  # uses EternalElixers.sql
+from refdata import tax_rate  # cached Setting_T tax rate
 
 cart_bp = Blueprint("cart", __name__)
 
-TAX_RATE = 0.06  # 6% sales tax
-
 
 # View Cart
 @cart_bp.route("/cart", methods=["GET"])
@@ -61,7 +60,7 @@ def view_cart():
         items.append(item_dict)
         subtotal += price
 
-    tax = round(subtotal * TAX_RATE, 2)
+    tax = round(subtotal * tax_rate(), 2)
     total = round(subtotal + tax, 2)
 
     return render_template(
@@ -3,17 +3,29 @@ checkout.py
 Handles:
 - Checkout page (review cart + enter shipping/payment)
 - Creating a Bill (Bill_T + BillInventoryItem_T)
-- Confirmation page showing order summary
+- Queuing post-order work for the background job workers
+- Announcing each order to live admin dashboards (events.py)
+- Confirmation page showing order summary (cached receipt)
 """
 
-from flask import Blueprint, render_template, request, redirect, url_for, session, flash
+from flask import Blueprint, render_template, request, redirect, url_for, session, flash, current_app
 from datetime import datetime
 from db import get_connection
+from idempotency import (
+    issue_payment_token,
+    claim_payment_token,
+    complete_payment_token,
+    release_payment_token,
+)
+from jobs import enqueue, job_handler
+from payments import get_gateway, PaymentError
+from refdata import shipping_options as cached_shipping_options, get_shipping, tax_rate
+from receipts import get_receipt, generate_receipts
+from stats import record_order
+from events import publish_order
 
 checkout_bp = Blueprint("checkout", __name__)
 
-TAX_RATE = 0.06  # must match what you're using elsewhere
-
 
 # HELPER: GET CURRENT USER CART ITEMS <<<<<<<<<<
 def _get_cart_items_for_user(user_id):
@@ -80,24 +92,12 @@ def checkout():
         flash("Your cart is empty. Add items before checking out.")
         return redirect(url_for("cart.view_cart"))
 
-    # Load shipping options from Shipping_T
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT ShippingID, ShippingType, ShippingCost FROM Shipping_T")
-    shipping_rows = cur.fetchall()
-    conn.close()
-
-    shipping_options = [
-        {
-            "id": row["ShippingID"],
-            "type": row["ShippingType"],
-            "cost": float(row["ShippingCost"]),
-        }
-        for row in shipping_rows
-    ]
+    # Shipping options + tax rate come from the in-memory refdata cache
+    shipping_options = cached_shipping_options()
+    rate = tax_rate()
     default_shipping_id = shipping_options[0]["id"] if shipping_options else None
 
-    tax = round(subtotal * TAX_RATE, 2)
+    tax = round(subtotal * rate, 2)
 
     # ---------- POST: validate shipping, then show PAYMENT PAGE ----------
     if request.method == "POST":
@@ -126,16 +126,17 @@ def checkout():
             return redirect(url_for("checkout.checkout"))
 
         shipping_cost = selected_shipping["cost"]
-        tax = round(subtotal * TAX_RATE, 2)
         total = round(subtotal + tax + shipping_cost, 2)
 
         # 👉 Instead of creating the Bill here, we show the PAYMENT SCREEN
-        #    and pass shipping info as hidden fields.
+        #    and pass shipping info as hidden fields, plus a one-time
+        #    token so a repeated submit can't create a second Bill.
         return render_template(
             "payment.html",
             items=items,
             subtotal=subtotal,
             tax=tax,
+            shipping_type=selected_shipping["type"],
             shipping_cost=shipping_cost,
             total=total,
             street=street,
@@ -143,6 +144,7 @@ def checkout():
             state=state,
             zip_code=zip_code,
             shipping_id=shipping_id,
+            payment_token=issue_payment_token(user_id),
         )
 
     # ---------- GET: show checkout page ----------
@@ -164,8 +166,10 @@ def checkout():
 def process_payment():
     """
     Handles the payment form:
-    - Validates fake payment fields
+    - Claims the payment token (repeat submits get the original Bill)
+    - Validates payment fields
     - Recomputes totals
+    - Authorizes the total with the payment provider
     - Creates Bill_T + BillInventoryItem_T
     - Clears cart and marks items as sold
     - Redirects to confirmation
@@ -175,6 +179,35 @@ def process_payment():
         flash("Please log in to complete payment.")
         return redirect(url_for("auth.login"))
 
+    token = request.form.get("payment_token", "").strip()
+    if not token:
+        flash("Your payment session has expired. Please try checkout again.")
+        return redirect(url_for("checkout.checkout"))
+
+    status, bill_id = claim_payment_token(token, user_id)
+    if status == "done":
+        # Double-click / retry: this token already produced a Bill
+        return redirect(url_for("checkout.confirmation", bill_id=bill_id))
+    if status == "processing":
+        flash("Your payment is still being processed. Check your account for the order.")
+        return redirect(url_for("auth.account"))
+    if status != "claimed":
+        flash("Your payment session has expired. Please try checkout again.")
+        return redirect(url_for("checkout.checkout"))
+
+    try:
+        return _place_order(user_id, token)
+    finally:
+        # Hand the token back if no Bill was created (no-op once it's done)
+        release_payment_token(token)
+
+
+def _place_order(user_id, token):
+    """
+    Does the real work of process_payment once the token is claimed.
+    Every early return leaves the token un-completed, so the caller
+    releases it and the same payment page can be submitted again.
+    """
     # Address + shipping come from hidden fields on payment page
     street = request.form.get("street", "").strip()
     city = request.form.get("city", "").strip()
@@ -198,22 +231,15 @@ def process_payment():
         flash("Your cart is empty.")
         return redirect(url_for("cart.view_cart"))
 
-    conn = get_connection()
-    cur = conn.cursor()
-
-    # Look up shipping row
-    cur.execute(
-        "SELECT ShippingType, ShippingCost FROM Shipping_T WHERE ShippingID = ?",
-        (shipping_id,),
-    )
-    ship_row = cur.fetchone()
-    if ship_row is None:
-        conn.close()
+    # Look up shipping option (cached, no query)
+    selected_shipping = get_shipping(shipping_id)
+    if selected_shipping is None:
         flash("Invalid shipping selection.")
         return redirect(url_for("checkout.checkout"))
 
-    shipping_cost = float(ship_row["ShippingCost"])
-    tax = round(subtotal * TAX_RATE, 2)
+    shipping_cost = selected_shipping["cost"]
+    rate = tax_rate()
+    tax = round(subtotal * rate, 2)
     total = round(subtotal + tax + shipping_cost, 2)
 
     # ---- Validate payment fields AFTER we know totals ----
@@ -221,15 +247,14 @@ def process_payment():
     exp_date = request.form.get("exp_date", "").strip()
     cvv = request.form.get("cvv", "").strip()
 
-    if not card_number or not exp_date or not cvv:
-        flash("Please fill out all payment fields.")
-        conn.close()
-        # Stay on payment page and re-show everything
+    # Anything that keeps us on the payment page re-shows everything
+    def stay_on_payment_page():
         return render_template(
             "payment.html",
             items=items,
             subtotal=subtotal,
             tax=tax,
+            shipping_type=selected_shipping["type"],
             shipping_cost=shipping_cost,
             total=total,
             street=street,
@@ -237,151 +262,195 @@ def process_payment():
             state=state,
             zip_code=zip_code,
             shipping_id=shipping_id,
+            payment_token=token,
         )
 
-    # ---- If we got here, pretend payment is OK -> create bill ----
-    # 1) Next BillID
-    cur.execute("SELECT COALESCE(MAX(BillID), 0) + 1 AS NextID FROM Bill_T")
-    next_bill_id = cur.fetchone()["NextID"]
+    if not card_number or not exp_date or not cvv:
+        flash("Please fill out all payment fields.")
+        return stay_on_payment_page()
 
-    # 2) Date/time
-    now = datetime.now()
-    sales_date = now.strftime("%Y-%m-%d")
-    sales_time = now.strftime("%H:%M:%S")
+    # ---- Authorize with the payment provider (bounded pool, strict timeout) ----
+    try:
+        auth_code = get_gateway().authorize(total, card_number, exp_date, cvv)
+    except PaymentError as e:
+        flash(str(e))
+        return stay_on_payment_page()
 
-    first_item_id = items[0]["item_id"]
+    # ---- Payment authorized -> create bill ----
+    conn = get_connection()
+    cur = conn.cursor()
 
-    insert_bill_sql = """
-        INSERT INTO Bill_T (
-            BillID, UserID, ShoppingCartID, ItemID,
-            SalesDate, SaleTime, SalesTax, SubTotal,
-            ShippingCost, Total, Street, City, State, Zip, ShippingID
+    try:
+        # Take the write lock up front so concurrent checkouts queue here
+        # instead of deadlocking on a read -> write lock upgrade
+        cur.execute("BEGIN IMMEDIATE")
+
+        # 0) Under the lock, make sure nobody bought these potions meanwhile
+        item_ids = [item["item_id"] for item in items]
+        placeholders = ", ".join("?" * len(item_ids))
+        cur.execute(
+            f"SELECT ItemID, PotionName FROM Inventory_T WHERE IsSold = 1 AND ItemID IN ({placeholders})",
+            item_ids,
+        )
+        sold_rows = cur.fetchall()
+        if sold_rows:
+            cur.executemany(
+                "DELETE FROM ShoppingCart_T WHERE UserID = ? AND ItemID = ?",
+                [(user_id, row["ItemID"]) for row in sold_rows],
+            )
+            conn.commit()
+            get_gateway().void(auth_code)
+            names = ", ".join(row["PotionName"] for row in sold_rows)
+            flash(f"Sorry, {names} sold out while you were checking out. You have not been charged.")
+            return redirect(url_for("cart.view_cart"))
+
+        # 1) Next BillID
+        cur.execute("SELECT COALESCE(MAX(BillID), 0) + 1 AS NextID FROM Bill_T")
+        next_bill_id = cur.fetchone()["NextID"]
+
+        # 2) Date/time
+        now = datetime.now()
+        sales_date = now.strftime("%Y-%m-%d")
+        sales_time = now.strftime("%H:%M:%S")
+
+        first_item_id = items[0]["item_id"]
+
+        insert_bill_sql = """
+            INSERT INTO Bill_T (
+                BillID, UserID, ShoppingCartID, ItemID,
+                SalesDate, SaleTime, SalesTax, SubTotal,
+                ShippingCost, Total, Street, City, State, Zip, ShippingID
+            )
+            VALUES (?, ?, NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """
+        cur.execute(
+            insert_bill_sql,
+            (
+                next_bill_id,
+                user_id,
+                first_item_id,
+                sales_date,
+                sales_time,
+                rate,
+                subtotal,
+                shipping_cost,
+                total,
+                street,
+                city,
+                state,
+                zip_code,
+                shipping_id,
+            ),
         )
-        VALUES (?, ?, NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """
-    cur.execute(
-        insert_bill_sql,
-        (
-            next_bill_id,
-            user_id,
-            first_item_id,
-            sales_date,
-            sales_time,
-            TAX_RATE,
-            subtotal,
-            shipping_cost,
-            total,
-            street,
-            city,
-            state,
-            zip_code,
-            shipping_id,
-        ),
-    )
 
-    # 3) Insert bill items
-    cur.execute(
-        "SELECT COALESCE(MAX(BillInventoryItemID), 0) + 1 AS NextID FROM BillInventoryItem_T"
-    )
-    next_bill_item_id = cur.fetchone()["NextID"]
+        # 3) Insert bill items
+        cur.execute(
+            "SELECT COALESCE(MAX(BillInventoryItemID), 0) + 1 AS NextID FROM BillInventoryItem_T"
+        )
+        next_bill_item_id = cur.fetchone()["NextID"]
 
-    insert_bill_item_sql = """
-        INSERT INTO BillInventoryItem_T (BillInventoryItemID, BillID, ItemID)
-        VALUES (?, ?, ?)
-    """
-    current_id = next_bill_item_id
-    for item in items:
-        cur.execute(insert_bill_item_sql, (current_id, next_bill_id, item["item_id"]))
-        current_id += 1
-
-    # 4) Clear cart
-    cur.execute("DELETE FROM ShoppingCart_T WHERE UserID = ?", (user_id,))
-
-    # 5) Mark items as sold
-    item_ids = [item["item_id"] for item in items]
-    cur.executemany(
-        "UPDATE Inventory_T SET IsSold = 1 WHERE ItemID = ?",
-        [(iid,) for iid in item_ids],
-    )
+        insert_bill_item_sql = """
+            INSERT INTO BillInventoryItem_T (BillInventoryItemID, BillID, ItemID)
+            VALUES (?, ?, ?)
+        """
+        current_id = next_bill_item_id
+        for item in items:
+            cur.execute(insert_bill_item_sql, (current_id, next_bill_id, item["item_id"]))
+            current_id += 1
+
+        # 4) Take the bought potions out of every cart (ours and anyone else's)
+        cur.execute(
+            f"DELETE FROM ShoppingCart_T WHERE ItemID IN ({placeholders})",
+            item_ids,
+        )
 
-    conn.commit()
-    conn.close()
+        # 5) Mark items as sold
+        cur.executemany(
+            "UPDATE Inventory_T SET IsSold = 1 WHERE ItemID = ?",
+            [(iid,) for iid in item_ids],
+        )
+
+        # 6) Running per-user / shop-wide totals and sales rollups (same transaction)
+        record_order(cur, next_bill_id, user_id, sales_date, total, len(items))
+
+        # 7) Remember which Bill this token made (same transaction)
+        complete_payment_token(cur, token, next_bill_id)
+
+        # 8) Queue post-order work; it runs after commit, off the request
+        enqueue(
+            cur,
+            "order_placed",
+            {"bill_id": next_bill_id, "user_id": user_id, "auth_code": auth_code},
+        )
+
+        conn.commit()
+    except Exception:
+        # Lock wait timed out ("database is locked") or a write failed:
+        # nothing was saved, so let go of the card hold
+        current_app.logger.exception("placing the order for user %s failed", user_id)
+        conn.rollback()
+        get_gateway().void(auth_code)
+        flash("We couldn't place your order just now. You have not been charged. Please try again.")
+        return stay_on_payment_page()
+    finally:
+        conn.close()
+
+    # Live admin dashboards (only once the order is really committed)
+    publish_order(total, len(items))
 
     flash("Payment successful! Your order has been placed.")
     return redirect(url_for("checkout.confirmation", bill_id=next_bill_id))
 
 
+# POST-ORDER JOBS <<<<<<<<<<
+@job_handler("order_placed")
+def _order_placed(payload):
+    """
+    Runs on a job worker after a Bill is committed.
+    Receipts, rollups and notifications hang off this
+    instead of running inline in process_payment.
+    """
+    current_app.logger.info(
+        "order placed: bill %s for user %s (auth %s)",
+        payload["bill_id"],
+        payload["user_id"],
+        payload.get("auth_code"),
+    )
+
+    # Pre-render the receipt so the confirmation page is a cache hit.
+    # The template uses url_for, which needs a request context.
+    with current_app.test_request_context("/"):
+        generate_receipts(payload["bill_id"], payload["user_id"])
+
 
 # CONFIRMATION PAGE <<<<<<<<<<
 @checkout_bp.route("/confirmation/<int:bill_id>", methods=["GET"])
 def confirmation(bill_id):
     """
     Shows a simple order confirmation / receipt for the given BillID.
+    Served from the receipt cache; only the owner can see it.
+    """
+    return _serve_receipt(bill_id, "html")
+
+
+@checkout_bp.route("/confirmation/<int:bill_id>/print", methods=["GET"])
+def confirmation_print(bill_id):
+    """
+    Printer-friendly version of the receipt.
     """
+    return _serve_receipt(bill_id, "print")
+
+
+def _serve_receipt(bill_id, variant):
     user_id = session.get("user_id")
     if not user_id:
         flash("Please log in to view your orders.")
         return redirect(url_for("auth.login"))
 
-    conn = get_connection()
-    cur = conn.cursor()
-
-    # Get Bill info
-    cur.execute(
-        """
-        SELECT
-            b.BillID,
-            b.SalesDate,
-            b.SaleTime,
-            b.SubTotal,
-            b.SalesTax,
-            b.ShippingCost,
-            b.Total,
-            b.Street,
-            b.City,
-            b.State,
-            b.Zip,
-            s.ShippingType
-        FROM Bill_T b
-        LEFT JOIN Shipping_T s ON b.ShippingID = s.ShippingID
-        WHERE b.BillID = ? AND b.UserID = ?
-        """,
-        (bill_id, user_id),
-    )
-    bill = cur.fetchone()
-
-    if bill is None:
-        conn.close()
+    html = get_receipt(bill_id, user_id, variant)
+    if html is None:
         flash("Order not found.")
         return redirect(url_for("shop.shop_home"))
 
-    # Get items for the bill
-    cur.execute(
-        """
-        SELECT
-            i.PotionName,
-            i.PotionDescription,
-            i.PotionCost
-        FROM BillInventoryItem_T bi
-        JOIN Inventory_T i ON bi.ItemID = i.ItemID
-        WHERE bi.BillID = ?
-        """,
-        (bill_id,),
-    )
-    item_rows = cur.fetchall()
-    conn.close()
-
-    items = [
-        {
-            "name": row["PotionName"],
-            "description": row["PotionDescription"],
-            "price": float(row["PotionCost"]),
-        }
-        for row in item_rows
-    ]
-
-    return render_template(
-        "confirmation.html",
-        bill=bill,
-        items=items,
-    )
+    # Receipts never change, but they're per-user: browser cache only
+    return html, 200, {"Cache-Control": "private, max-age=3600"}
@@ -0,0 +1,37 @@
+"""
+config.py
+App-level settings for create_app(), read from the environment:
+- EE_SECRET_KEY           session signing key (set this in production)
+- EE_DB_PATH              SQLite database file (default EternalElixers.db)
+- EE_INIT_DB              on | off: create / upgrade the schema at startup (default on)
+- EE_WARM_CACHES          on | off: load refdata before the first request (default on)
+- EE_JOB_WORKERS          in-process job worker threads, started with the first request (default 1)
+- EE_STARTUP_BUDGET_MS    create_app() logs a warning when slower than this (default 500)
+
+Subsystems with their own knobs (sessions, ratelimit, events, reports,
+payments, passwords, metrics) still read theirs; see each module's docstring.
+"""
+
+import os
+
+from db import DB_PATH
+
+DEV_SECRET_KEY = "CHANGE_THIS_SECRET_KEY"
+
+
+def _flag(environ, name, default):
+    return environ.get(name, default) != "off"
+
+
+def from_env(environ=os.environ):
+    """
+    Returns the config dict for app.config, from `environ`.
+    """
+    return {
+        "SECRET_KEY": environ.get("EE_SECRET_KEY", DEV_SECRET_KEY),
+        "DATABASE": environ.get("EE_DB_PATH", str(DB_PATH)),
+        "INIT_DB": _flag(environ, "EE_INIT_DB", "on"),
+        "WARM_CACHES": _flag(environ, "EE_WARM_CACHES", "on"),
+        "JOB_WORKERS": int(environ.get("EE_JOB_WORKERS", "1")),
+        "STARTUP_BUDGET_MS": float(environ.get("EE_STARTUP_BUDGET_MS", "500")),
+    }
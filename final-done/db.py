@@ -5,21 +5,65 @@ db.py
 - inventory management and admin promotion
 """
 
+import json
+import math
+import os
 import sqlite3
+import zlib
 from pathlib import Path
 
+from flask import current_app, has_app_context
+
 BASE_DIR = Path(__file__).resolve().parent
-DB_PATH = BASE_DIR / "EternalElixers.db"
+# EE_DB_PATH lets load tests / benchmarks point at a scratch database
+DB_PATH = Path(os.environ.get("EE_DB_PATH", BASE_DIR / "EternalElixers.db"))
 SCHEMA_PATH = BASE_DIR / "EternalElixers.sql"
+UPGRADES_PATH = BASE_DIR / "EternalElixers_upgrades.sql"
+
+# How long a connection waits for another one's write lock before
+# giving up with "database is locked"
+BUSY_TIMEOUT_SECONDS = 10
+
+# Class get_connection() opens; metrics.init_app() swaps in one that
+# counts and times every statement
+connection_class = sqlite3.Connection
+
+# Paths init_db() has brought up to date in this process
+_initialized_paths = set()
+
+
+class SchemaUpgradeError(Exception):
+    """The database holds data the upgrades can't apply over; str() says what to fix."""
+
+
+def configure(db_path):
+    """
+    Sets the process default database (DB_PATH), used wherever
+    there is no app context (serve.py's master, scripts).
+    """
+    global DB_PATH
+    DB_PATH = Path(db_path)
+
+
+def database_path():
+    """
+    The current app's DATABASE setting inside an app context,
+    so apps from create_app() each keep their own file;
+    DB_PATH otherwise.
+    """
+    if has_app_context():
+        return Path(current_app.config["DATABASE"])
+    return DB_PATH
 
 
 def get_connection():
     """
-    Opens a connection to the EternalElixers.db SQLite database.
+    Opens a connection to the EternalElixers.db SQLite database
+    (database_path(), so the current app's file).
     Returns a connection object that other modules can use.
     Ensures foreign keys are enforced and rows are dict-like.
     """
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(database_path(), timeout=BUSY_TIMEOUT_SECONDS, factory=connection_class)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA foreign_keys = ON")
     return conn
@@ -28,26 +72,142 @@ def get_connection():
 def init_db():
     """
     If the database file is missing or empty, create it
-    and run the schema/seed SQL from EternalElixers.sql
+    and run the schema/seed SQL from EternalElixers.sql.
+    Then apply EternalElixers_upgrades.sql, which only adds
+    tables/indexes that don't exist yet, so it is safe on every start.
+
+    Idempotent and cheap to repeat: the upgrades' checksum is kept
+    in PRAGMA user_version, so a worker booting against an up-to-date
+    database only reads that header instead of re-running the script.
     """
-    # If file exists AND is non-empty, leave it alone
-    if DB_PATH.exists() and DB_PATH.stat().st_size > 0:
+    db_path = database_path()
+    if db_path in _initialized_paths:
         return
 
-    print("Initializing new EternalElixers.db at:", DB_PATH)
+    # If file exists AND is non-empty, only apply upgrades
+    if not (db_path.exists() and db_path.stat().st_size > 0):
+        print("Initializing new EternalElixers.db at:", db_path)
+        _run_script(db_path, SCHEMA_PATH)
+        print("Database initialized.")
+
+    upgrades_version = zlib.crc32(UPGRADES_PATH.read_bytes()) & 0x7FFFFFFF
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_SECONDS)
+    current_version = conn.execute("PRAGMA user_version").fetchone()[0]
+    conn.close()
+
+    if current_version != upgrades_version:
+        _check_double_sold(db_path)
+        _check_duplicate_usernames(db_path)
+        _run_script(db_path, UPGRADES_PATH)
+        _backfill_sales_rollup(db_path)
+
+        # WAL lets readers keep going while a checkout is committing
+        # (the setting is stored in the database file itself)
+        conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_SECONDS)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute(f"PRAGMA user_version = {upgrades_version}")
+        conn.close()
+
+    _initialized_paths.add(db_path)
+
+
+def _check_double_sold(db_path):
+    """
+    Raises SchemaUpgradeError if a potion is on more than one bill
+    (possible before checkout re-checked IsSold), since the upgrades'
+    UNIQUE index on BillInventoryItem_T(ItemID) can't be built then.
+    """
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_SECONDS)
+    rows = conn.execute(
+        """
+        SELECT ItemID, GROUP_CONCAT(BillID, ', ')
+        FROM BillInventoryItem_T
+        GROUP BY ItemID
+        HAVING COUNT(*) > 1
+        ORDER BY ItemID
+        """
+    ).fetchall()
+    conn.close()
+    if rows:
+        sold_twice = "; ".join(f"ItemID {item_id} on BillIDs {bill_ids}" for item_id, bill_ids in rows)
+        raise SchemaUpgradeError(
+            f"{db_path}: potions sold more than once ({sold_twice}). Refund or correct "
+            "those bills so each ItemID is on one bill only, then start again."
+        )
+
+
+def _check_duplicate_usernames(db_path):
+    """
+    Raises SchemaUpgradeError if two users' Usernames differ only in
+    case (possible while register checked LOWER() without a lock),
+    since the upgrades' UNIQUE NOCASE index on Username can't be built then.
+    """
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_SECONDS)
+    rows = conn.execute(
+        """
+        SELECT LOWER(Username), GROUP_CONCAT(UserID, ', ')
+        FROM User_T
+        GROUP BY Username COLLATE NOCASE
+        HAVING COUNT(*) > 1
+        ORDER BY 1
+        """
+    ).fetchall()
+    conn.close()
+    if rows:
+        clashes = "; ".join(f"{name!r} on UserIDs {user_ids}" for name, user_ids in rows)
+        raise SchemaUpgradeError(
+            f"{db_path}: usernames that differ only in case ({clashes}). Rename or merge "
+            "those users so each username is unique ignoring case, then start again."
+        )
+
 
-    conn = sqlite3.connect(DB_PATH)
+def _backfill_sales_rollup(db_path):
+    """
+    Fills SalesRollup_T from Bill_T if it is still empty (a database
+    that had sales before the table existed), with the same query as
+    `flask stats rebuild rollups`.
+    """
+    import stats  # stats imports db
+
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_SECONDS)
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    if cur.execute("SELECT 1 FROM SalesRollup_T LIMIT 1").fetchone() is None:
+        stats.rebuild_sales_rollup(cur)
+    conn.commit()
+    conn.close()
+
+
+def _run_script(db_path, path):
+    """
+    Runs a whole .sql file against the database in one go.
+    """
+    conn = sqlite3.connect(db_path)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA foreign_keys = ON")
 
-    with open(SCHEMA_PATH, "r", encoding="utf-8") as f:
+    with open(path, "r", encoding="utf-8") as f:
         sql = f.read()
 
     conn.executescript(sql)
     conn.commit()
     conn.close()
 
-    print("Database initialized.")
+
+# CACHE VERSION HELPERS <<<<<<<<<<
+def bump_cache_version(cur, name):
+    """
+    Tells every worker's refdata cache that data set `name`
+    ('shipping', 'settings' or 'catalog') changed. Uses the caller's
+    cursor so the bump commits together with the change itself.
+    """
+    cur.execute(
+        """
+        INSERT INTO CacheVersion_T (Name, Version) VALUES (?, 1)
+        ON CONFLICT(Name) DO UPDATE SET Version = Version + 1
+        """,
+        (name,),
+    )
 
 
 # INVENTORY HELPERS <<<<<<<<<<
@@ -90,6 +250,7 @@ def add_inventory_item(name, category, description, cost, photo):
         """,
         (name, category, description, cost, photo),
     )
+    bump_cache_version(cur, "catalog")
     conn.commit()
     conn.close()
 
@@ -98,27 +259,160 @@ def delete_inventory_item(item_id):
     conn = get_connection()
     cur = conn.cursor()
     cur.execute("DELETE FROM Inventory_T WHERE ItemID = ?", (item_id,))
+    bump_cache_version(cur, "catalog")
     conn.commit()
     conn.close()
 
 
+# BULK INVENTORY HELPERS <<<<<<<<<<
+# Each helper is one set-based statement over the matching unsold
+# potions (sold ones stay as they were on the receipt), in one
+# transaction with a single catalog version bump.
+def _unsold_items_where(item_ids=None, category=None, name_contains=None):
+    """
+    WHERE clause for unsold potions matching the given ItemIDs
+    and/or filters. The ID list travels as one JSON parameter, so any
+    number of IDs is still a single statement.
+    """
+    clauses = ["IsSold = 0"]
+    params = []
+    if item_ids is not None:
+        clauses.append("ItemID IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps([int(i) for i in item_ids]))
+    if category:
+        clauses.append("PotionCategory = ?")
+        params.append(category)
+    if name_contains:
+        clauses.append("PotionName LIKE ?")
+        params.append(f"%{name_contains}%")
+    return " AND ".join(clauses), params
+
+
+def delete_inventory_items(item_ids):
+    """
+    Deletes the given unsold potions (and takes them out of carts).
+    Returns how many potions were deleted.
+    """
+    where, params = _unsold_items_where(item_ids)
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(f"DELETE FROM ShoppingCart_T WHERE ItemID IN (SELECT ItemID FROM Inventory_T WHERE {where})", params)
+    cur.execute(f"DELETE FROM Inventory_T WHERE {where}", params)
+    count = cur.rowcount
+    bump_cache_version(cur, "catalog")
+    conn.commit()
+    conn.close()
+    return count
+
+
+def reprice_inventory(mode, amount, item_ids=None, category=None, name_contains=None):
+    """
+    Changes the price of every matching unsold potion:
+    - mode "percent":  +10 = 10% more, -25 = 25% off
+    - mode "absolute": add `amount` dollars (negative to discount)
+    Prices are rounded to cents and never drop below $0.01.
+    Returns how many potions were repriced. Raises ValueError for a
+    non-finite amount (NaN would set every price to NULL).
+    """
+    if not math.isfinite(amount):
+        raise ValueError(f"reprice amount must be a finite number, not {amount!r}")
+    if mode == "percent":
+        new_cost = "PotionCost * (1 + ? / 100.0)"
+    else:
+        new_cost = "PotionCost + ?"
+    where, params = _unsold_items_where(item_ids, category, name_contains)
+
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(
+        f"UPDATE Inventory_T SET PotionCost = MAX(0.01, ROUND({new_cost}, 2)) WHERE {where}",
+        [amount] + params,
+    )
+    count = cur.rowcount
+    bump_cache_version(cur, "catalog")
+    conn.commit()
+    conn.close()
+    return count
+
+
+def recategorize_inventory(new_category, item_ids=None, category=None, name_contains=None):
+    """
+    Moves every matching unsold potion to `new_category`.
+    Returns how many potions changed.
+    """
+    where, params = _unsold_items_where(item_ids, category, name_contains)
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(f"UPDATE Inventory_T SET PotionCategory = ? WHERE {where}", [new_category] + params)
+    count = cur.rowcount
+    bump_cache_version(cur, "catalog")
+    conn.commit()
+    conn.close()
+    return count
+
+
 # USER / ADMIN HELPERS <<<<<<<<<<
-def get_all_users():
+USERS_PER_PAGE = 50
+
+
+def _prefix_range(prefix):
+    """
+    (low, high) bounds matching every string that starts with prefix
+    under NOCASE, as a plain range so the NOCASE indexes are used.
+    """
+    low = prefix.lower()
+    return low, low[:-1] + chr(ord(low[-1]) + 1)
+
+
+def search_users(query="", user_type=None, after_id=0, limit=USERS_PER_PAGE):
     """
-    Return all users for the admin 'manage users' screen.
+    One page of users for the admin 'manage users' screen, by UserID,
+    with their running order stats (UserStats_T, no aggregation).
+    - query: case-insensitive prefix of Username, Name or Email
+      (each side served by its NOCASE index)
+    - user_type: 'Admin' / 'User' filter (idx_user_type_id)
+    - after_id: keyset cursor, the last UserID of the previous page
+    Returns (rows, has_more).
     """
+    clauses = ["u.UserID > ?"]
+    params = [after_id]
+    if user_type:
+        clauses.append("u.UserType = ?")
+        params.append(user_type)
+    if query:
+        # Each prefix is a range scan on its own NOCASE index; the
+        # UNIONed IDs come back sorted, so no pass over every user
+        low, high = _prefix_range(query)
+        clauses.append(
+            """u.UserID IN (
+                SELECT UserID FROM User_T WHERE Username >= ? COLLATE NOCASE AND Username < ? COLLATE NOCASE
+                UNION
+                SELECT UserID FROM User_T WHERE Name >= ? COLLATE NOCASE AND Name < ? COLLATE NOCASE
+                UNION
+                SELECT UserID FROM User_T WHERE Email >= ? COLLATE NOCASE AND Email < ? COLLATE NOCASE
+            )"""
+        )
+        params += [low, high] * 3
+
     conn = get_connection()
     cur = conn.cursor()
     cur.execute(
-        """
-        SELECT UserID, Username, Name, Email, UserType
-        FROM User_T
-        ORDER BY UserID
-        """
+        f"""
+        SELECT u.UserID, u.Username, u.Name, u.Email, u.UserType,
+               COALESCE(s.OrderCount, 0)      AS OrderCount,
+               COALESCE(s.LifetimeSpend, 0)   AS LifetimeSpend,
+               s.LastOrderDate
+        FROM User_T u
+        LEFT JOIN UserStats_T s ON s.UserID = u.UserID
+        WHERE {" AND ".join(clauses)}
+        ORDER BY u.UserID
+        LIMIT ?
+        """,
+        params + [limit + 1],
     )
     rows = cur.fetchall()
     conn.close()
-    return rows
+    return rows[:limit], len(rows) > limit
 
 
 def promote_user_to_admin(user_id):
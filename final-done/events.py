@@ -0,0 +1,210 @@
+"""
+events.py
+Live updates for the admin dashboard over Server-Sent Events:
+- process_payment publishes an "order" event (orders / revenue /
+  items-sold deltas) once its transaction commits
+- every open dashboard holds one /admin/events stream; a publish is
+  one put per subscriber queue, with no queries per viewer
+- a new stream starts with a "snapshot" of the shop totals, so
+  a reconnecting dashboard never misses what happened meanwhile
+
+Pub/sub is in process memory, so with several worker processes a
+dashboard only sees orders placed by its own worker. For that case
+set EE_EVENTS_FANOUT=sqlite: each process then runs one poller thread
+that watches `PRAGMA data_version` (a free, no-I/O check that changes
+whenever another connection commits) and, when it moves, re-reads
+the one-row ShopStats_T and broadcasts the difference. Checkout's
+direct publish is then skipped so local orders aren't counted twice.
+
+Configured from the environment:
+- EE_EVENTS_FANOUT    off | sqlite    (default off)
+"""
+
+import json
+import os
+import queue
+import threading
+
+import metrics
+from db import get_connection
+
+FANOUT = os.environ.get("EE_EVENTS_FANOUT", "off")
+POLL_INTERVAL_SECONDS = 0.5
+HEARTBEAT_SECONDS = 15     # comment line so proxies don't drop idle streams
+MAX_SUBSCRIBERS = 100      # open streams per process (serve.py sets it to --max-streams)
+SUBSCRIBER_QUEUE_SIZE = 100  # a client this far behind is dropped
+
+
+# BROKER <<<<<<<<<<
+class Broker:
+    """
+    In-process pub/sub: each subscriber gets a bounded queue.
+    publish() never blocks; a subscriber whose queue is full is
+    cut off (its stream ends and the browser reconnects).
+    """
+
+    def __init__(self, max_subscribers=MAX_SUBSCRIBERS):
+        self.max_subscribers = max_subscribers
+        self.closed = False
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        """
+        Returns a new queue, or None if this process is at
+        max_subscribers or shutting down.
+        """
+        q = queue.Queue(SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            if self.closed or len(self._subscribers) >= self.max_subscribers:
+                return None
+            self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def publish(self, event, data):
+        message = (event, data)
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                # Too far behind: drop its backlog and tell the stream to close
+                self.unsubscribe(q)
+                self._end(q)
+
+    def close(self):
+        """
+        Ends every open stream and refuses new ones (a retiring worker
+        calls this so its streams don't keep it from exiting; the
+        browsers reconnect to another worker).
+        """
+        with self._lock:
+            self.closed = True
+            subscribers = list(self._subscribers)
+            self._subscribers.clear()
+        for q in subscribers:
+            self._end(q)
+
+    @staticmethod
+    def _end(q):
+        with q.mutex:
+            q.queue.clear()
+        q.put_nowait(None)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+
+broker = Broker()
+metrics.Gauge("ee_dashboard_streams", "Live dashboard streams open.", broker.subscriber_count)
+
+
+def _totals(row):
+    return {"orders": row["OrderCount"], "revenue": round(float(row["Revenue"]), 2), "items": row["ItemsSold"]}
+
+
+def _format(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream(shop_stats):
+    """
+    Generator for one SSE response: the shop totals (a get_shop_stats()
+    row) as a snapshot first, then every event published in this
+    process until the client leaves.
+    Returns None instead if there are too many open streams.
+    """
+    q = broker.subscribe()
+    if q is None:
+        return None
+
+    def generate():
+        try:
+            yield "retry: 3000\n"
+            yield _format("snapshot", _totals(shop_stats))
+            while True:
+                try:
+                    message = q.get(timeout=HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                if message is None:
+                    return
+                yield _format(*message)
+        finally:
+            broker.unsubscribe(q)
+
+    return generate()
+
+
+# PUBLISHING <<<<<<<<<<
+def publish_order(total, item_count):
+    """
+    Called by process_payment after its commit. With the SQLite
+    fan-out on, the poller reports the order instead.
+    """
+    if _poller is not None:
+        return
+    broker.publish("order", {"orders": 1, "revenue": round(total, 2), "items": item_count})
+
+
+class DataVersionPoller(threading.Thread):
+    """
+    Cross-worker fan-out: watches the database for commits made by any
+    connection and publishes the change in ShopStats_T as an "order"
+    event. Several orders between two polls arrive as one event.
+    """
+
+    def __init__(self, app, interval=POLL_INTERVAL_SECONDS):
+        super().__init__(name="events-poller", daemon=True)
+        self.app = app
+        self.interval = interval
+        self._stopping = threading.Event()
+
+    def run(self):
+        with self.app.app_context():  # the app's DATABASE
+            conn = get_connection()
+        try:
+            version, last = None, None
+            while True:
+                # fetchall() so no statement is left open holding a read snapshot
+                current = conn.execute("PRAGMA data_version").fetchall()[0][0]
+                if current != version:
+                    version = current
+                    row = conn.execute(
+                        "SELECT OrderCount, Revenue, ItemsSold FROM ShopStats_T WHERE StatsID = 1"
+                    ).fetchall()[0]
+                    totals = _totals(row)
+                    if last is not None and totals["orders"] != last["orders"]:
+                        broker.publish("order", {
+                            "orders": totals["orders"] - last["orders"],
+                            "revenue": round(totals["revenue"] - last["revenue"], 2),
+                            "items": totals["items"] - last["items"],
+                        })
+                    last = totals
+                if self._stopping.wait(self.interval):
+                    break
+        finally:
+            conn.close()
+
+    def stop(self):
+        self._stopping.set()
+
+
+_poller = None
+
+
+def init_app(app):
+    """
+    Starts the data_version poller when EE_EVENTS_FANOUT=sqlite.
+    """
+    global _poller
+    if FANOUT == "sqlite" and _poller is None:
+        _poller = DataVersionPoller(app)
+        _poller.start()
@@ -0,0 +1,134 @@
+"""
+idempotency.py
+Handles:
+- Issuing a one-time payment token each time the payment page is shown
+- Claiming that token when the payment form is submitted
+- Remembering which Bill a token produced, so a double-click or a
+  network retry gets the original confirmation instead of a second order
+"""
+
+import secrets
+import time
+
+from db import get_connection
+
+TOKEN_TTL_SECONDS = 15 * 60  # how long a payment page stays valid
+
+
+def issue_payment_token(user_id):
+    """
+    Creates a new 'issued' token for this user and returns it.
+    Also clears out expired tokens so the table stays small
+    (the delete is served by the CreatedAt index).
+    """
+    token = secrets.token_urlsafe(24)
+    now = time.time()
+
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(
+        "DELETE FROM PaymentToken_T WHERE CreatedAt < ?",
+        (now - TOKEN_TTL_SECONDS,),
+    )
+    cur.execute(
+        """
+        INSERT INTO PaymentToken_T (Token, UserID, Status, CreatedAt)
+        VALUES (?, ?, 'issued', ?)
+        """,
+        (token, user_id, now),
+    )
+    conn.commit()
+    conn.close()
+    return token
+
+
+def claim_payment_token(token, user_id):
+    """
+    Tries to take ownership of a token for one payment attempt.
+    Returns (status, bill_id):
+    - ("claimed", None)    -> caller should process the payment
+    - ("done", bill_id)    -> already paid, send them to that bill
+    - ("processing", None) -> another submit is still running
+    - ("invalid", None)    -> unknown, someone else's, or expired
+    Never waits: a duplicate submit answers "processing" straight away
+    instead of holding a request thread until the first one finishes.
+    """
+    cutoff = time.time() - TOKEN_TTL_SECONDS
+
+    conn = get_connection()
+    cur = conn.cursor()
+
+    # Two tries: the first submit may hand the token back (no Bill)
+    # between our UPDATE and SELECT, and then it's ours to take
+    for _ in range(2):
+        # Single atomic UPDATE: only one request can flip 'issued' -> 'processing'
+        cur.execute(
+            """
+            UPDATE PaymentToken_T
+            SET Status = 'processing'
+            WHERE Token = ? AND UserID = ? AND Status = 'issued' AND CreatedAt >= ?
+            """,
+            (token, user_id, cutoff),
+        )
+        conn.commit()
+        if cur.rowcount == 1:
+            conn.close()
+            return "claimed", None
+
+        # Lost the race (or a retry): see what the other request did
+        cur.execute(
+            """
+            SELECT Status, BillID
+            FROM PaymentToken_T
+            WHERE Token = ? AND UserID = ? AND CreatedAt >= ?
+            """,
+            (token, user_id, cutoff),
+        )
+        row = cur.fetchone()
+
+        if row is None:
+            conn.close()
+            return "invalid", None
+        if row["Status"] == "done":
+            conn.close()
+            return "done", row["BillID"]
+        if row["Status"] == "processing":
+            break
+
+    conn.close()
+    return "processing", None
+
+
+def complete_payment_token(cur, token, bill_id):
+    """
+    Marks a claimed token as done with the Bill it created.
+    Takes the caller's cursor so it commits in the same
+    transaction as the Bill itself.
+    """
+    cur.execute(
+        """
+        UPDATE PaymentToken_T
+        SET Status = 'done', BillID = ?
+        WHERE Token = ? AND Status = 'processing'
+        """,
+        (bill_id, token),
+    )
+
+
+def release_payment_token(token):
+    """
+    Gives a claimed token back so the same payment page can be
+    submitted again (used when the attempt did not create a Bill).
+    No-op once the token is done.
+    """
+    conn = get_connection()
+    conn.execute(
+        """
+        UPDATE PaymentToken_T
+        SET Status = 'issued'
+        WHERE Token = ? AND Status = 'processing'
+        """,
+        (token,),
+    )
+    conn.commit()
+    conn.close()
@@ -0,0 +1,383 @@
+"""
+importers.py
+Bulk loaders for data coming from outside the web forms:
+- `flask import users FILE.csv`: accounts from a legacy CSV export
+- `flask import inventory FILE.csv|.ndjson` (and the admin inventory
+  page): potions in bulk
+
+Rows are streamed (never the whole file in memory), validated and
+de-duplicated in memory, then written with executemany in large
+batches, a few transactions in total. Bad rows go to a reject file
+with the reason, so they can be fixed and re-imported.
+"""
+
+import csv
+import io
+import json
+import math
+import sqlite3
+import time
+
+import click
+from flask.cli import AppGroup
+
+from db import get_connection, bump_cache_version
+from passwords import hash_passwords, HASH_WORKERS
+
+MIN_PASSWORD_LENGTH = 6  # same rule as auth.register
+USER_TYPES = ("User", "Admin")
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class _Progress:
+    """
+    Counts rows and prints a rows/sec line as the import goes.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.read = 0
+        self.imported = 0
+        self.rejected = 0
+
+    def rate(self):
+        elapsed = time.perf_counter() - self.started
+        return self.read / elapsed if elapsed else 0.0
+
+    def report(self, final=False):
+        label = "done" if final else "..."
+        click.echo(
+            f"{label} read={self.read} imported={self.imported} "
+            f"rejected={self.rejected} ({self.rate():.0f} rows/s)"
+        )
+
+
+class InventoryImportError(Exception):
+    """
+    An inventory import stopped partway (unreadable file, database
+    error). str() is safe to show; .progress counts what was already
+    committed before it stopped.
+    """
+
+    def __init__(self, message, progress):
+        super().__init__(message)
+        self.progress = progress
+
+
+# USERS <<<<<<<<<<
+def _existing_usernames():
+    """
+    Every current username, lower-cased (names are unique NOCASE).
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT Username FROM User_T")
+    names = set()
+    while True:
+        rows = cur.fetchmany(5000)
+        if not rows:
+            break
+        names.update(row["Username"].lower() for row in rows)
+    conn.close()
+    return names
+
+
+def _clean_user_row(raw, taken):
+    """
+    Validates one CSV row (header names are case-insensitive).
+    Returns (values, None) or (None, reason). Adds the username
+    to `taken` so later duplicates in the file are rejected.
+    """
+    row = {k.strip().lower(): (v or "").strip() for k, v in raw.items() if isinstance(k, str)}
+    email = row.get("email", "")
+    password = row.get("password", "")
+    username = row.get("username", "") or email
+    user_type = row.get("usertype", "") or "User"
+
+    if not email or not password or not username:
+        return None, "missing email, password or username"
+    if "@" not in email:
+        return None, "invalid email"
+    if len(password) < MIN_PASSWORD_LENGTH:
+        return None, f"password shorter than {MIN_PASSWORD_LENGTH} characters"
+    if user_type not in USER_TYPES:
+        return None, f"unknown UserType {user_type!r}"
+    if username.lower() in taken:
+        return None, "username already taken"
+
+    taken.add(username.lower())
+    return (username, password, row.get("name", ""), user_type, email), None
+
+
+def import_users(csv_file, reject_file, batch_size=1000, txn_rows=20000, workers=HASH_WORKERS):
+    """
+    Streams users from csv_file into User_T.
+    Passwords are hashed `workers` at a time outside any transaction;
+    rows are then inserted `batch_size` per executemany, `txn_rows`
+    per transaction, so the write lock is only held for the inserts.
+    Returns the _Progress counters.
+    """
+    progress = _Progress()
+    taken = _existing_usernames()
+
+    reader = csv.DictReader(csv_file)
+    fields = list(reader.fieldnames or [])
+    rejects = csv.writer(reject_file)
+    rejects.writerow(fields + ["error"])
+
+    def reject(raw, reason):
+        rejects.writerow([raw.get(f, "") for f in fields] + [reason])
+        progress.rejected += 1
+
+    pending = []  # (raw, insert values)
+    for raw_batch in _batches(reader, batch_size):
+        good = []
+        for raw in raw_batch:
+            progress.read += 1
+            values, reason = _clean_user_row(raw, taken)
+            if reason:
+                reject(raw, reason)
+            else:
+                good.append((raw, values))
+
+        hashes = hash_passwords([values[1] for _, values in good], workers)
+        for (raw, values), password_hash in zip(good, hashes):
+            pending.append((raw, (values[0], password_hash) + values[2:]))
+
+        if len(pending) >= txn_rows:
+            _insert_users(pending, batch_size, progress, reject)
+            pending = []
+            progress.report()
+
+    if pending:
+        _insert_users(pending, batch_size, progress, reject)
+    return progress
+
+
+def _insert_users(pending, batch_size, progress, reject):
+    """
+    One write transaction of batched inserts. OR IGNORE skips a name
+    someone registered on the site after we loaded the taken set;
+    those rows are found afterwards and rejected.
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    skipped = []
+    for chunk in _batches(pending, batch_size):
+        before = conn.total_changes
+        cur.executemany(
+            """
+            INSERT OR IGNORE INTO User_T (Username, Password, Name, UserType, Email)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            [values for _, values in chunk],
+        )
+        inserted = conn.total_changes - before
+        progress.imported += inserted
+        if inserted < len(chunk):
+            # Rare: find the rows whose (salted, unique) hash didn't land
+            for raw, values in chunk:
+                cur.execute("SELECT Password FROM User_T WHERE Username = ? COLLATE NOCASE", (values[0],))
+                if cur.fetchone()["Password"] != values[1]:
+                    skipped.append(raw)
+    conn.commit()
+    conn.close()
+
+    for raw in skipped:
+        reject(raw, "username already taken")
+
+
+# INVENTORY <<<<<<<<<<
+def _inventory_rows(text_stream, fmt):
+    """
+    Yields (line_no, raw dict or None) from a CSV (header row) or
+    NDJSON (one JSON object per line) text stream. raw is None for an
+    NDJSON line that isn't a JSON object.
+    """
+    if fmt == "ndjson":
+        for line_no, line in enumerate(text_stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                raw = json.loads(line)
+            except ValueError:
+                raw = None
+            yield line_no, raw if isinstance(raw, dict) else None
+    else:
+        for line_no, raw in enumerate(csv.DictReader(text_stream), start=2):
+            yield line_no, raw
+
+
+def _clean_potion_row(raw):
+    """
+    Validates one potion (keys are case-insensitive, with or without
+    the "Potion" prefix: name / PotionName, cost / PotionCost, ...).
+    Returns (values, None) or (None, reason).
+    """
+    if raw is None:
+        return None, "not a JSON object"
+    row = {}
+    for key, value in raw.items():
+        if not isinstance(key, str):
+            continue
+        key = key.strip().lower()
+        key = key[len("potion"):] if key.startswith("potion") else key
+        row[key] = "" if value is None else str(value).strip()
+
+    name = row.get("name", "")
+    if not name:
+        return None, "missing name"
+    try:
+        cost = float(row.get("cost", ""))
+    except ValueError:
+        return None, "cost is not a number"
+    if not math.isfinite(cost):  # "nan", "inf", "1e400"
+        return None, "cost is not a number"
+    if cost <= 0:
+        return None, "cost must be positive"
+
+    return (name, row.get("category", ""), row.get("description", ""), cost, row.get("photo", "")), None
+
+
+def import_inventory(text_stream, fmt, reject=None, chunk_size=1000, txn_rows=20000):
+    """
+    Streams potions from a CSV / NDJSON text stream into Inventory_T.
+    Rows are parsed and validated with no lock held; every `txn_rows`
+    good rows are then written in one short transaction,
+    `chunk_size` per executemany, which also bumps the catalog cache
+    version. reject(line_no, raw, reason) is called for every bad row.
+    Returns the _Progress counters; raises InventoryImportError if the
+    file or the database fails partway.
+    """
+    progress = _Progress()
+    pending = []
+    try:
+        for chunk in _batches(_inventory_rows(text_stream, fmt), chunk_size):
+            for line_no, raw in chunk:
+                progress.read += 1
+                values, reason = _clean_potion_row(raw)
+                if reason:
+                    progress.rejected += 1
+                    if reject:
+                        reject(line_no, raw, reason)
+                else:
+                    pending.append(values)
+
+            if len(pending) >= txn_rows:
+                _insert_potions(pending, chunk_size, progress)
+                pending = []
+
+        if pending:
+            _insert_potions(pending, chunk_size, progress)
+    except (UnicodeDecodeError, csv.Error) as exc:
+        raise InventoryImportError(
+            f"The file couldn't be read as UTF-8 CSV / NDJSON after {progress.read} row(s).", progress
+        ) from exc
+    except sqlite3.Error as exc:
+        raise InventoryImportError(f"The database stopped the import: {exc}.", progress) from exc
+    return progress
+
+
+def _insert_potions(pending, chunk_size, progress):
+    """
+    One write transaction of batched inserts plus the catalog version
+    bump, so every worker reloads its categories once per transaction.
+    Rolled back as a whole if anything fails.
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("BEGIN IMMEDIATE")
+        for chunk in _batches(pending, chunk_size):
+            cur.executemany(
+                """
+                INSERT INTO Inventory_T (PotionName, PotionCategory, PotionDescription, PotionCost, PotionPhoto)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                chunk,
+            )
+        bump_cache_version(cur, "catalog")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    progress.imported += len(pending)
+
+
+def detect_format(filename):
+    return "ndjson" if filename.lower().endswith((".ndjson", ".jsonl")) else "csv"
+
+
+def open_upload(file_storage):
+    """
+    Text stream over an uploaded file (werkzeug FileStorage),
+    read incrementally from its spooled temp file.
+    """
+    return io.TextIOWrapper(file_storage.stream, encoding="utf-8-sig", newline="")
+
+
+# CLI: flask import ... <<<<<<<<<<
+import_cli = AppGroup("import", help="Bulk-load data from files.")
+
+
+@import_cli.command("users")
+@click.argument("csv_path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--rejects", "reject_path", default=None,
+              help="Where to write rejected rows (default: <csv>.rejects.csv).")
+@click.option("--batch-size", default=1000, show_default=True, help="Rows per executemany.")
+@click.option("--txn-rows", default=20000, show_default=True, help="Rows per transaction.")
+@click.option("--workers", default=HASH_WORKERS, show_default=True, help="Password hashing threads.")
+def import_users_command(csv_path, reject_path, batch_size, txn_rows, workers):
+    """Import accounts from CSV (Username, Password, Name, Email, UserType)."""
+    reject_path = reject_path or f"{csv_path}.rejects.csv"
+    with open(csv_path, newline="", encoding="utf-8-sig") as csv_file, \
+            open(reject_path, "w", newline="", encoding="utf-8") as reject_file:
+        progress = import_users(csv_file, reject_file, batch_size, txn_rows, workers)
+    progress.report(final=True)
+    if progress.rejected:
+        click.echo(f"Rejected rows written to {reject_path}")
+
+
+@import_cli.command("inventory")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(["csv", "ndjson"]), default=None,
+              help="Input format (default: from the file extension).")
+@click.option("--rejects", "reject_path", default=None,
+              help="Where to write rejected rows (default: <file>.rejects.csv).")
+@click.option("--chunk-size", default=1000, show_default=True, help="Rows per executemany.")
+@click.option("--txn-rows", default=20000, show_default=True, help="Rows per transaction.")
+def import_inventory_command(path, fmt, reject_path, chunk_size, txn_rows):
+    """Import potions (name, category, description, cost, photo) from CSV or NDJSON."""
+    fmt = fmt or detect_format(path)
+    reject_path = reject_path or f"{path}.rejects.csv"
+    with open(path, newline="", encoding="utf-8-sig") as source, \
+            open(reject_path, "w", newline="", encoding="utf-8") as reject_file:
+        rejects = csv.writer(reject_file)
+        rejects.writerow(["line", "error", "row"])
+        try:
+            progress = import_inventory(
+                source,
+                fmt,
+                reject=lambda line_no, raw, reason: rejects.writerow([line_no, reason, json.dumps(raw)]),
+                chunk_size=chunk_size,
+                txn_rows=txn_rows,
+            )
+        except InventoryImportError as exc:
+            exc.progress.report(final=True)
+            raise click.ClickException(str(exc))
+    progress.report(final=True)
+    if progress.rejected:
+        click.echo(f"Rejected rows written to {reject_path}")
@@ -0,0 +1,398 @@
+"""
+jobs.py
+Durable background job queue backed by Job_T:
+- enqueue() writes a job inside the caller's transaction
+  (so post-order work is saved together with the Bill)
+- worker threads claim jobs in batches and run registered handlers,
+  heartbeating their locks so only a dead worker's jobs get re-queued
+- failed jobs are retried with exponential backoff, then dead-lettered
+- `flask jobs ...` commands to inspect, retry and run the queue
+"""
+
+import json
+import os
+import random
+import socket
+import threading
+import time
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from db import get_connection
+
+DEFAULT_MAX_ATTEMPTS = 5
+BACKOFF_BASE_SECONDS = 2
+BACKOFF_MAX_SECONDS = 10 * 60
+LOCK_TIMEOUT_SECONDS = 5 * 60  # a 'running' job not heartbeated for this long is assumed lost
+HEARTBEAT_SECONDS = LOCK_TIMEOUT_SECONDS / 5
+BATCH_SIZE = 20
+POLL_INTERVAL_SECONDS = 1.0
+
+# kind -> function(payload dict)
+_HANDLERS = {}
+
+# running Worker threads in this process
+_WORKERS = []
+
+# set by enqueue() so local workers pick new jobs up without waiting a poll
+_WAKEUP = threading.Event()
+
+
+# REGISTERING HANDLERS <<<<<<<<<<
+def job_handler(kind):
+    """
+    Decorator that registers a function as the handler for a job kind.
+    The function gets the job's payload dict. Raising an exception
+    marks the attempt as failed.
+    """
+    def decorator(func):
+        _HANDLERS[kind] = func
+        return func
+    return decorator
+
+
+# ENQUEUE <<<<<<<<<<
+def enqueue(cur, kind, payload, delay=0, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """
+    Adds a job using the caller's cursor. Nothing runs until the
+    caller commits, so a rolled-back order never fires its jobs.
+    """
+    now = time.time()
+    cur.execute(
+        """
+        INSERT INTO Job_T (Kind, Payload, Status, Attempts, MaxAttempts, RunAfter, CreatedAt)
+        VALUES (?, ?, 'queued', 0, ?, ?, ?)
+        """,
+        (kind, json.dumps(payload), max_attempts, now + delay, now),
+    )
+    _WAKEUP.set()
+
+
+def _backoff_seconds(attempts):
+    """
+    Exponential backoff with jitter: ~2s, 4s, 8s ... capped at BACKOFF_MAX_SECONDS.
+    """
+    delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** (attempts - 1)))
+    return delay * random.uniform(0.5, 1.0)
+
+
+# CLAIM + RUN <<<<<<<<<<
+def claim_batch(worker_id, limit=BATCH_SIZE):
+    """
+    Atomically moves up to `limit` due jobs to 'running' for this worker
+    and returns them. Jobs whose LockedAt hasn't been refreshed for
+    LOCK_TIMEOUT_SECONDS (worker crashed; see _Heartbeat) are put back
+    in the queue first.
+    """
+    now = time.time()
+
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(
+        """
+        UPDATE Job_T
+        SET Status = 'queued', LockedBy = NULL, LockedAt = NULL
+        WHERE Status = 'running' AND LockedAt < ?
+        """,
+        (now - LOCK_TIMEOUT_SECONDS,),
+    )
+    cur.execute(
+        """
+        UPDATE Job_T
+        SET Status = 'running', LockedBy = ?, LockedAt = ?, Attempts = Attempts + 1
+        WHERE JobID IN (
+            SELECT JobID
+            FROM Job_T
+            WHERE Status = 'queued' AND RunAfter <= ?
+            ORDER BY RunAfter
+            LIMIT ?
+        )
+        RETURNING JobID, Kind, Payload, Attempts, MaxAttempts
+        """,
+        (worker_id, now, now, limit),
+    )
+    jobs = cur.fetchall()
+    conn.commit()
+    conn.close()
+    return jobs
+
+
+class _Heartbeat(threading.Thread):
+    """
+    Refreshes LockedAt every HEARTBEAT_SECONDS on the jobs of a batch
+    that haven't finished yet, so a long handler (or a long batch)
+    isn't taken for a crashed worker and run a second time.
+    """
+
+    def __init__(self, worker_id, job_ids):
+        super().__init__(name=f"job-heartbeat-{worker_id}", daemon=True)
+        self.app = current_app._get_current_object()
+        self.worker_id = worker_id
+        self.pending = set(job_ids)
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def done(self, job_id):
+        with self._lock:
+            self.pending.discard(job_id)
+
+    def run(self):
+        while not self._stopping.wait(HEARTBEAT_SECONDS):
+            with self._lock:
+                job_ids = list(self.pending)
+            if not job_ids:
+                continue
+            try:
+                with self.app.app_context():
+                    conn = get_connection()
+                    conn.execute(
+                        f"""
+                        UPDATE Job_T
+                        SET LockedAt = ?
+                        WHERE Status = 'running' AND LockedBy = ?
+                          AND JobID IN ({",".join("?" * len(job_ids))})
+                        """,
+                        (time.time(), self.worker_id, *job_ids),
+                    )
+                    conn.commit()
+                    conn.close()
+            except Exception:
+                self.app.logger.exception("job worker %s failed to heartbeat its jobs", self.worker_id)
+
+    def stop(self):
+        self._stopping.set()
+        self.join()
+
+
+def run_batch(jobs, worker_id):
+    """
+    Runs each claimed job's handler while a _Heartbeat keeps the
+    batch's locks fresh, then records all the results in one
+    transaction: finished jobs are deleted, failed ones are
+    rescheduled with backoff or dead-lettered after MaxAttempts.
+    Results only apply to jobs still locked by `worker_id`; a job
+    another worker has since reclaimed is left to that worker.
+    """
+    finished = []
+    retries = []
+    dead = []
+
+    heartbeat = _Heartbeat(worker_id, [job["JobID"] for job in jobs])
+    heartbeat.start()
+    try:
+        for job in jobs:
+            handler = _HANDLERS.get(job["Kind"])
+            try:
+                if handler is None:
+                    raise LookupError(f"no handler registered for job kind {job['Kind']!r}")
+                handler(json.loads(job["Payload"]))
+            except Exception as exc:  # any failure counts as a failed attempt
+                error = f"{type(exc).__name__}: {exc}"
+                if job["Attempts"] >= job["MaxAttempts"]:
+                    dead.append((error, job["JobID"], worker_id))
+                else:
+                    run_after = time.time() + _backoff_seconds(job["Attempts"])
+                    retries.append((run_after, error, job["JobID"], worker_id))
+            else:
+                finished.append((job["JobID"], worker_id))
+            heartbeat.done(job["JobID"])
+    finally:
+        heartbeat.stop()
+
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.executemany("DELETE FROM Job_T WHERE JobID = ? AND LockedBy = ?", finished)
+    cur.executemany(
+        """
+        UPDATE Job_T
+        SET Status = 'queued', RunAfter = ?, LastError = ?, LockedBy = NULL, LockedAt = NULL
+        WHERE JobID = ? AND LockedBy = ?
+        """,
+        retries,
+    )
+    cur.executemany(
+        """
+        UPDATE Job_T
+        SET Status = 'dead', LastError = ?, LockedBy = NULL, LockedAt = NULL
+        WHERE JobID = ? AND LockedBy = ?
+        """,
+        dead,
+    )
+    conn.commit()
+    conn.close()
+
+    return len(finished), len(retries), len(dead)
+
+
+# WORKER THREADS <<<<<<<<<<
+class Worker(threading.Thread):
+    """
+    Background thread that keeps claiming and running batches
+    until stop() is called. Everything runs inside the app's context,
+    so it uses the app's DATABASE and handlers can use current_app,
+    render_template, etc.
+    """
+
+    def __init__(self, app, name, batch_size=BATCH_SIZE, poll_interval=POLL_INTERVAL_SECONDS):
+        super().__init__(name=name, daemon=True)
+        self.app = app
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{name}"
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._stopping = threading.Event()
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                with self.app.app_context():
+                    jobs = claim_batch(self.worker_id, self.batch_size)
+                    if jobs:
+                        run_batch(jobs, self.worker_id)
+                        continue
+            except Exception:
+                self.app.logger.exception("job worker %s failed to process a batch", self.worker_id)
+
+            # Nothing to do: sleep until the next poll or a local enqueue()
+            _WAKEUP.wait(self.poll_interval)
+            _WAKEUP.clear()
+
+    def stop(self):
+        self._stopping.set()
+        _WAKEUP.set()
+
+
+def start_workers(app, count):
+    """
+    Starts `count` worker threads for this process and returns them.
+    """
+    for _ in range(count):
+        worker = Worker(app, name=f"job-worker-{len(_WORKERS) + 1}")
+        worker.start()
+        _WORKERS.append(worker)
+    return _WORKERS
+
+
+def stop_workers(timeout=5):
+    """
+    Asks every worker in this process to stop and waits for them.
+    """
+    for worker in _WORKERS:
+        worker.stop()
+    for worker in _WORKERS:
+        worker.join(timeout)
+    _WORKERS.clear()
+
+
+# CLI: flask jobs ... <<<<<<<<<<
+jobs_cli = AppGroup("jobs", help="Inspect and run the background job queue.")
+
+
+@jobs_cli.command("stats")
+def jobs_stats():
+    """Show how many jobs are in each status, per kind."""
+    conn = get_connection()
+    rows = conn.execute(
+        """
+        SELECT Kind, Status, COUNT(*) AS N
+        FROM Job_T
+        GROUP BY Kind, Status
+        ORDER BY Kind, Status
+        """
+    ).fetchall()
+    conn.close()
+
+    if not rows:
+        click.echo("Queue is empty.")
+        return
+    for row in rows:
+        click.echo(f"{row['Kind']:<24} {row['Status']:<8} {row['N']:>8}")
+
+
+@jobs_cli.command("list")
+@click.option("--status", default="dead", show_default=True,
+              type=click.Choice(["queued", "running", "dead"]))
+@click.option("--limit", default=20, show_default=True)
+def jobs_list(status, limit):
+    """List jobs in one status (dead letters by default)."""
+    conn = get_connection()
+    rows = conn.execute(
+        """
+        SELECT JobID, Kind, Attempts, MaxAttempts, Payload, LastError
+        FROM Job_T
+        WHERE Status = ?
+        ORDER BY JobID
+        LIMIT ?
+        """,
+        (status, limit),
+    ).fetchall()
+    conn.close()
+
+    for row in rows:
+        click.echo(
+            f"#{row['JobID']} {row['Kind']} attempts={row['Attempts']}/{row['MaxAttempts']} "
+            f"payload={row['Payload']} error={row['LastError'] or '-'}"
+        )
+
+
+@jobs_cli.command("retry")
+@click.argument("job_ids", nargs=-1, type=int)
+@click.option("--all-dead", is_flag=True, help="Requeue every dead-lettered job.")
+def jobs_retry(job_ids, all_dead):
+    """Put dead-lettered jobs back in the queue."""
+    conn = get_connection()
+    cur = conn.cursor()
+    if all_dead:
+        cur.execute(
+            "UPDATE Job_T SET Status = 'queued', Attempts = 0, RunAfter = ? WHERE Status = 'dead'",
+            (time.time(),),
+        )
+    else:
+        cur.executemany(
+            "UPDATE Job_T SET Status = 'queued', Attempts = 0, RunAfter = ? WHERE JobID = ? AND Status = 'dead'",
+            [(time.time(), job_id) for job_id in job_ids],
+        )
+    conn.commit()
+    click.echo(f"Requeued {cur.rowcount} job(s).")
+    conn.close()
+
+
+@jobs_cli.command("purge-dead")
+def jobs_purge_dead():
+    """Delete all dead-lettered jobs."""
+    conn = get_connection()
+    cur = conn.execute("DELETE FROM Job_T WHERE Status = 'dead'")
+    conn.commit()
+    click.echo(f"Deleted {cur.rowcount} dead job(s).")
+    conn.close()
+
+
+@jobs_cli.command("work")
+@click.option("--threads", default=2, show_default=True, help="Worker threads to run.")
+@click.option("--burst", is_flag=True, help="Exit once the queue has no due jobs.")
+def jobs_work(threads, burst):
+    """Run queue workers in the foreground."""
+    from flask import current_app
+
+    app = current_app._get_current_object()
+
+    if burst:
+        worker_id = f"{socket.gethostname()}:{os.getpid()}:burst"
+        total = [0, 0, 0]
+        while True:
+            jobs = claim_batch(worker_id)
+            if not jobs:
+                break
+            for i, n in enumerate(run_batch(jobs, worker_id)):
+                total[i] += n
+        click.echo(f"done={total[0]} retried={total[1]} dead={total[2]}")
+        return
+
+    start_workers(app, threads)
+    click.echo(f"Running {threads} job worker thread(s). Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop_workers()
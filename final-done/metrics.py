@@ -0,0 +1,458 @@
+"""
+metrics.py
+Request, database, cache and pool metrics, served at GET /metrics in
+the Prometheus text format (no client library needed):
+- ee_http_requests_total{endpoint,method,status}
+- ee_http_request_duration_seconds{endpoint}   histogram, until the response starts
+- ee_http_requests_in_flight
+- ee_db_queries_per_request{endpoint}          histogram
+- ee_db_seconds_per_request{endpoint}          histogram (execute + fetch time)
+- ee_db_queries_total, ee_db_query_seconds_total   every thread, jobs included
+- ee_db_connections_opened_total               get_connection() opens one per call (no pool)
+- ee_cache_requests_total{cache,result}        refdata / receipts / session_user
+- ee_pool_rejected_total{pool}                 payment / password / admission: turned away when full
+- ee_dashboard_streams                         open /admin/events streams (events.py)
+Hit rates are ratios of these, e.g. in PromQL
+    sum(rate(ee_cache_requests_total{cache="receipts",result="hit"}[5m]))
+      / sum(rate(ee_cache_requests_total{cache="receipts"}[5m]))
+
+Several worker processes (serve.py): each worker writes a snapshot of
+its counters to a shared directory every FLUSH_SECONDS and when it
+exits. A scrape, whichever worker answers it, adds up every worker's
+snapshot plus retired.json, where serve.py's master folds in the last
+snapshot of each worker that exited, so totals never go backwards when
+a worker restarts. Gauges only come from running workers.
+
+Configured from the environment:
+- EE_METRICS          on | off  (default on)
+- EE_METRICS_TOKEN    bearer token a scraper must send. Without one,
+                      only loopback clients may read /metrics (set a
+                      token when a proxy sits in front)
+"""
+
+import hmac
+import json
+import os
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+from pathlib import Path
+
+from flask import Response, request
+
+import db
+
+ENABLED = os.environ.get("EE_METRICS", "on") != "off"
+TOKEN = os.environ.get("EE_METRICS_TOKEN", "")
+FLUSH_SECONDS = 2
+RETIRED_FILE = "retired.json"
+FOLDED_MEMORY_SECONDS = 60  # how long retired.json remembers which snapshots it holds
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+METRICS_DIR = None   # shared snapshot directory (serve.py sets one up); None = this process only
+_worker_id = None    # this process's snapshot id, set by init_app()
+_flusher = None
+_in_flight = 0
+_lock = threading.Lock()
+_local = threading.local()  # .db = [queries, seconds] while a request is running
+_families = {}              # name -> metric, in declaration order
+
+
+# METRIC TYPES <<<<<<<<<<
+class Counter:
+    """
+    Monotonic count per combination of label values.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}  # label values tuple -> number
+        _families[name] = self
+
+    def inc(self, *label_values, amount=1):
+        with _lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Histogram:
+    """
+    Observations counted into fixed buckets. Each value is a list:
+    one (non-cumulative) count per bucket, one for +Inf, then the sum.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+        _families[name] = self
+
+    def observe(self, value, *label_values):
+        slot = bisect_left(self.buckets, value)
+        with _lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 2)
+            counts[slot] += 1
+            counts[-1] += value
+
+
+class Gauge:
+    """
+    Current value, read from `collect()` at snapshot time.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help, collect):
+        self.name = name
+        self.help = help
+        self.labels = ()
+        self.collect = collect
+        _families[name] = self
+
+
+# METRICS <<<<<<<<<<
+HTTP_REQUESTS = Counter("ee_http_requests_total", "Requests served.", ("endpoint", "method", "status"))
+HTTP_DURATION = Histogram(
+    "ee_http_request_duration_seconds", "Time until the response starts.", ("endpoint",)
+)
+HTTP_IN_FLIGHT = Gauge("ee_http_requests_in_flight", "Requests being served now.", lambda: _in_flight)
+DB_QUERIES_PER_REQUEST = Histogram(
+    "ee_db_queries_per_request", "SQL statements run by one request.", ("endpoint",), QUERY_COUNT_BUCKETS
+)
+DB_SECONDS_PER_REQUEST = Histogram(
+    "ee_db_seconds_per_request", "Time one request spent in SQLite.", ("endpoint",)
+)
+DB_QUERIES = Counter("ee_db_queries_total", "SQL statements run, requests and background threads.")
+DB_SECONDS = Counter("ee_db_query_seconds_total", "Time spent in SQLite, requests and background threads.")
+DB_CONNECTIONS = Counter("ee_db_connections_opened_total", "Connections opened by db.get_connection().")
+CACHE_REQUESTS = Counter("ee_cache_requests_total", "Cache lookups by outcome.", ("cache", "result"))
+POOL_REJECTED = Counter("ee_pool_rejected_total", "Work turned away because a pool was full.", ("pool",))
+
+
+# DATABASE TIMING <<<<<<<<<<
+def _record_query(seconds, count=1):
+    stats = getattr(_local, "db", None)
+    if stats is None:
+        DB_QUERIES.inc(amount=count)
+        DB_SECONDS.inc(amount=seconds)
+    else:
+        # Added to the totals once, when the request ends
+        stats[0] += count
+        stats[1] += seconds
+
+
+class TimedCursor(sqlite3.Cursor):
+    """
+    Cursor that counts statements and times execute + fetch calls
+    (rows read by iterating the cursor aren't timed).
+    """
+
+    def _timed(self, method, args, count):
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            _record_query(time.perf_counter() - started, count)
+
+    def execute(self, *args):
+        return self._timed(super().execute, args, 1)
+
+    def executemany(self, *args):
+        return self._timed(super().executemany, args, 1)
+
+    def executescript(self, *args):
+        return self._timed(super().executescript, args, 1)
+
+    def fetchone(self):
+        return self._timed(super().fetchone, (), 0)
+
+    def fetchmany(self, *args):
+        return self._timed(super().fetchmany, args, 0)
+
+    def fetchall(self):
+        return self._timed(super().fetchall, (), 0)
+
+
+class TimedConnection(sqlite3.Connection):
+    """
+    Connection whose cursors (including conn.execute shortcuts) are TimedCursors.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        DB_CONNECTIONS.inc()
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def executescript(self, *args):
+        return self.cursor().executescript(*args)
+
+
+# REQUEST INSTRUMENTATION <<<<<<<<<<
+class _Instrument:
+    """
+    WSGI middleware around the Flask app: times each request from
+    before the session loads until the response starts, and collects
+    the request's SQL counts (streamed bodies run after that, so an
+    export's or event stream's queries only reach the totals).
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        global _in_flight
+
+        def capture_status(status, headers, exc_info=None):
+            environ["ee.status"] = status.split(" ", 1)[0]
+            return start_response(status, headers, exc_info)
+
+        with _lock:
+            _in_flight += 1
+        _local.db = stats = [0, 0.0]
+        started = time.perf_counter()
+        try:
+            return self.wsgi_app(environ, capture_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            _local.db = None
+            with _lock:
+                _in_flight -= 1
+            endpoint = environ.get("ee.endpoint", "unmatched")
+            HTTP_REQUESTS.inc(endpoint, environ["REQUEST_METHOD"], environ.get("ee.status", "500"))
+            HTTP_DURATION.observe(elapsed, endpoint)
+            DB_QUERIES_PER_REQUEST.observe(stats[0], endpoint)
+            DB_SECONDS_PER_REQUEST.observe(stats[1], endpoint)
+            DB_QUERIES.inc(amount=stats[0])
+            DB_SECONDS.inc(amount=stats[1])
+
+
+def _note_endpoint():
+    # Registered first, so it runs even when a later hook answers early (429 / 503)
+    request.environ["ee.endpoint"] = request.endpoint or "unmatched"
+
+
+# SNAPSHOTS (one per worker) <<<<<<<<<<
+def configure(metrics_dir):
+    """
+    Shares metrics through `metrics_dir` (serve.py's master calls
+    this before forking). Every worker that inherits it writes
+    snapshots there, and any of them can answer a scrape for all.
+    """
+    global METRICS_DIR
+    METRICS_DIR = Path(metrics_dir)
+    METRICS_DIR.mkdir(parents=True, exist_ok=True)
+
+
+def _snapshot():
+    with _lock:
+        counters = {
+            family.name: [[list(labels), list(value) if family.kind == "histogram" else value]
+                          for labels, value in family.values.items()]
+            for family in _families.values()
+            if family.kind != "gauge"
+        }
+    gauges = {family.name: family.collect() for family in _families.values() if family.kind == "gauge"}
+    return {"id": _worker_id, "pid": os.getpid(), "counters": counters, "gauges": gauges}
+
+
+def _add(totals, counters):
+    """
+    Adds a snapshot's counters into `totals` (name -> labels -> value).
+    """
+    for name, rows in counters.items():
+        family = totals.setdefault(name, {})
+        for labels, value in rows:
+            key = tuple(labels)
+            have = family.get(key)
+            if have is None:
+                family[key] = list(value) if isinstance(value, list) else value
+            elif isinstance(value, list):
+                if len(have) == len(value):  # skip if a reload changed the buckets
+                    family[key] = [a + b for a, b in zip(have, value)]
+            else:
+                family[key] = have + value
+
+
+def _rows(totals):
+    return {name: [[list(labels), value] for labels, value in family.items()] for name, family in totals.items()}
+
+
+def _read(path):
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _write(path, data):
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(json.dumps(data), encoding="utf-8")
+    os.replace(tmp_path, path)
+
+
+def flush():
+    """
+    Writes this worker's snapshot (no-op with a single process).
+    """
+    if METRICS_DIR is not None and _worker_id is not None:
+        _write(METRICS_DIR / f"worker-{os.getpid()}.json", _snapshot())
+
+
+def _flush_forever():
+    while True:
+        time.sleep(FLUSH_SECONDS)
+        try:
+            flush()
+        except OSError:
+            pass  # directory gone (master shutting down); try again later
+
+
+def fold_worker(pid):
+    """
+    Adds an exited worker's last snapshot to retired.json and deletes
+    it. Only serve.py's master calls this, so retired.json has a single
+    writer; it lists the snapshot ids it holds, so a scrape that read a
+    worker file just before the fold doesn't count it twice.
+    """
+    if METRICS_DIR is None:
+        return
+    path = METRICS_DIR / f"worker-{pid}.json"
+    snapshot = _read(path)
+    if snapshot is None:
+        return
+    retired = _read(METRICS_DIR / RETIRED_FILE) or {"counters": {}, "folded": {}}
+    totals = {}
+    _add(totals, retired["counters"])
+    _add(totals, snapshot["counters"])
+    now = time.time()
+    folded = {sid: at for sid, at in retired["folded"].items() if now - at < FOLDED_MEMORY_SECONDS}
+    folded[snapshot["id"]] = now
+    _write(METRICS_DIR / RETIRED_FILE, {"counters": _rows(totals), "folded": folded})
+    path.unlink()
+
+
+def collect():
+    """
+    Returns (counters, gauges) added up over every worker sharing
+    METRICS_DIR (or just this process): counters as
+    name -> labels -> value, gauges as name -> value.
+    """
+    own = _snapshot()
+    totals = {}
+    _add(totals, own["counters"])
+    gauges = dict(own["gauges"])
+    if METRICS_DIR is None:
+        return totals, gauges
+
+    # Worker files first, then retired.json (see fold_worker)
+    others = []
+    for path in METRICS_DIR.glob("worker-*.json"):
+        snapshot = _read(path)
+        if snapshot is not None and snapshot["id"] != own["id"]:
+            others.append(snapshot)
+    retired = _read(METRICS_DIR / RETIRED_FILE) or {"counters": {}, "folded": {}}
+    _add(totals, retired["counters"])
+    for snapshot in others:
+        if snapshot["id"] in retired["folded"]:
+            continue
+        _add(totals, snapshot["counters"])
+        for name, value in snapshot["gauges"].items():
+            gauges[name] = gauges.get(name, 0) + value
+    return totals, gauges
+
+
+# EXPOSITION <<<<<<<<<<
+def _number(value):
+    if isinstance(value, float):
+        return "+Inf" if value == float("inf") else repr(value)
+    return str(value)
+
+
+def _label_text(names, values, extra=""):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def render(counters, gauges):
+    """
+    The Prometheus text format for collect()'s result.
+    """
+    lines = []
+    for family in _families.values():
+        lines.append(f"# HELP {family.name} {family.help}")
+        lines.append(f"# TYPE {family.name} {family.kind}")
+        if family.kind == "gauge":
+            lines.append(f"{family.name} {_number(gauges.get(family.name, 0))}")
+            continue
+        for labels, value in sorted(counters.get(family.name, {}).items()):
+            if family.kind == "counter":
+                lines.append(f"{family.name}{_label_text(family.labels, labels)} {_number(value)}")
+                continue
+            if len(value) != len(family.buckets) + 2:
+                continue
+            cumulative = 0
+            for bound, count in zip(family.buckets + (float("inf"),), value):
+                cumulative += count
+                le = f'le="{_number(float(bound))}"'
+                lines.append(f"{family.name}_bucket{_label_text(family.labels, labels, le)} {cumulative}")
+            lines.append(f"{family.name}_sum{_label_text(family.labels, labels)} {_number(value[-1])}")
+            lines.append(f"{family.name}_count{_label_text(family.labels, labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+def _metrics_view():
+    if TOKEN:
+        allowed = hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {TOKEN}")
+    else:
+        allowed = request.remote_addr in ("127.0.0.1", "::1")
+    if not allowed:
+        return Response("Forbidden\n", status=403, mimetype="text/plain")
+    return Response(render(*collect()), content_type=CONTENT_TYPE)
+
+
+def init_app(app):
+    """
+    Instruments the app and adds GET /metrics. Call it before the
+    other init_app()s so its hook runs first. Does nothing when
+    EE_METRICS=off.
+    """
+    global _worker_id, _flusher
+    if not ENABLED:
+        return
+    db.connection_class = TimedConnection
+    app.wsgi_app = _Instrument(app.wsgi_app)
+    app.before_request(_note_endpoint)
+    app.add_url_rule("/metrics", "metrics", _metrics_view)
+
+    # Set here, after serve.py's fork, so every worker has its own
+    if _worker_id is None:
+        _worker_id = f"{os.getpid()}-{time.time_ns()}"
+    if METRICS_DIR is not None and _flusher is None:
+        _flusher = threading.Thread(target=_flush_forever, name="metrics-flush", daemon=True)
+        _flusher.start()
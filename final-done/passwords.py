@@ -0,0 +1,134 @@
+"""
+passwords.py
+Password hashing for User_T:
+- scrypt (memory-hard, in the standard library) with tunable cost
+- every hash / verify runs on a small bounded thread pool, and at most
+  MAX_PENDING_HASHES can be queued or running, so a login storm can't
+  tie up every request thread burning CPU
+- legacy plaintext passwords still verify and are flagged for rehash,
+  so old rows upgrade themselves on the user's next login
+
+Stored format:  scrypt$<n>$<r>$<p>$<salt b64>$<hash b64>
+
+Tuning (environment):
+- EE_SCRYPT_N / EE_SCRYPT_R / EE_SCRYPT_P   cost parameters (2**14 / 8 / 1)
+- EE_HASH_WORKERS   hashes computed at once (default: CPU count, max 4)
+"""
+
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+PREFIX = "scrypt"
+SCRYPT_N = int(os.environ.get("EE_SCRYPT_N", 2 ** 14))
+SCRYPT_R = int(os.environ.get("EE_SCRYPT_R", 8))
+SCRYPT_P = int(os.environ.get("EE_SCRYPT_P", 1))
+SALT_BYTES = 16
+HASH_BYTES = 32
+
+HASH_WORKERS = int(os.environ.get("EE_HASH_WORKERS", min(4, os.cpu_count() or 1)))
+MAX_PENDING_HASHES = HASH_WORKERS * 4  # running + waiting for a worker
+SLOT_WAIT_SECONDS = 5                  # how long a request waits to get in line
+
+_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="password")
+_slots = threading.BoundedSemaphore(MAX_PENDING_HASHES)
+
+
+class PasswordBusy(Exception):
+    """Too many hashes already pending; the caller should ask the user to retry."""
+
+
+def _b64(raw):
+    return base64.b64encode(raw).decode("ascii")
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(
+        password.encode("utf-8"),
+        salt=salt,
+        n=n,
+        r=r,
+        p=p,
+        maxmem=132 * n * r * p + 1024 * 1024,
+        dklen=HASH_BYTES,
+    )
+
+
+def _on_pool(func, *args):
+    """
+    Runs func(*args) on the hashing pool and waits for the answer.
+    Raises PasswordBusy if the queue is already full.
+    """
+    if not _slots.acquire(timeout=SLOT_WAIT_SECONDS):
+        metrics.POOL_REJECTED.inc("password")
+        raise PasswordBusy("Too many sign-ins right now. Please try again in a moment.")
+    try:
+        return _executor.submit(func, *args).result()
+    finally:
+        _slots.release()
+
+
+def _hash_now(password):
+    salt = secrets.token_bytes(SALT_BYTES)
+    digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f"{PREFIX}${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64(salt)}${_b64(digest)}"
+
+
+def _verify_now(stored, candidate):
+    try:
+        _, n, r, p, salt, digest = stored.split("$")
+        n, r, p = int(n), int(r), int(p)
+        expected = base64.b64decode(digest, validate=True)
+        actual = _scrypt(candidate, base64.b64decode(salt, validate=True), n, r, p)
+    except ValueError:
+        # Truncated or corrupt hash (missing fields, bad base64, or
+        # cost parameters scrypt rejects): a failed login, not a 500
+        return False, False
+    ok = hmac.compare_digest(actual, expected)
+    outdated = (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return ok, ok and outdated
+
+
+def is_hashed(stored):
+    return stored.startswith(PREFIX + "$")
+
+
+def hash_password(password):
+    """
+    Returns the string to store in User_T.Password.
+    """
+    return _on_pool(_hash_now, password)
+
+
+def hash_passwords(passwords, workers=HASH_WORKERS):
+    """
+    Hashes a batch of passwords for bulk imports (not for request
+    paths: it bypasses the request pool's queue limit). Runs on its
+    own `workers` threads, since scrypt releases the GIL, and returns
+    the hashes in input order.
+    """
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-bulk") as pool:
+        return list(pool.map(_hash_now, passwords))
+
+
+def verify_password(stored, candidate):
+    """
+    Checks a login attempt against the stored password.
+    Returns (ok, needs_rehash). needs_rehash is True when the stored
+    value is legacy plaintext or was hashed with older cost settings.
+    """
+    if not stored:
+        return False, False
+
+    if not is_hashed(stored):
+        # Legacy plaintext row: compare in constant time, then upgrade
+        ok = hmac.compare_digest(stored.encode("utf-8"), candidate.encode("utf-8"))
+        return ok, ok
+
+    return _on_pool(_verify_now, stored, candidate)
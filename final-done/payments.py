@@ -0,0 +1,260 @@
+"""
+payments.py
+Handles:
+- The payment-provider interface (PaymentProvider)
+- A local stub provider with configurable latency / error rates
+- Running authorizations on a bounded worker pool with a strict timeout
+- A circuit breaker that fails fast while the provider is degraded
+
+Configured from the environment:
+- EE_PAYMENT_PROVIDER    (default "stub")
+- EE_PAYMENT_TIMEOUT     seconds to wait for an authorization (default 5)
+- EE_PAYMENT_WORKERS     authorizations in flight at once (default 8)
+- EE_PAYMENT_LATENCY     stub: seconds per call (default 0)
+- EE_PAYMENT_ERROR_RATE  stub: 0..1 chance a call errors (default 0)
+"""
+
+import os
+import random
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import metrics
+
+
+# ERRORS <<<<<<<<<<
+class PaymentError(Exception):
+    """
+    Base class for anything that stops a payment.
+    str(error) is safe to show the customer.
+    """
+
+
+class PaymentDeclined(PaymentError):
+    """The provider answered and said no (bad card, etc.)."""
+
+
+class PaymentUnavailable(PaymentError):
+    """We couldn't get an answer: timeout, provider error, circuit open or pool full."""
+
+
+# PROVIDERS <<<<<<<<<<
+class PaymentProvider:
+    """
+    Interface every payment provider implements.
+    authorize() returns an authorization code string,
+    raises PaymentDeclined for a refused card and any
+    other exception for a provider/network failure.
+    """
+
+    name = "base"
+
+    def authorize(self, amount, card_number, exp_date, cvv):
+        raise NotImplementedError
+
+    def void(self, auth_code):
+        """Releases an authorization we ended up not using."""
+        raise NotImplementedError
+
+
+class StubProvider(PaymentProvider):
+    """
+    Local stand-in for a real gateway, for development and load tests.
+    - latency:     seconds every call takes (plus up to `jitter` more)
+    - error_rate:  chance (0..1) a call raises a provider error
+    - decline_rate: chance (0..1) a call is declined
+    Card numbers ending in 0000 are always declined.
+    """
+
+    name = "stub"
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, decline_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.decline_rate = decline_rate
+
+    def authorize(self, amount, card_number, exp_date, cvv):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+        if random.random() < self.error_rate:
+            raise ConnectionError("stub provider error")
+
+        digits = card_number.replace(" ", "")
+        if digits.endswith("0000") or random.random() < self.decline_rate:
+            raise PaymentDeclined("Your card was declined.")
+
+        return f"stub-{secrets.token_hex(8)}"
+
+    def void(self, auth_code):
+        pass
+
+
+PROVIDERS = {
+    "stub": StubProvider,
+}
+
+
+# CIRCUIT BREAKER <<<<<<<<<<
+class CircuitBreaker:
+    """
+    Classic three-state breaker:
+    - closed:    calls go through; `failure_threshold` failures in a row opens it
+    - open:      calls fail immediately for `reset_timeout` seconds
+    - half-open: one trial call; success closes it, failure re-opens it
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half-open"
+                self._trial_running = False
+            if self.state == "half-open" and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def cancel_trial(self):
+        """
+        Gives back a half-open trial that never reached the provider
+        (no free slot), so the next call can make the trial instead.
+        """
+        with self._lock:
+            self._trial_running = False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half-open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self._trial_running = False
+
+
+# GATEWAY <<<<<<<<<<
+class PaymentGateway:
+    """
+    Runs provider.authorize() on its own bounded thread pool so the
+    request thread only ever waits `timeout` seconds. At most
+    `max_workers` calls are in flight; extra requests fail fast
+    instead of queueing behind a slow provider.
+    """
+
+    def __init__(self, provider, timeout=5.0, max_workers=8, breaker=None):
+        self.provider = provider
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="payment")
+        # A timed-out call keeps its slot until the provider really returns
+        self._slots = threading.BoundedSemaphore(max_workers)
+
+    def authorize(self, amount, card_number, exp_date, cvv):
+        if not self.breaker.allow():
+            raise PaymentUnavailable("Payments are temporarily unavailable. Please try again shortly.")
+
+        if not self._slots.acquire(blocking=False):
+            self.breaker.cancel_trial()
+            metrics.POOL_REJECTED.inc("payment")
+            raise PaymentUnavailable("Payments are busy right now. Please try again shortly.")
+
+        try:
+            future = self._executor.submit(
+                self.provider.authorize, amount, card_number, exp_date, cvv
+            )
+        except RuntimeError:
+            self._slots.release()
+            self.breaker.cancel_trial()
+            raise PaymentUnavailable("Payments are temporarily unavailable. Please try again shortly.")
+        future.add_done_callback(lambda f: self._slots.release())
+
+        try:
+            auth_code = future.result(timeout=self.timeout)
+        except FutureTimeout:
+            self.breaker.record_failure()
+            raise PaymentUnavailable("The payment provider timed out. You have not been charged.")
+        except PaymentDeclined:
+            # The provider is healthy, the card just isn't
+            self.breaker.record_success()
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            raise PaymentUnavailable("The payment provider had an error. You have not been charged.")
+
+        self.breaker.record_success()
+        return auth_code
+
+    def void(self, auth_code):
+        """
+        Best-effort release of an authorization (e.g. the potions sold
+        out before the Bill was written). Runs in the background and
+        never raises; the provider expires unused holds anyway.
+        """
+        try:
+            self._executor.submit(self.provider.void, auth_code)
+        except RuntimeError:
+            pass
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway():
+    """
+    Returns the process-wide PaymentGateway, building it from
+    the EE_PAYMENT_* environment variables on first use.
+    """
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                _gateway = build_gateway_from_env()
+    return _gateway
+
+
+def set_gateway(gateway):
+    """
+    Swaps in a different gateway (load tests, a real provider).
+    """
+    global _gateway
+    _gateway = gateway
+
+
+def build_gateway_from_env():
+    name = os.environ.get("EE_PAYMENT_PROVIDER", "stub")
+    provider_cls = PROVIDERS[name]
+
+    if provider_cls is StubProvider:
+        provider = StubProvider(
+            latency=float(os.environ.get("EE_PAYMENT_LATENCY", "0")),
+            error_rate=float(os.environ.get("EE_PAYMENT_ERROR_RATE", "0")),
+        )
+    else:
+        provider = provider_cls()
+
+    return PaymentGateway(
+        provider,
+        timeout=float(os.environ.get("EE_PAYMENT_TIMEOUT", "5")),
+        max_workers=int(os.environ.get("EE_PAYMENT_WORKERS", "8")),
+    )
@@ -0,0 +1,318 @@
+"""
+ratelimit.py
+Keeps abusive or expensive traffic from starving the worker pool:
+- Token-bucket rate limits per route, keyed by client IP and by user
+  (logged-in UserID, or the username being tried on /login)
+- Admission control: requests are counted in flight per priority
+  class, and lower classes are shed with a fast 503 once the process
+  is busy, so checkout keeps going while reports and searches wait
+
+Budgets live in RULES (endpoint -> Rule). Bucket state is kept:
+- in process memory (default; each worker has its own buckets), or
+- in a small shared SQLite file next to the main DB
+  (EE_RATELIMIT_BACKEND=sqlite) so all workers on a host share them
+
+Configured from the environment:
+- EE_RATELIMIT            on | off                  (default on)
+- EE_RATELIMIT_BACKEND    memory | sqlite           (default memory)
+- EE_MAX_INFLIGHT         requests in flight per process before shedding (default 64;
+                          serve.py sets it to --threads, see set_max_inflight)
+"""
+
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from pathlib import Path
+
+from flask import Response, g, request, session
+
+import db
+import metrics
+from db import BUSY_TIMEOUT_SECONDS
+
+ENABLED = os.environ.get("EE_RATELIMIT", "on") != "off"
+MAX_INFLIGHT = int(os.environ.get("EE_MAX_INFLIGHT", "64"))
+MEMORY_MAX_BUCKETS = 100_000
+SHARED_DB_NAME = "ratelimit.db"  # next to the main database
+
+
+# RULES <<<<<<<<<<
+# per_minute: steady refill rate, burst: bucket size.
+Budget = namedtuple("Budget", "per_minute burst")
+
+
+class Rule:
+    """
+    Rate limit for one endpoint.
+    - methods: only these HTTP methods are counted
+    - when:    optional predicate(request); the rule only applies if it's true
+    - per_ip / per_user: Budget for each key (None = not limited that way)
+    - user_field: form field to key on when nobody is logged in
+      (e.g. the username being tried on /login)
+    """
+
+    def __init__(self, methods=("GET", "POST"), when=None, per_ip=None, per_user=None, user_field=None):
+        self.methods = methods
+        self.when = when
+        self.per_ip = per_ip
+        self.per_user = per_user
+        self.user_field = user_field
+
+
+RULES = {
+    "auth.login": Rule(
+        methods=("POST",),
+        per_ip=Budget(per_minute=10, burst=10),
+        per_user=Budget(per_minute=5, burst=5),
+        user_field="username",
+    ),
+    "auth.register": Rule(methods=("POST",), per_ip=Budget(per_minute=5, burst=5)),
+    "auth.check_username": Rule(per_ip=Budget(per_minute=60, burst=20)),
+    "shop.shop_home": Rule(
+        when=lambda req: bool(req.args.get("q", "").strip()),
+        per_ip=Budget(per_minute=60, burst=20),
+        per_user=Budget(per_minute=60, burst=20),
+    ),
+    "admin.sales_report_export_csv": Rule(
+        per_ip=Budget(per_minute=6, burst=3),
+        per_user=Budget(per_minute=6, burst=3),
+    ),
+    "admin.reports_start": Rule(methods=("POST",), per_user=Budget(per_minute=6, burst=3)),
+}
+
+# Admission classes: a class is shed once total in-flight requests
+# reach its share of MAX_INFLIGHT. Anything not listed is "normal".
+PRIORITY_SHARE = {"critical": 1.0, "normal": 0.9, "bulk": 0.5}
+PRIORITIES = {
+    "checkout.checkout": "critical",
+    "checkout.process_payment": "critical",
+    "checkout.confirmation": "critical",
+    "admin.sales_report": "bulk",
+    "admin.sales_report_export_csv": "bulk",
+    "admin.report_download": "bulk",
+    "shop.shop_home": "normal",
+}
+
+# Not counted as in flight: long-lived streams, held open for minutes
+# (events.py caps how many a process serves), and the metrics scrape,
+# which must still answer while the shop is shedding load
+UNCOUNTED = {"admin.dashboard_events", "metrics"}
+
+
+# BUCKET BACKENDS <<<<<<<<<<
+class MemoryBuckets:
+    """
+    Per-process buckets in a bounded LRU (idle keys fall out first;
+    a key that falls out simply starts again with a full bucket).
+    """
+
+    def __init__(self, max_buckets=MEMORY_MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()  # key -> (tokens, updated_at)
+        self._lock = threading.Lock()
+
+    def take(self, key, budget, now=None):
+        """
+        Takes one token. Returns 0 if allowed, otherwise the
+        seconds until a token will be available.
+        """
+        now = time.monotonic() if now is None else now
+        rate = budget.per_minute / 60.0
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (budget.burst, now))
+            tokens = min(budget.burst, tokens + (now - updated_at) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                self._buckets.move_to_end(key)
+                while len(self._buckets) > self.max_buckets:
+                    self._buckets.popitem(last=False)
+                return 0
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            return (1 - tokens) / rate
+
+
+class SQLiteBuckets:
+    """
+    Buckets shared by every worker on the host, in their own SQLite
+    file (so limiter writes never queue behind checkout's write lock).
+    Each take is a single atomic upsert.
+    """
+
+    def __init__(self, path=None):
+        self.path = str(path or Path(db.DB_PATH).with_name(SHARED_DB_NAME))
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS Bucket_T (
+                BucketKey  TEXT  PRIMARY KEY,
+                Tokens     REAL  NOT NULL,
+                UpdatedAt  REAL  NOT NULL
+            )
+            """
+        )
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_SECONDS, isolation_level=None)
+            conn.execute("PRAGMA synchronous = NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, budget, now=None):
+        now = time.time() if now is None else now
+        rate = budget.per_minute / 60.0
+        conn = self._conn()
+        # Refill + take in one statement; no row back means "not enough tokens"
+        row = conn.execute(
+            """
+            INSERT INTO Bucket_T (BucketKey, Tokens, UpdatedAt) VALUES (?, ? - 1, ?)
+            ON CONFLICT(BucketKey) DO UPDATE
+            SET Tokens = MIN(?, Tokens + (excluded.UpdatedAt - UpdatedAt) * ?) - 1,
+                UpdatedAt = excluded.UpdatedAt
+            WHERE MIN(?, Tokens + (excluded.UpdatedAt - UpdatedAt) * ?) >= 1
+            RETURNING Tokens
+            """,
+            (key, budget.burst, now, budget.burst, rate, budget.burst, rate),
+        ).fetchone()
+        if row is not None:
+            return 0
+
+        row = conn.execute("SELECT Tokens, UpdatedAt FROM Bucket_T WHERE BucketKey = ?", (key,)).fetchone()
+        tokens = min(budget.burst, row[0] + (now - row[1]) * rate) if row else budget.burst
+        return max(0.0, (1 - tokens) / rate)
+
+
+def buckets_from_env(db_path=None):
+    if os.environ.get("EE_RATELIMIT_BACKEND", "memory") == "sqlite":
+        return SQLiteBuckets(db_path and Path(db_path).with_name(SHARED_DB_NAME))
+    return MemoryBuckets()
+
+
+# ADMISSION CONTROL <<<<<<<<<<
+class Admission:
+    """
+    Counts requests in flight in this process and decides whether
+    one more of a given priority may start.
+    """
+
+    def __init__(self, max_inflight=MAX_INFLIGHT):
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self.shed = 0
+        self._lock = threading.Lock()
+
+    def enter(self, priority):
+        limit = max(1, int(self.max_inflight * PRIORITY_SHARE[priority]))
+        with self._lock:
+            if self.inflight >= limit:
+                self.shed += 1
+                metrics.POOL_REJECTED.inc("admission")
+                return False
+            self.inflight += 1
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.inflight -= 1
+
+
+# FLASK HOOKS <<<<<<<<<<
+_buckets = None
+_admission = Admission()
+
+
+def _client_ip():
+    return request.remote_addr or "unknown"
+
+
+def _too_many(retry_after):
+    return Response(
+        "Too many requests. Please slow down and try again shortly.\n",
+        status=429,
+        mimetype="text/plain",
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+def _check_rate_limit():
+    rule = RULES.get(request.endpoint)
+    if rule is None or request.method not in rule.methods:
+        return None
+    if rule.when is not None and not rule.when(request):
+        return None
+
+    waits = []
+    if rule.per_ip:
+        waits.append(_buckets.take(f"{request.endpoint}:ip:{_client_ip()}", rule.per_ip))
+    if rule.per_user:
+        user = session.get("user_id")
+        if user is None and rule.user_field:
+            user = request.form.get(rule.user_field, "").strip().lower() or None
+        if user is not None:
+            waits.append(_buckets.take(f"{request.endpoint}:user:{user}", rule.per_user))
+
+    retry_after = max(waits, default=0)
+    return _too_many(retry_after) if retry_after else None
+
+
+def _before_request():
+    if request.endpoint in (None, "static"):
+        return None
+
+    limited = _check_rate_limit()
+    if limited is not None:
+        return limited
+
+    if request.endpoint in UNCOUNTED:
+        return None
+    if not _admission.enter(PRIORITIES.get(request.endpoint, "normal")):
+        return Response(
+            "The shop is very busy right now. Please try again in a moment.\n",
+            status=503,
+            mimetype="text/plain",
+            headers={"Retry-After": "2"},
+        )
+    g.admitted = True
+    return None
+
+
+def _teardown_request(exc):
+    if g.pop("admitted", False):
+        _admission.leave()
+
+
+def init_app(app, buckets=None):
+    """
+    Installs the rate limiter and admission control on the app.
+    Does nothing when EE_RATELIMIT=off (load tests).
+    """
+    global _buckets
+    if not ENABLED:
+        return
+    _buckets = buckets or buckets_from_env(app.config.get("DATABASE"))
+    app.before_request(_before_request)
+    app.teardown_request(_teardown_request)
+
+
+def set_max_inflight(limit):
+    """
+    Sizes admission control to the server's request threads. A server
+    never runs more requests at once than it has threads, so with a
+    higher limit nothing would ever be shed: overload would just queue
+    in the accept backlog, checkout included.
+    """
+    _admission.max_inflight = limit
+
+
+def stats():
+    """
+    In-flight / shed counters for this process.
+    """
+    return {"inflight": _admission.inflight, "shed": _admission.shed, "max_inflight": _admission.max_inflight}
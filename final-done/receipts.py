@@ -0,0 +1,192 @@
+"""
+receipts.py
+Rendered order receipts (the confirmation page).
+A Bill never changes once written, so each receipt is rendered once:
+- right after checkout by the order_placed job, or on first view
+- kept in a bounded in-memory LRU and on disk under receipts/ next
+  to the app's database, both per database, so two apps (or a test
+  database) never serve each other's receipts for the same BillID
+- file names carry the owner's UserID, so serving a stored copy
+  still only works for the user who placed the order
+
+Variants:
+- "html"  -> the normal confirmation page
+- "print" -> printer-friendly version (no buttons, opens print dialog)
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from flask import render_template
+
+import metrics
+from db import get_connection, database_path
+
+RECEIPT_DIR = os.environ.get("EE_RECEIPT_DIR")  # default: receipts/ beside the DATABASE
+MEMORY_CACHE_SIZE = 512  # receipts kept in memory per process
+VARIANTS = ("html", "print")
+
+# (database path, bill_id, variant) -> (user_id, html), most recently used last
+_memory = OrderedDict()
+_memory_lock = threading.Lock()
+
+
+def receipt_dir():
+    """
+    EE_RECEIPT_DIR if set, else receipts/ in the current app's
+    DATABASE directory.
+    """
+    if RECEIPT_DIR:
+        return Path(RECEIPT_DIR)
+    return database_path().parent / "receipts"
+
+
+def _receipt_path(bill_id, user_id, variant):
+    # e.g. receipts/42-7.html and receipts/42-7.print.html
+    suffix = ".html" if variant == "html" else f".{variant}.html"
+    return receipt_dir() / f"{bill_id}-{user_id}{suffix}"
+
+
+def _memory_key(bill_id, variant):
+    return (str(database_path()), bill_id, variant)
+
+
+def _remember(bill_id, user_id, variant, html):
+    key = _memory_key(bill_id, variant)
+    with _memory_lock:
+        _memory[key] = (user_id, html)
+        _memory.move_to_end(key)
+        while len(_memory) > MEMORY_CACHE_SIZE:
+            _memory.popitem(last=False)
+
+
+def render_receipt(bill_id, user_id, variant="html"):
+    """
+    Builds the receipt HTML from the database.
+    Returns None if the bill doesn't exist or isn't this user's.
+    Needs a request context (the template uses url_for).
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+
+    # Get Bill info (the UserID filter is the ownership check)
+    cur.execute(
+        """
+        SELECT
+            b.BillID,
+            b.SalesDate,
+            b.SaleTime,
+            b.SubTotal,
+            b.SalesTax,
+            b.ShippingCost,
+            b.Total,
+            b.Street,
+            b.City,
+            b.State,
+            b.Zip,
+            s.ShippingType
+        FROM Bill_T b
+        LEFT JOIN Shipping_T s ON b.ShippingID = s.ShippingID
+        WHERE b.BillID = ? AND b.UserID = ?
+        """,
+        (bill_id, user_id),
+    )
+    bill = cur.fetchone()
+
+    if bill is None:
+        conn.close()
+        return None
+
+    # Get items for the bill
+    cur.execute(
+        """
+        SELECT
+            i.PotionName,
+            i.PotionDescription,
+            i.PotionCost
+        FROM BillInventoryItem_T bi
+        JOIN Inventory_T i ON bi.ItemID = i.ItemID
+        WHERE bi.BillID = ?
+        """,
+        (bill_id,),
+    )
+    item_rows = cur.fetchall()
+    conn.close()
+
+    items = [
+        {
+            "name": row["PotionName"],
+            "description": row["PotionDescription"],
+            "price": float(row["PotionCost"]),
+        }
+        for row in item_rows
+    ]
+
+    return render_template(
+        "confirmation.html",
+        bill=bill,
+        items=items,
+        printable=(variant == "print"),
+    )
+
+
+def store_receipt(bill_id, user_id, variant, html):
+    """
+    Saves a rendered receipt to disk (atomic rename) and memory.
+    """
+    path = _receipt_path(bill_id, user_id, variant)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp_path.write_text(html, encoding="utf-8")
+    os.replace(tmp_path, path)
+    _remember(bill_id, user_id, variant, html)
+
+
+def generate_receipts(bill_id, user_id):
+    """
+    Renders and stores every variant of a receipt.
+    Called by the order_placed job right after checkout.
+    """
+    for variant in VARIANTS:
+        if _receipt_path(bill_id, user_id, variant).exists():
+            continue
+        html = render_receipt(bill_id, user_id, variant)
+        if html is None:
+            return
+        store_receipt(bill_id, user_id, variant, html)
+
+
+def get_receipt(bill_id, user_id, variant="html"):
+    """
+    Returns the receipt HTML for this user's bill, or None if it
+    isn't theirs. Memory first, then disk, then render + store.
+    A cached copy belonging to someone else falls through to the
+    owner-checked lookups below (which then find nothing).
+    """
+    key = _memory_key(bill_id, variant)
+    with _memory_lock:
+        cached = _memory.get(key)
+        if cached is not None:
+            _memory.move_to_end(key)
+    if cached is not None and cached[0] == user_id:
+        metrics.CACHE_REQUESTS.inc("receipts", "hit")
+        return cached[1]
+
+    path = _receipt_path(bill_id, user_id, variant)
+    try:
+        html = path.read_text(encoding="utf-8")
+    except FileNotFoundError:
+        html = None
+    if html is not None:
+        metrics.CACHE_REQUESTS.inc("receipts", "disk")
+        _remember(bill_id, user_id, variant, html)
+        return html
+
+    # Not generated yet (or not this user's bill): the query checks ownership
+    metrics.CACHE_REQUESTS.inc("receipts", "miss")
+    html = render_receipt(bill_id, user_id, variant)
+    if html is not None:
+        store_receipt(bill_id, user_id, variant, html)
+    return html
@@ -0,0 +1,191 @@
+"""
+refdata.py
+In-memory cache of rarely-changing reference data:
+- shipping options (Shipping_T)
+- tax rate (Setting_T)
+- potion categories (Inventory_T)
+
+Everything is loaded once and served from memory. Each data set has a
+counter in CacheVersion_T; writers bump it with db.bump_cache_version().
+At most once every REFRESH_INTERVAL_SECONDS a background thread compares
+the counters and reloads only what changed, so requests never wait on
+the database (except the very first one if warm() wasn't called).
+"""
+
+import threading
+import time
+
+import click
+from flask import current_app, has_app_context
+from flask.cli import AppGroup
+
+import metrics
+from db import get_connection, bump_cache_version
+
+REFRESH_INTERVAL_SECONDS = 5
+DEFAULT_TAX_RATE = 0.06
+
+_data = {}          # name -> loaded value
+_versions = {}      # name -> version the loaded value came from
+_checked_at = 0.0   # time.monotonic() of the last version check
+_lock = threading.Lock()
+_refreshing = threading.Event()
+
+
+# LOADERS (one per data set) <<<<<<<<<<
+def _load_shipping(cur):
+    cur.execute(
+        """
+        SELECT ShippingID, ShippingType, ShippingCost
+        FROM Shipping_T
+        ORDER BY ShippingID
+        """
+    )
+    return [
+        {
+            "id": row["ShippingID"],
+            "type": row["ShippingType"],
+            "cost": float(row["ShippingCost"]),
+        }
+        for row in cur.fetchall()
+    ]
+
+
+def _load_settings(cur):
+    cur.execute("SELECT SettingKey, SettingValue FROM Setting_T")
+    return {row["SettingKey"]: row["SettingValue"] for row in cur.fetchall()}
+
+
+def _load_catalog(cur):
+    cur.execute(
+        """
+        SELECT DISTINCT PotionCategory
+        FROM Inventory_T
+        WHERE PotionCategory IS NOT NULL AND PotionCategory <> ''
+        ORDER BY PotionCategory
+        """
+    )
+    return {"categories": [row["PotionCategory"] for row in cur.fetchall()]}
+
+
+_LOADERS = {
+    "shipping": _load_shipping,
+    "settings": _load_settings,
+    "catalog": _load_catalog,
+}
+
+
+# REFRESH <<<<<<<<<<
+def _refresh(force=False):
+    """
+    Reloads every data set whose CacheVersion_T counter moved
+    (or all of them when `force` is set).
+    """
+    global _checked_at
+
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT Name, Version FROM CacheVersion_T")
+    versions = {row["Name"]: row["Version"] for row in cur.fetchall()}
+
+    fresh = {}
+    for name, loader in _LOADERS.items():
+        if force or name not in _data or versions.get(name) != _versions.get(name):
+            fresh[name] = loader(cur)
+    conn.close()
+
+    with _lock:
+        for name, value in fresh.items():
+            _data[name] = value
+            _versions[name] = versions.get(name)
+        _checked_at = time.monotonic()
+
+
+def _refresh_in_background(app):
+    try:
+        if app is None:
+            _refresh()
+        else:
+            with app.app_context():  # same database as the request that started it
+                _refresh()
+    finally:
+        _refreshing.clear()
+
+
+def _get(name):
+    """
+    Returns a cached data set. Loads synchronously only on a cold
+    cache; otherwise a stale check is handed to a background thread
+    and the current copy is served immediately.
+    """
+    if name not in _data:
+        metrics.CACHE_REQUESTS.inc("refdata", "miss")
+        _refresh()
+        return _data[name]
+
+    metrics.CACHE_REQUESTS.inc("refdata", "hit")
+    if time.monotonic() - _checked_at > REFRESH_INTERVAL_SECONDS and not _refreshing.is_set():
+        _refreshing.set()
+        app = current_app._get_current_object() if has_app_context() else None
+        threading.Thread(
+            target=_refresh_in_background, args=(app,), name="refdata-refresh", daemon=True
+        ).start()
+    return _data[name]
+
+
+def warm():
+    """
+    Loads everything up front (call at startup so the first
+    request doesn't pay for it).
+    """
+    _refresh(force=True)
+
+
+# PUBLIC LOOKUPS <<<<<<<<<<
+def shipping_options():
+    """
+    All shipping options as dicts with id / type / cost.
+    """
+    return _get("shipping")
+
+
+def get_shipping(shipping_id):
+    """
+    The shipping option with this ShippingID, or None.
+    """
+    return next((s for s in _get("shipping") if s["id"] == shipping_id), None)
+
+
+def tax_rate():
+    """
+    Sales tax rate as a fraction (0.06 = 6%).
+    """
+    return float(_get("settings").get("tax_rate", DEFAULT_TAX_RATE))
+
+
+def categories():
+    """
+    Sorted list of potion categories in the catalog.
+    """
+    return _get("catalog")["categories"]
+
+
+# CLI: flask refdata ... <<<<<<<<<<
+refdata_cli = AppGroup("refdata", help="Manage the reference-data cache.")
+
+
+@refdata_cli.command("bump")
+@click.argument("names", nargs=-1)
+def refdata_bump(names):
+    """
+    Bump cache versions after editing Shipping_T / Setting_T / the
+    catalog by hand, so every worker reloads. Bumps all by default.
+    """
+    names = names or tuple(_LOADERS)
+    conn = get_connection()
+    cur = conn.cursor()
+    for name in names:
+        bump_cache_version(cur, name)
+    conn.commit()
+    conn.close()
+    click.echo("Bumped: " + ", ".join(names))
@@ -0,0 +1,492 @@
+"""
+reports.py
+Admin reports as files:
+- the sales CSV writer (streamed by /admin/sales-report/export)
+- background report jobs: an admin asks for a report, a job worker
+  writes it under reports/ while recording its progress in Report_T,
+  and the admin downloads the finished file later
+- asking again with the same parameters reuses a report that is still
+  being built, or one finished within REPORT_FRESH_MINUTES
+- finished files are deleted after REPORT_RETENTION_HOURS
+  (by the workers after each build, or `flask reports purge`)
+
+Configured from the environment:
+- EE_REPORT_DIR               where report files go (default reports/
+                              next to the app's DATABASE)
+- EE_REPORT_FRESH_MINUTES     reuse window for identical requests (default 15)
+- EE_REPORT_RETENTION_HOURS   how long finished reports are kept (default 24)
+"""
+
+import csv
+import io
+import json
+import os
+import secrets
+import time
+import zlib
+from collections import namedtuple
+from datetime import datetime
+from pathlib import Path
+
+import click
+from flask.cli import AppGroup
+
+from db import get_connection, database_path
+from jobs import enqueue, job_handler
+from stats import sales_rollup, pivot_rollup
+
+REPORT_DIR = os.environ.get("EE_REPORT_DIR")  # default: reports/ beside the DATABASE
+REPORT_FRESH_SECONDS = float(os.environ.get("EE_REPORT_FRESH_MINUTES", "15")) * 60
+REPORT_RETENTION_SECONDS = float(os.environ.get("EE_REPORT_RETENTION_HOURS", "24")) * 3600
+REPORT_MAX_ATTEMPTS = 2
+PROGRESS_INTERVAL_SECONDS = 1.0  # at most one progress write per second per report
+
+# Rows pulled from the cursor per streamed chunk of the CSV export
+EXPORT_FETCH_ROWS = 1000
+
+EXPORT_COLUMNS = [
+    "BillID",
+    "Date",
+    "Time",
+    "Username",
+    "Name",
+    "Items",
+    "ItemCount",
+    "Subtotal",
+    "Tax",
+    "Shipping",
+    "Total",
+]
+
+
+# SALES CSV <<<<<<<<<<
+def sales_filters(args):
+    """
+    Reads the sales filters shared by the report, the export and
+    sales report jobs:
+    - start / end: YYYY-MM-DD, inclusive
+    - user: exact username (case-insensitive)
+    - min_total: only bills with Total >= this
+    Returns (where_sql, params, filters); filters holds the values
+    that were applied, for re-filling the form and building links.
+    Raises ValueError on a malformed date or amount.
+    """
+    clauses = []
+    params = []
+    filters = {}
+
+    for name, op in (("start", ">="), ("end", "<=")):
+        value = args.get(name, "").strip()
+        if value:
+            datetime.strptime(value, "%Y-%m-%d")
+            clauses.append(f"b.SalesDate {op} ?")
+            params.append(value)
+            filters[name] = value
+
+    username = args.get("user", "").strip()
+    if username:
+        clauses.append("b.UserID IN (SELECT UserID FROM User_T WHERE Username = ? COLLATE NOCASE)")
+        params.append(username)
+        filters["user"] = username
+
+    min_total = args.get("min_total", "").strip()
+    if min_total:
+        clauses.append("b.Total >= ?")
+        params.append(float(min_total))
+        filters["min_total"] = min_total
+
+    where_sql = ("WHERE " + " AND ".join(clauses)) if clauses else ""
+    return where_sql, params, filters
+
+
+def sales_csv_chunks(where_sql, params, compress, progress=None):
+    """
+    Generator for the sales CSV: steps the cursor EXPORT_FETCH_ROWS
+    rows at a time and yields each chunk as soon as it's written
+    (gzip-compressed on the fly if asked), so memory stays flat and
+    the download starts right away. Bills come out in
+    idx_bill_date order (no sort), item names per bill via
+    idx_billitem_bill (no GROUP BY over the whole table).
+    progress(rows_written), if given, is called after every chunk.
+    """
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            SELECT
+                b.BillID,
+                b.SalesDate,
+                b.SaleTime,
+                b.SubTotal,
+                b.SalesTax,
+                b.ShippingCost,
+                b.Total,
+                u.Username,
+                u.Name,
+                (SELECT COUNT(*) FROM BillInventoryItem_T bi
+                 WHERE bi.BillID = b.BillID) AS ItemCount,
+                (SELECT COALESCE(GROUP_CONCAT(i.PotionName, ', '), '')
+                 FROM BillInventoryItem_T bi
+                 JOIN Inventory_T i ON bi.ItemID = i.ItemID
+                 WHERE bi.BillID = b.BillID) AS ItemNames
+            FROM Bill_T b
+            JOIN User_T u ON b.UserID = u.UserID
+            {where_sql}
+            ORDER BY b.SalesDate DESC, b.SaleTime DESC, b.BillID DESC
+            """,
+            params,
+        )
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        gzipper = zlib.compressobj(wbits=31) if compress else None  # 31 = gzip container
+        written = 0
+
+        def take_chunk():
+            data = buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+            return gzipper.compress(data) if gzipper else data
+
+        # header
+        writer.writerow(EXPORT_COLUMNS)
+        yield take_chunk()
+
+        while True:
+            rows = cur.fetchmany(EXPORT_FETCH_ROWS)
+            if not rows:
+                break
+            for row in rows:
+                subtotal = float(row["SubTotal"])
+                tax_amount = round(subtotal * float(row["SalesTax"]), 2)
+
+                writer.writerow([
+                    row["BillID"],
+                    row["SalesDate"],
+                    row["SaleTime"],
+                    row["Username"],
+                    row["Name"],
+                    row["ItemNames"],
+                    row["ItemCount"],
+                    subtotal,
+                    tax_amount,
+                    float(row["ShippingCost"]),
+                    float(row["Total"]),
+                ])
+            chunk = take_chunk()
+            if chunk:
+                yield chunk
+            written += len(rows)
+            if progress:
+                progress(written)
+
+        if gzipper:
+            yield gzipper.flush()
+    finally:
+        conn.close()
+
+
+def count_sales(where_sql, params):
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(f"SELECT COUNT(*) FROM Bill_T b {where_sql}", params)
+    total = cur.fetchone()[0]
+    conn.close()
+    return total
+
+
+# ANALYTICS OPTIONS <<<<<<<<<<
+def analytics_options(args):
+    """
+    Reads the analytics page options (period, by, measure, start, end)
+    with their defaults. Raises ValueError with a message for the user
+    on an unknown option or a malformed date.
+    """
+    options = {
+        "period": args.get("period", "week"),
+        "by": args.get("by", "category"),
+        "measure": args.get("measure", "Revenue"),
+        "start": args.get("start", "").strip(),
+        "end": args.get("end", "").strip(),
+    }
+    if options["period"] not in ("day", "week") or options["by"] not in ("category", "state") \
+            or options["measure"] not in ("Revenue", "Orders", "ItemsSold"):
+        raise ValueError("Unknown analytics option.")
+    try:
+        for name in ("start", "end"):
+            if options[name]:
+                datetime.strptime(options[name], "%Y-%m-%d")
+    except ValueError:
+        raise ValueError("Dates must look like YYYY-MM-DD.") from None
+    return options
+
+
+# REPORT KINDS <<<<<<<<<<
+# - label:  shown on the reports page
+# - params: request args -> canonical params dict (raises ValueError)
+# - build:  (params, binary file, progress(done, total)) -> None
+ReportKind = namedtuple("ReportKind", "label params build")
+
+
+def _sales_report_params(args):
+    try:
+        _, _, filters = sales_filters(args)
+    except ValueError:
+        raise ValueError("Dates must look like YYYY-MM-DD and the minimum total must be a number.") from None
+    return dict(filters, gzip=args.get("gzip") == "1")
+
+
+def _build_sales_report(params, out, progress):
+    where_sql, sql_params, _ = sales_filters(params)
+    total = count_sales(where_sql, sql_params)
+    progress(0, total)
+    for chunk in sales_csv_chunks(where_sql, sql_params, params["gzip"], lambda done: progress(done, total)):
+        out.write(chunk)
+
+
+def _build_analytics_report(params, out, progress):
+    rows = sales_rollup(params["period"], params["by"], params["start"] or None, params["end"] or None)
+    progress(0, len(rows))
+    columns, buckets, column_totals = pivot_rollup(rows, params["measure"])
+
+    text = io.TextIOWrapper(out, encoding="utf-8", newline="")
+    writer = csv.writer(text)
+    writer.writerow(["Week of" if params["period"] == "week" else "Date"] + [c or "(none)" for c in columns] + ["Total"])
+    for bucket in buckets:
+        writer.writerow([bucket["start"]] + bucket["values"] + [bucket["total"]])
+    writer.writerow(["Total"] + column_totals + [sum(column_totals)])
+    text.flush()
+    text.detach()
+    progress(len(rows), len(rows))
+
+
+REPORT_KINDS = {
+    "sales": ReportKind("Sales report (CSV)", _sales_report_params, _build_sales_report),
+    "analytics": ReportKind("Sales analytics (CSV)", analytics_options, _build_analytics_report),
+}
+
+
+def report_dir():
+    """
+    EE_REPORT_DIR if set, else reports/ in the current app's
+    DATABASE directory, so each database keeps its own files.
+    """
+    if REPORT_DIR:
+        return Path(REPORT_DIR)
+    return database_path().parent / "reports"
+
+
+def _report_path(report_id, params):
+    return report_dir() / (f"{report_id}.csv.gz" if params.get("gzip") else f"{report_id}.csv")
+
+
+# REQUEST / READ <<<<<<<<<<
+def request_report(kind, args, user_id):
+    """
+    Starts a report, or reuses one: a report with the same kind and
+    params that is queued, running, or finished within the fresh
+    window. Returns (ReportID, reused).
+    Raises KeyError for an unknown kind, ValueError for bad params.
+    """
+    params = json.dumps(REPORT_KINDS[kind].params(args), sort_keys=True)
+    now = time.time()
+
+    conn = get_connection()
+    cur = conn.cursor()
+    # Write lock up front so two admins asking at once get one report
+    cur.execute("BEGIN IMMEDIATE")
+    cur.execute(
+        """
+        SELECT ReportID, Status, FileName
+        FROM Report_T
+        WHERE Kind = ? AND Params = ?
+          AND (Status IN ('queued', 'running') OR (Status = 'done' AND FinishedAt >= ?))
+        ORDER BY CreatedAt DESC
+        LIMIT 1
+        """,
+        (kind, params, now - REPORT_FRESH_SECONDS),
+    )
+    row = cur.fetchone()
+    if row is not None and (row["Status"] != "done" or (report_dir() / row["FileName"]).exists()):
+        conn.rollback()
+        conn.close()
+        return row["ReportID"], True
+
+    cur.execute(
+        """
+        INSERT INTO Report_T (Kind, Params, Status, RequestedBy, CreatedAt)
+        VALUES (?, ?, 'queued', ?, ?)
+        """,
+        (kind, params, user_id, now),
+    )
+    report_id = cur.lastrowid
+    enqueue(cur, "build_report", {"report_id": report_id}, max_attempts=REPORT_MAX_ATTEMPTS)
+    conn.commit()
+    conn.close()
+    return report_id, False
+
+
+def get_report(report_id):
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM Report_T WHERE ReportID = ?", (report_id,))
+    row = cur.fetchone()
+    conn.close()
+    return row
+
+
+def recent_reports(limit=50):
+    """
+    Newest reports first (any admin's), for the reports page.
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(
+        """
+        SELECT r.*, u.Username
+        FROM Report_T r
+        LEFT JOIN User_T u ON u.UserID = r.RequestedBy
+        ORDER BY r.ReportID DESC
+        LIMIT ?
+        """,
+        (limit,),
+    )
+    rows = cur.fetchall()
+    conn.close()
+    return rows
+
+
+def report_file(report):
+    """
+    Path of a finished report's file, or None if it isn't
+    done or has already been purged.
+    """
+    if report is None or report["Status"] != "done":
+        return None
+    path = report_dir() / report["FileName"]
+    return path if path.exists() else None
+
+
+def download_name(report):
+    suffix = Path(report["FileName"]).name.split(".", 1)[1]
+    created = datetime.fromtimestamp(report["CreatedAt"]).strftime("%Y%m%d-%H%M")
+    return f"{report['Kind']}-report-{created}.{suffix}"
+
+
+# BUILD (JOB WORKER) <<<<<<<<<<
+def _update_report(report_id, **columns):
+    conn = get_connection()
+    conn.execute(
+        f"UPDATE Report_T SET {', '.join(f'{name} = ?' for name in columns)} WHERE ReportID = ?",
+        (*columns.values(), report_id),
+    )
+    conn.commit()
+    conn.close()
+
+
+class _ProgressWriter:
+    """
+    progress(done, total) callback for builders: records RowsDone /
+    RowsTotal, at most once per PROGRESS_INTERVAL_SECONDS (each write
+    is its own short transaction).
+    """
+
+    def __init__(self, report_id):
+        self.report_id = report_id
+        self.last_write = 0.0
+
+    def __call__(self, done, total):
+        now = time.monotonic()
+        if done and done < total and now - self.last_write < PROGRESS_INTERVAL_SECONDS:
+            return
+        self.last_write = now
+        _update_report(self.report_id, RowsDone=done, RowsTotal=total)
+
+
+@job_handler("build_report")
+def _build_report(payload):
+    """
+    Builds one report into a temp file, then renames it into place,
+    so a download never sees a half-written file. A failure is
+    recorded on the report and re-raised for the job queue to retry.
+    """
+    report = get_report(payload["report_id"])
+    if report is None:  # purged before a worker got to it
+        return
+    params = json.loads(report["Params"])
+    path = _report_path(report["ReportID"], params)
+
+    _update_report(report["ReportID"], Status="running", RowsDone=0, Error=None)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # unique per attempt, not per process: two worker threads can be
+    # building the same report if its job was re-queued
+    tmp_path = path.with_name(f"{path.name}.{secrets.token_hex(8)}.tmp")
+    try:
+        with open(tmp_path, "wb") as out:
+            REPORT_KINDS[report["Kind"]].build(params, out, _ProgressWriter(report["ReportID"]))
+        os.replace(tmp_path, path)
+    except Exception as exc:
+        tmp_path.unlink(missing_ok=True)
+        _update_report(report["ReportID"], Status="failed", Error=f"{type(exc).__name__}: {exc}",
+                       FinishedAt=time.time(), ExpiresAt=time.time() + REPORT_RETENTION_SECONDS)
+        raise
+
+    finished = time.time()
+    _update_report(
+        report["ReportID"],
+        Status="done",
+        FileName=path.name,
+        FileSize=path.stat().st_size,
+        FinishedAt=finished,
+        ExpiresAt=finished + REPORT_RETENTION_SECONDS,
+    )
+    purge_expired()
+
+
+# RETENTION <<<<<<<<<<
+def purge_expired(now=None):
+    """
+    Deletes reports past their ExpiresAt, files first.
+    Returns how many were removed.
+    """
+    now = time.time() if now is None else now
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT ReportID, FileName FROM Report_T WHERE ExpiresAt < ?", (now,))
+    expired = cur.fetchall()
+    for row in expired:
+        if row["FileName"]:
+            (report_dir() / row["FileName"]).unlink(missing_ok=True)
+    cur.executemany("DELETE FROM Report_T WHERE ReportID = ?", [(row["ReportID"],) for row in expired])
+    conn.commit()
+    conn.close()
+    return len(expired)
+
+
+# CLI: flask reports ... <<<<<<<<<<
+reports_cli = AppGroup("reports", help="Inspect and clean up background reports.")
+
+
+@reports_cli.command("list")
+@click.option("--limit", default=20, show_default=True)
+def reports_list(limit):
+    """List the newest reports."""
+    for row in recent_reports(limit):
+        done = f"{row['RowsDone']}/{row['RowsTotal']}" if row["RowsTotal"] is not None else "-"
+        click.echo(
+            f"#{row['ReportID']} {row['Kind']} {row['Status']} rows={done} "
+            f"params={row['Params']} file={row['FileName'] or '-'} error={row['Error'] or '-'}"
+        )
+
+
+@reports_cli.command("purge")
+@click.option("--all", "purge_all", is_flag=True, help="Delete every finished or failed report.")
+def reports_purge(purge_all):
+    """Delete reports past their retention (default) or all finished ones."""
+    if purge_all:
+        conn = get_connection()
+        conn.execute("UPDATE Report_T SET ExpiresAt = 0 WHERE Status IN ('done', 'failed')")
+        conn.commit()
+        conn.close()
+    click.echo(f"Deleted {purge_expired()} report(s).")
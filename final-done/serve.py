@@ -0,0 +1,615 @@
+"""
+serve.py
+Production entry point: a prefork server with no extra dependencies.
+
+    python serve.py --bind 0.0.0.0:8000 --workers 4 --threads 8
+
+- The master process never imports the app (only db / config, to
+  initialize the database once, and metrics). It binds the port, then forks
+  --workers processes and keeps that many running.
+- Each worker calls create_app() after the fork and runs at most
+  --threads requests at once, over HTTP/1.1 keep-alive. Between
+  requests an idle connection holds no thread: one poller thread
+  watches them all, hands a connection back to the pool when its next
+  request arrives, and closes it after --keepalive idle seconds.
+- A live dashboard stream (/admin/events) stays open for minutes, so
+  it gives its request slot back once it starts streaming and runs on
+  one of --max-streams extra threads (more streams get a 503). So
+  --threads only counts ordinary requests: size it for how many a
+  worker should run at once (ratelimit.py sheds low-priority ones
+  before all of them are busy).
+- All workers accept from the one listening socket the master opened,
+  so a worker that restarts never drops queued connections. It is
+  opened with SO_REUSEPORT where the OS has it (Linux, BSD, macOS), so
+  a new serve.py can bind the port while the old one drains.
+- A worker restarts after --max-requests requests (plus up to
+  --max-requests-jitter, so they don't all restart together), which
+  bounds memory growth. A restart finishes in-flight requests first.
+- /metrics covers every worker: they share a private snapshot
+  directory, and the master keeps the counts of workers that exited
+  (see metrics.py).
+
+Signals (to the master):
+- HUP            graceful reload: start fresh workers (they import the
+                 code on disk now), then retire the old ones
+- TERM / INT     graceful shutdown: stop accepting, finish in-flight
+                 requests for up to --graceful-timeout, then exit
+- TTIN / TTOU    one worker more / less
+
+SQLite with several processes. Every worker opens its own connections
+to the same file, which is safe with these settings:
+- journal_mode=WAL: readers never block the writer or each other.
+  init_db() sets it, and it is stored in the database file. serve.py
+  refuses to start if the database isn't in WAL mode.
+- busy timeout (db.BUSY_TIMEOUT_SECONDS, 10 s): a writer waits for the
+  lock instead of failing with "database is locked". Checkout and
+  other writers take the lock up front with BEGIN IMMEDIATE.
+- No connection is opened before the fork and then reused. The master
+  closes everything it opened, and each worker connects on its own.
+- Keep the database on a local disk. WAL needs shared memory, so it
+  does not work on NFS or other network filesystems.
+- Per-process state needs a shared backend:
+  - EE_SESSION_BACKEND=sqlite (the default) or redis. Not memory.
+  - EE_RATELIMIT_BACKEND=sqlite, so all workers share one budget.
+  - EE_EVENTS_FANOUT=sqlite, so live dashboards see every worker's orders.
+"""
+
+import argparse
+import os
+import random
+import selectors
+import shutil
+import signal
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+from werkzeug.wsgi import LimitedStream
+
+import config
+import db
+import metrics
+
+BACKLOG = 2048
+RESPAWN_DELAY_SECONDS = 1.0  # wait before replacing a worker that died right after starting
+
+
+# WORKER <<<<<<<<<<
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """
+    werkzeug's handler closes the connection after every response.
+    This one keeps HTTP/1.1 connections open: the request body is read
+    to its Content-Length and the response is framed by Content-Length
+    or chunked encoding, so the next request starts at the next byte.
+    Between requests the connection goes back to the server (see
+    PoolWSGIServer), so an idle one doesn't hold a thread.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def handle(self):
+        """
+        Serves this connection's request, and any that follow it
+        already sent (pipelined), then returns; the server keeps the
+        connection open unless close_connection is set.
+        """
+        self.close_connection = True
+        try:
+            self.handle_one_request()
+            while not self.close_connection and self._request_waiting():
+                self.handle_one_request()
+        except (ConnectionError, TimeoutError) as exc:
+            self.close_connection = True
+            self.connection_dropped(exc)
+
+    def _request_waiting(self):
+        """
+        True if bytes of the next request have arrived already (in
+        rfile's buffer or on the socket), without waiting for any.
+        """
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def run_wsgi(self):
+        self.environ = environ = self.make_environ()
+        if environ.get("wsgi.input_terminated") or self.server.stopping:
+            body = None
+            self.close_connection = True  # chunked upload, or worker retiring
+        else:
+            try:
+                length = int(environ.get("CONTENT_LENGTH") or 0)
+            except ValueError:
+                length = 0
+                self.close_connection = True
+            body = environ["wsgi.input"] = LimitedStream(self.rfile, length)
+
+        state = {"status": None, "headers": None, "sent": False, "chunked": False}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and state["sent"]:
+                raise exc_info[1].with_traceback(exc_info[2])
+            state["status"], state["headers"] = status, headers
+            return write
+
+        def send_headers():
+            code, _, reason = state["status"].partition(" ")
+            code = int(code)
+            self.send_response(code, reason)
+            keys = set()
+            for key, value in state["headers"]:
+                self.send_header(key, value)
+                keys.add(key.lower())
+            if not ("content-length" in keys or self.command == "HEAD"
+                    or 100 <= code < 200 or code in (204, 304)):
+                state["chunked"] = True
+                self.send_header("Transfer-Encoding", "chunked")
+            if self.close_connection:
+                self.send_header("Connection", "close")
+            self.end_headers()
+            state["sent"] = True
+            if any(key.lower() == "content-type" and value.startswith("text/event-stream")
+                   for key, value in state["headers"]):
+                self.server.release_slot()  # a stream: don't count it against --threads
+
+        def write(data):
+            if not state["sent"]:
+                send_headers()
+            if not data:
+                return
+            if state["chunked"]:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            else:
+                self.wfile.write(data)
+
+        try:
+            app_iter = self.server.app(environ, start_response)
+            try:
+                for data in app_iter:
+                    write(data)
+                write(b"")
+                if state["chunked"]:
+                    self.wfile.write(b"0\r\n\r\n")
+            finally:
+                if hasattr(app_iter, "close"):
+                    app_iter.close()
+        except (ConnectionError, TimeoutError):
+            self.close_connection = True
+            return
+        except Exception:
+            self.close_connection = True
+            self.log_error("error on request:\n%s", traceback.format_exc())
+            if not state["sent"]:
+                state["status"], state["headers"] = "500 Internal Server Error", [("Content-Length", "0")]
+                send_headers()
+            return
+
+        if body is not None:
+            body.exhaust()  # whatever the app didn't read of this request's body
+
+
+class _IdleConnections(threading.Thread):
+    """
+    Watches keep-alive connections between requests, outside the
+    request pool. A connection whose next request arrives goes back to
+    the server; one idle for `keepalive` seconds is closed.
+    """
+
+    def __init__(self, server, keepalive):
+        super().__init__(name="keepalive", daemon=True)
+        self.server = server
+        self.keepalive = keepalive
+        self.closed = False
+        self._pending = []  # (socket, client_address) parked since the last loop
+        self._lock = threading.Lock()
+        self._selector = selectors.DefaultSelector()
+        self._wakeup, self._waker = socket.socketpair()
+        self._waker.setblocking(False)
+        self._selector.register(self._wakeup, selectors.EVENT_READ)
+
+    def park(self, request, client_address):
+        """
+        Takes an idle connection. Returns False once closed
+        (the caller then closes the connection itself).
+        """
+        with self._lock:
+            if self.closed:
+                return False
+            self._pending.append((request, client_address))
+        self._wake()
+        return True
+
+    def close(self):
+        """
+        Closes every idle connection and stops (a retiring worker:
+        those connections have no request in flight).
+        """
+        with self._lock:
+            self.closed = True
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._waker.send(b"\0")
+        except BlockingIOError:
+            pass  # already full of wakeups
+
+    def run(self):
+        while True:
+            with self._lock:
+                pending, self._pending = self._pending, []
+                closed = self.closed
+            deadline = time.monotonic() + self.keepalive
+            for request, client_address in pending:
+                self._selector.register(request, selectors.EVENT_READ, (client_address, deadline))
+            if closed:
+                break
+
+            parked = [key for key in self._selector.get_map().values() if key.data]
+            timeout = min((key.data[1] for key in parked), default=None)
+            for key, _ in self._selector.select(None if timeout is None else max(0.0, timeout - time.monotonic())):
+                if key.fileobj is self._wakeup:
+                    self._wakeup.recv(4096)
+                    continue
+                self._selector.unregister(key.fileobj)
+                self.server.resume(key.fileobj, key.data[0])
+
+            now = time.monotonic()
+            for key in list(self._selector.get_map().values()):
+                if key.data and key.data[1] <= now:
+                    self._selector.unregister(key.fileobj)
+                    self.server.shutdown_request(key.fileobj)
+
+        for key in list(self._selector.get_map().values()):
+            if key.data:
+                self.server.shutdown_request(key.fileobj)
+        self._selector.close()
+        self._wakeup.close()
+        self._waker.close()
+
+
+class PoolWSGIServer(BaseWSGIServer):
+    """
+    Werkzeug's WSGI server with keep-alive and a fixed number of request
+    slots: at most `threads` requests run at once. When every slot is
+    taken the accept loop waits, so extra connections queue in the
+    kernel instead of piling up in memory. Idle keep-alive connections
+    hold no slot (see _IdleConnections), and neither does a response
+    that calls release_slot() (a dashboard stream): `streams` extra
+    threads serve those.
+    """
+
+    multithread = True
+
+    def __init__(self, sock, app, threads, keepalive, streams=0):
+        handler = type("RequestHandler", (KeepAliveRequestHandler,), {"timeout": keepalive})
+        host, port = sock.getsockname()[:2]
+        super().__init__(host, port, app, handler=handler, fd=sock.fileno())
+        self.socket.setblocking(False)  # every worker polls the same socket; losers of a race move on
+        self.stopping = False
+        self.threads = threads
+        self._pool = ThreadPoolExecutor(threads + streams, thread_name_prefix="request")
+        self._slots = threading.Semaphore(threads)
+        self._holding = threading.local()  # .slot: this pool thread still holds its slot
+        self._idle = _IdleConnections(self, keepalive)
+        self._idle.start()
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        self._pool.submit(self._process_request_thread, request, client_address)
+
+    def resume(self, request, client_address):
+        """
+        Serves the next request on a parked keep-alive connection,
+        once a slot is free (called by _IdleConnections).
+        """
+        while not self._slots.acquire(timeout=1.0):
+            if self.stopping:
+                self.shutdown_request(request)
+                return
+        self._pool.submit(self._process_request_thread, request, client_address)
+
+    def release_slot(self):
+        """
+        Gives the current request's slot back before the response ends.
+        """
+        if getattr(self._holding, "slot", False):
+            self._holding.slot = False
+            self._slots.release()
+
+    def _process_request_thread(self, request, client_address):
+        self._holding.slot = True
+        keep_open = False
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+            keep_open = not handler.close_connection
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.release_slot()
+        if not (keep_open and self._idle.park(request, client_address)):
+            self.shutdown_request(request)
+
+    def drain(self, timeout):
+        """
+        Closes idle keep-alive connections, then waits up to `timeout`
+        seconds for the requests already running to finish.
+        Returns False if some are still running.
+        """
+        self._idle.close()
+        deadline = time.monotonic() + timeout
+        for _ in range(self.threads):
+            if not self._slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+                return False
+        self._pool.shutdown(wait=False)
+        return True
+
+
+class _RequestLimit:
+    """
+    WSGI middleware that asks the server to stop accepting (a graceful
+    worker restart) once `limit` requests have started.
+    """
+
+    def __init__(self, wsgi_app, limit, on_limit):
+        self.wsgi_app = wsgi_app
+        self.limit = limit
+        self.on_limit = on_limit
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        with self._lock:
+            self.count += 1
+            reached = self.count == self.limit
+        if reached:
+            self.on_limit()
+        return self.wsgi_app(environ, start_response)
+
+
+def _listen_socket(host, port, reuse_port):
+    """
+    The one listening socket, created by the master and inherited by
+    every worker. SO_REUSEPORT (where the OS has it) lets a second
+    serve.py bind the same port while this one drains, for swaps of
+    serve.py itself.
+    """
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port and hasattr(socket, "SO_REUSEPORT"):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+def _run_worker(args, listener):
+    """
+    Body of a forked worker process; never returns.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)  # until the server is up
+    signal.signal(signal.SIGINT, signal.SIG_IGN)   # Ctrl+C: the master decides
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGTTIN, signal.SIG_IGN)
+    signal.signal(signal.SIGTTOU, signal.SIG_IGN)
+
+    from app import create_app  # after the fork: fresh code on every reload
+    import events
+    import ratelimit
+
+    app = create_app()
+    server = PoolWSGIServer(listener, app, args.threads, args.keepalive, streams=args.max_streams)
+    # Each open dashboard stream runs on one of the extra stream threads
+    events.broker.max_subscribers = args.max_streams
+    # Shed low-priority requests before every thread is taken
+    ratelimit.set_max_inflight(args.threads)
+
+    def stop(*_):
+        # shutdown() waits for serve_forever to return, so not on its thread
+        server.stopping = True
+        events.broker.close()  # streams never end on their own
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    if args.max_requests:
+        limit = args.max_requests + random.randint(0, args.max_requests_jitter)
+        server.app = _RequestLimit(app, limit, stop)
+
+    server.serve_forever()
+    if not server.drain(args.graceful_timeout):
+        print(f"[serve] worker {os.getpid()}: requests still running after "
+              f"{args.graceful_timeout:.0f}s, exiting anyway", file=sys.stderr)
+
+    from jobs import stop_workers
+    stop_workers()  # let a running job finish instead of waiting out its lock
+    metrics.flush()
+    os._exit(0)
+
+
+# MASTER <<<<<<<<<<
+class Master:
+    """
+    Forks workers, keeps --workers of them alive, and handles
+    reload / resize / shutdown signals. Signal handlers only set
+    flags; the loop in run() acts on them.
+    """
+
+    def __init__(self, args, listener):
+        self.args = args
+        self.listener = listener
+        self.size = args.workers
+        self.generation = 0
+        self.workers = {}  # pid -> (generation, started_at)
+        self.stopping = False
+        self.reload_requested = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _run_worker(self.args, self.listener)
+            except BaseException:
+                traceback.print_exc()
+            os._exit(1)
+        self.workers[pid] = (self.generation, time.monotonic())
+
+    def signal_workers(self, sig, pids=None):
+        for pid in list(self.workers if pids is None else pids):
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def current(self):
+        return [pid for pid, (gen, _) in self.workers.items() if gen == self.generation]
+
+    def reap(self):
+        """
+        Collects exited workers. Returns True if one died right after
+        starting (usually a broken deploy), to slow down respawning.
+        """
+        crashed = False
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            gen, started = self.workers.pop(pid, (None, 0))
+            try:
+                metrics.fold_worker(pid)
+            except OSError as exc:
+                print(f"[serve] could not keep worker {pid}'s metrics: {exc}", file=sys.stderr)
+            if gen == self.generation and time.monotonic() - started < RESPAWN_DELAY_SECONDS:
+                crashed = True
+            if not self.stopping and gen == self.generation:
+                print(f"[serve] worker {pid} exited ({os.waitstatus_to_exitcode(status)})", file=sys.stderr)
+        return crashed
+
+    def install_signals(self):
+        def on_stop(*_):
+            self.stopping = True
+
+        def on_reload(*_):
+            self.reload_requested = True
+
+        def on_more(*_):
+            self.size += 1
+
+        def on_fewer(*_):
+            self.size = max(1, self.size - 1)
+
+        signal.signal(signal.SIGTERM, on_stop)
+        signal.signal(signal.SIGINT, on_stop)
+        signal.signal(signal.SIGHUP, on_reload)
+        signal.signal(signal.SIGTTIN, on_more)
+        signal.signal(signal.SIGTTOU, on_fewer)
+
+    def run(self):
+        self.install_signals()
+        print(f"[serve] master {os.getpid()} on {self.args.host}:{self.args.port} "
+              f"workers={self.size} threads={self.args.threads}", file=sys.stderr)
+
+        while not self.stopping:
+            if self.reload_requested:
+                self.reload_requested = False
+                old = self.current()
+                self.generation += 1
+                for _ in range(self.size):
+                    self.spawn()
+                self.signal_workers(signal.SIGTERM, old)
+                print(f"[serve] reloading: {len(old)} old worker(s) retiring", file=sys.stderr)
+
+            if self.reap():
+                time.sleep(RESPAWN_DELAY_SECONDS)
+
+            current = self.current()
+            for _ in range(self.size - len(current)):
+                self.spawn()
+            if len(current) > self.size:
+                self.signal_workers(signal.SIGTERM, current[self.size:])
+
+            time.sleep(0.2)
+
+        self.shutdown()
+
+    def shutdown(self):
+        print("[serve] shutting down", file=sys.stderr)
+        self.signal_workers(signal.SIGTERM)
+        deadline = time.monotonic() + self.args.graceful_timeout
+        while self.workers and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        self.signal_workers(signal.SIGKILL)
+        while self.workers:
+            pid, _ = os.waitpid(-1, 0)
+            self.workers.pop(pid, None)
+
+
+def _check_database():
+    """
+    Creates / upgrades the schema once, before any worker starts,
+    and makes sure the file is in WAL mode (see the module docstring).
+    """
+    db.configure(config.from_env()["DATABASE"])
+    try:
+        db.init_db()
+    except db.SchemaUpgradeError as exc:
+        sys.exit(str(exc))
+    conn = sqlite3.connect(db.DB_PATH, timeout=db.BUSY_TIMEOUT_SECONDS)
+    journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    conn.close()
+    if journal_mode.lower() != "wal":
+        sys.exit(f"{db.DB_PATH} is in {journal_mode} mode; multi-process serving needs WAL")
+    if os.environ.get("EE_SESSION_BACKEND") == "memory":
+        print("[serve] warning: EE_SESSION_BACKEND=memory keeps sessions per worker; "
+              "use sqlite or redis", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    parser.add_argument("--bind", default=os.environ.get("EE_BIND", "127.0.0.1:8000"), help="host:port")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("EE_WORKERS", os.cpu_count() or 1)))
+    parser.add_argument("--threads", type=int, default=int(os.environ.get("EE_THREADS", "8")),
+                        help="request threads per worker")
+    parser.add_argument("--keepalive", type=float, default=5.0, help="idle keep-alive seconds")
+    parser.add_argument("--max-streams", type=int, default=int(os.environ.get("EE_MAX_STREAMS", "16")),
+                        help="live dashboard streams per worker, on threads of their own")
+    parser.add_argument("--max-requests", type=int, default=int(os.environ.get("EE_MAX_REQUESTS", "10000")),
+                        help="restart a worker after this many requests (0 = never)")
+    parser.add_argument("--max-requests-jitter", type=int, default=500)
+    parser.add_argument("--graceful-timeout", type=float, default=30.0,
+                        help="seconds in-flight requests get on shutdown")
+    parser.add_argument("--no-reuse-port", action="store_true", help="don't set SO_REUSEPORT on the socket")
+    args = parser.parse_args()
+
+    host, _, port = args.bind.rpartition(":")
+    args.host, args.port = host.strip("[]") or "127.0.0.1", int(port)
+
+    _check_database()
+    metrics_dir = tempfile.mkdtemp(prefix="ee-metrics-")
+    metrics.configure(metrics_dir)
+
+    listener = _listen_socket(args.host, args.port, reuse_port=not args.no_reuse_port)
+    listener.listen(BACKLOG)
+    if args.port == 0:
+        args.port = listener.getsockname()[1]
+
+    Master(args, listener).run()
+    listener.close()
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
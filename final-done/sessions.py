@@ -0,0 +1,394 @@
+"""
+sessions.py
+Server-side sessions for Flask.
+The cookie only carries a random session id; everything else
+(user_id, user_type, flash messages, the cached User_T row) lives
+in a pluggable backend:
+- MemoryBackend  per-process LRU (single worker / development)
+- SQLiteBackend  Session_T table (default, shared by all workers)
+- RedisBackend   any Redis-protocol server (redis-server or a stand-in)
+
+Sessions are only written back when they change, and sessions for a
+user (or all sessions) can be revoked in bulk.
+
+Configured from the environment:
+- EE_SESSION_BACKEND   memory | sqlite | redis   (default sqlite)
+- EE_SESSION_REDIS     host:port                 (default 127.0.0.1:6379)
+- EE_SESSION_DAYS      session lifetime in days  (default 7)
+"""
+
+import os
+import secrets
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+import click
+from flask.cli import AppGroup
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from db import get_connection
+
+SESSION_LIFETIME_SECONDS = int(os.environ.get("EE_SESSION_DAYS", "7")) * 24 * 3600
+MEMORY_MAX_SESSIONS = 10_000
+
+_serializer = TaggedJSONSerializer()  # same format Flask uses for cookie sessions
+
+
+# SESSION OBJECT <<<<<<<<<<
+class ServerSession(CallbackDict, SessionMixin):
+    """
+    Dict-like session that remembers whether it was changed,
+    so unchanged sessions are never written back.
+    """
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.rotated_from = None
+        self.touched = False
+
+    def rotate(self):
+        """
+        Give this session a brand-new id (call on login to prevent
+        session fixation). The old id is deleted when the response is saved.
+        """
+        if self.rotated_from is None:
+            self.rotated_from = self.sid
+        self.sid = _new_sid()
+        self.modified = True
+
+
+def _new_sid():
+    return secrets.token_urlsafe(32)
+
+
+# BACKENDS <<<<<<<<<<
+class MemoryBackend:
+    """
+    In-process LRU of sessions. Fast, but each worker process has
+    its own copy, so only use it with a single worker.
+    """
+
+    def __init__(self, max_sessions=MEMORY_MAX_SESSIONS):
+        self.max_sessions = max_sessions
+        self._data = OrderedDict()  # sid -> (expires_at, user_id, payload)
+        self._lock = threading.Lock()
+
+    def load(self, sid):
+        with self._lock:
+            entry = self._data.get(sid)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self._data[sid]
+                return None
+            self._data.move_to_end(sid)
+            return entry[0], entry[2]
+
+    def save(self, sid, user_id, payload, expires_at):
+        with self._lock:
+            self._data[sid] = (expires_at, user_id, payload)
+            self._data.move_to_end(sid)
+            while len(self._data) > self.max_sessions:
+                self._data.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._data.pop(sid, None)
+
+    def revoke_user(self, user_id, keep_sid=None):
+        with self._lock:
+            doomed = [
+                sid for sid, (_, uid, _) in self._data.items()
+                if uid == user_id and sid != keep_sid
+            ]
+            for sid in doomed:
+                del self._data[sid]
+        return len(doomed)
+
+    def revoke_all(self):
+        with self._lock:
+            count = len(self._data)
+            self._data.clear()
+        return count
+
+
+class SQLiteBackend:
+    """
+    Sessions in Session_T, indexed by UserID for bulk revocation.
+    Expired rows are swept now and then on save.
+    """
+
+    SWEEP_EVERY_SECONDS = 600
+
+    def __init__(self):
+        self._last_sweep = 0.0
+
+    def load(self, sid):
+        conn = get_connection()
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT Data, ExpiresAt FROM Session_T WHERE SessionID = ? AND ExpiresAt > ?",
+            (sid, time.time()),
+        )
+        row = cur.fetchone()
+        conn.close()
+        if row is None:
+            return None
+        return row["ExpiresAt"], row["Data"]
+
+    def save(self, sid, user_id, payload, expires_at):
+        now = time.time()
+        conn = get_connection()
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO Session_T (SessionID, UserID, Data, ExpiresAt)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(SessionID) DO UPDATE
+            SET UserID = excluded.UserID, Data = excluded.Data, ExpiresAt = excluded.ExpiresAt
+            """,
+            (sid, user_id, payload, expires_at),
+        )
+        if now - self._last_sweep > self.SWEEP_EVERY_SECONDS:
+            self._last_sweep = now
+            cur.execute("DELETE FROM Session_T WHERE ExpiresAt <= ?", (now,))
+        conn.commit()
+        conn.close()
+
+    def delete(self, sid):
+        conn = get_connection()
+        conn.execute("DELETE FROM Session_T WHERE SessionID = ?", (sid,))
+        conn.commit()
+        conn.close()
+
+    def revoke_user(self, user_id, keep_sid=None):
+        conn = get_connection()
+        cur = conn.execute(
+            "DELETE FROM Session_T WHERE UserID = ? AND SessionID IS NOT ?",
+            (user_id, keep_sid),
+        )
+        count = cur.rowcount
+        conn.commit()
+        conn.close()
+        return count
+
+    def revoke_all(self):
+        conn = get_connection()
+        cur = conn.execute("DELETE FROM Session_T")
+        count = cur.rowcount
+        conn.commit()
+        conn.close()
+        return count
+
+
+class RedisBackend:
+    """
+    Sessions in any server that speaks the Redis protocol (RESP).
+    Keys: ee:sess:<sid> (string with TTL) and ee:user:<id>:sess (set of sids).
+    Uses one small connection per thread; no client library needed.
+    """
+
+    PREFIX = "ee:sess:"
+
+    def __init__(self, host="127.0.0.1", port=6379, timeout=2.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._local = threading.local()
+
+    # --- tiny RESP client ---
+    def _conn(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is None:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            self._local.sock = sock
+            self._local.reader = sock.makefile("rb")
+        return sock, self._local.reader
+
+    def _command(self, *args):
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        sock, reader = self._conn()
+        try:
+            sock.sendall(b"".join(parts))
+            return self._read(reader)
+        except OSError:
+            self._local.sock = None
+            raise
+
+    def _read(self, reader):
+        line = reader.readline()
+        if not line:
+            raise ConnectionError("redis connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            raise RuntimeError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            size = int(rest)
+            if size < 0:
+                return None
+            data = reader.read(size + 2)[:-2]
+            return data.decode("utf-8")
+        if kind == b"*":
+            size = int(rest)
+            return None if size < 0 else [self._read(reader) for _ in range(size)]
+        raise ConnectionError(f"unexpected redis reply {line!r}")
+
+    # --- backend interface ---
+    def _user_key(self, user_id):
+        return f"ee:user:{user_id}:sess"
+
+    def load(self, sid):
+        payload = self._command("GET", self.PREFIX + sid)
+        if payload is None:
+            return None
+        ttl = self._command("TTL", self.PREFIX + sid)
+        return time.time() + max(ttl, 0), payload
+
+    def save(self, sid, user_id, payload, expires_at):
+        ttl = max(1, int(expires_at - time.time()))
+        self._command("SET", self.PREFIX + sid, payload, "EX", ttl)
+        if user_id is not None:
+            self._command("SADD", self._user_key(user_id), sid)
+            self._command("EXPIRE", self._user_key(user_id), SESSION_LIFETIME_SECONDS)
+
+    def delete(self, sid):
+        self._command("DEL", self.PREFIX + sid)
+
+    def revoke_user(self, user_id, keep_sid=None):
+        sids = [s for s in (self._command("SMEMBERS", self._user_key(user_id)) or []) if s != keep_sid]
+        if sids:
+            self._command("DEL", *[self.PREFIX + s for s in sids])
+            self._command("SREM", self._user_key(user_id), *sids)
+        return len(sids)
+
+    def revoke_all(self):
+        count = 0
+        cursor = "0"
+        while True:
+            cursor, keys = self._command("SCAN", cursor, "MATCH", "ee:*", "COUNT", 1000)
+            if keys:
+                count += sum(1 for k in keys if k.startswith(self.PREFIX))
+                self._command("DEL", *keys)
+            if cursor == "0":
+                return count
+
+
+def backend_from_env():
+    name = os.environ.get("EE_SESSION_BACKEND", "sqlite")
+    if name == "memory":
+        return MemoryBackend()
+    if name == "redis":
+        host, _, port = os.environ.get("EE_SESSION_REDIS", "127.0.0.1:6379").partition(":")
+        return RedisBackend(host, int(port or 6379))
+    return SQLiteBackend()
+
+
+# FLASK SESSION INTERFACE <<<<<<<<<<
+class ServerSessionInterface(SessionInterface):
+    """
+    Plugs a backend into Flask (app.session_interface = ...).
+    Unchanged sessions aren't written; the expiry is only pushed
+    forward once less than half the lifetime is left.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            loaded = self.backend.load(sid)
+            if loaded is not None:
+                expires_at, payload = loaded
+                session = ServerSession(_serializer.loads(payload), sid=sid)
+                session.touched = expires_at - time.time() < SESSION_LIFETIME_SECONDS / 2
+                return session
+        return ServerSession(sid=_new_sid(), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.rotated_from:
+            self.backend.delete(session.rotated_from)
+
+        # Emptied session (logout): drop it server-side and clear the cookie
+        if not session:
+            if not session.new:
+                self.backend.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if not (session.modified or session.touched or session.rotated_from):
+            return
+
+        expires_at = time.time() + SESSION_LIFETIME_SECONDS
+        self.backend.save(session.sid, session.get("user_id"), _serializer.dumps(dict(session)), expires_at)
+        response.set_cookie(
+            name,
+            session.sid,
+            max_age=SESSION_LIFETIME_SECONDS,
+            httponly=self.get_cookie_httponly(app),
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+            domain=domain,
+            path=path,
+        )
+
+
+_interface = None
+
+
+def init_app(app, backend=None):
+    """
+    Switches the app to server-side sessions and registers
+    the `flask sessions ...` commands.
+    """
+    global _interface
+    _interface = ServerSessionInterface(backend or backend_from_env())
+    app.session_interface = _interface
+    app.cli.add_command(sessions_cli)
+
+
+def revoke_user_sessions(user_id, keep_sid=None):
+    """
+    Logs a user out everywhere (except `keep_sid`, if given).
+    Returns how many sessions were removed.
+    """
+    return _interface.backend.revoke_user(user_id, keep_sid) if _interface else 0
+
+
+# CLI: flask sessions ... <<<<<<<<<<
+sessions_cli = AppGroup("sessions", help="Manage server-side sessions.")
+
+
+@sessions_cli.command("revoke-user")
+@click.argument("user_ids", nargs=-1, type=int, required=True)
+def sessions_revoke_user(user_ids):
+    """Log the given UserIDs out of every session."""
+    total = sum(revoke_user_sessions(uid) for uid in user_ids)
+    click.echo(f"Revoked {total} session(s).")
+
+
+@sessions_cli.command("revoke-all")
+def sessions_revoke_all():
+    """Log everyone out."""
+    click.echo(f"Revoked {_interface.backend.revoke_all()} session(s).")
@@ -8,6 +8,7 @@ Handles the main shop/home page:
 
 from flask import Blueprint, render_template, request, redirect, url_for, session, flash
 from db import get_connection  # uses EternalElixers.sql
+from refdata import categories  # cached category list for the filter menu
 
 # Blueprint for shop-related routes
 shop_bp = Blueprint("shop", __name__)
@@ -74,6 +75,7 @@ def shop_home():
         current_search=search_term,
         current_category=category,
         current_sort=sort,  # NEW (in case you want to use it in the template)
+        categories=categories(),
     )
 
 
@@ -135,18 +137,13 @@ def add_to_cart():
         flash(f"{potion_name} is already in your cart.")
         return redirect(url_for("cart.view_cart"))
 
-    # 3) Get next ShoppingCartID (MAX + 1)
-    cur.execute(
-        "SELECT COALESCE(MAX(ShoppingCartID), 0) + 1 AS NextID FROM ShoppingCart_T"
-    )
-    next_id = cur.fetchone()["NextID"]
-
-    # 4) Insert into ShoppingCart_T
+    # 3) Insert into ShoppingCart_T (SQLite assigns ShoppingCartID;
+    #    the UserID/ItemID unique index makes a double-click a no-op)
     insert_sql = """
-        INSERT INTO ShoppingCart_T (ShoppingCartID, UserID, ItemID)
-        VALUES (?, ?, ?)
+        INSERT OR IGNORE INTO ShoppingCart_T (UserID, ItemID)
+        VALUES (?, ?)
     """
-    cur.execute(insert_sql, (next_id, user_id, item_id))
+    cur.execute(insert_sql, (user_id, item_id))
     conn.commit()
     conn.close()
 
@@ -0,0 +1,301 @@
+"""
+stats.py
+Running totals kept up to date as orders are placed, so pages
+never aggregate Bill_T at request time:
+- UserStats_T: order count, lifetime spend, last order date per user
+- ShopStats_T: one row of shop-wide counters for the admin dashboard
+  (orders, revenue, items sold)
+- SalesRollup_T: orders / items / revenue per day and per week,
+  by PotionCategory and shipping State, for the analytics page
+
+record_order() is called inside the checkout transaction, so the
+numbers commit (or roll back) together with the Bill.
+`flask stats rebuild` recomputes everything from Bill_T;
+`flask stats reconcile` shows (and with --fix repairs) any drift.
+"""
+
+import click
+from flask.cli import AppGroup
+
+from db import get_connection
+
+
+# UPDATE (INSIDE CHECKOUT) <<<<<<<<<<
+# Rollup rows for the bills matching {where}. Each bill lands in a
+# 'day' and a 'week' bucket (weeks start on Monday), twice per bucket:
+# - PotionCategory '*': the whole order (Revenue = Bill Total)
+# - one row per category in the order (Revenue = those potions' prices)
+_ROLLUP_SELECT_SQL = """
+    WITH periods(Period) AS (VALUES ('day'), ('week')),
+    lines AS (
+        SELECT b.BillID,
+               b.SalesDate,
+               COALESCE(b.State, '') AS State,
+               COALESCE(i.PotionCategory, 'Uncategorized') AS PotionCategory,
+               COUNT(bi.ItemID) AS Items,
+               COALESCE(SUM(i.PotionCost), 0) AS ItemRevenue,
+               b.Total
+        FROM Bill_T b
+        JOIN BillInventoryItem_T bi ON bi.BillID = b.BillID
+        LEFT JOIN Inventory_T i ON i.ItemID = bi.ItemID
+        WHERE {where}
+        GROUP BY b.BillID, PotionCategory
+    ),
+    facts AS (
+        SELECT SalesDate, State, PotionCategory, 1 AS Orders, Items, ItemRevenue AS Revenue
+        FROM lines
+        UNION ALL
+        SELECT SalesDate, State, '*', 1, SUM(Items), Total
+        FROM lines
+        GROUP BY BillID
+    )
+    SELECT p.Period,
+           CASE p.Period
+               WHEN 'day' THEN f.SalesDate
+               ELSE date(f.SalesDate, 'weekday 0', '-6 days')
+           END AS PeriodStart,
+           f.PotionCategory,
+           f.State,
+           SUM(f.Orders),
+           SUM(f.Items),
+           SUM(f.Revenue)
+    FROM facts f
+    CROSS JOIN periods p
+    GROUP BY p.Period, PeriodStart, f.PotionCategory, f.State
+"""
+
+
+def record_order(cur, bill_id, user_id, sales_date, total, item_count):
+    """
+    Adds one just-inserted Bill (and its BillInventoryItem_T rows)
+    to the running totals. Runs on the caller's cursor, inside its
+    transaction.
+    """
+    cur.execute(
+        f"""
+        INSERT INTO SalesRollup_T (Period, PeriodStart, PotionCategory, State, Orders, ItemsSold, Revenue)
+        {_ROLLUP_SELECT_SQL.format(where="b.BillID = ?")}
+        ON CONFLICT(Period, PeriodStart, PotionCategory, State) DO UPDATE
+        SET Orders    = Orders + excluded.Orders,
+            ItemsSold = ItemsSold + excluded.ItemsSold,
+            Revenue   = Revenue + excluded.Revenue
+        """,
+        (bill_id,),
+    )
+    cur.execute(
+        """
+        UPDATE ShopStats_T
+        SET OrderCount = OrderCount + 1,
+            Revenue    = Revenue + ?,
+            ItemsSold  = ItemsSold + ?
+        WHERE StatsID = 1
+        """,
+        (total, item_count),
+    )
+    cur.execute(
+        """
+        INSERT INTO UserStats_T (UserID, OrderCount, LifetimeSpend, LastOrderDate)
+        VALUES (?, 1, ?, ?)
+        ON CONFLICT(UserID) DO UPDATE
+        SET OrderCount    = OrderCount + 1,
+            LifetimeSpend = LifetimeSpend + excluded.LifetimeSpend,
+            LastOrderDate = MAX(COALESCE(LastOrderDate, ''), excluded.LastOrderDate)
+        """,
+        (user_id, total, sales_date),
+    )
+
+
+# READ <<<<<<<<<<
+def get_user_stats(user_id):
+    """
+    Returns {"OrderCount", "LifetimeSpend", "LastOrderDate"} for one user
+    (zeros / None if they've never ordered). Single primary-key lookup.
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT OrderCount, LifetimeSpend, LastOrderDate FROM UserStats_T WHERE UserID = ?",
+        (user_id,),
+    )
+    row = cur.fetchone()
+    conn.close()
+    if row is None:
+        return {"OrderCount": 0, "LifetimeSpend": 0.0, "LastOrderDate": None}
+    return dict(row)
+
+
+def get_shop_stats():
+    """
+    Returns {"OrderCount", "Revenue", "ItemsSold"}: one row, whatever
+    the number of sales.
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT OrderCount, Revenue, ItemsSold FROM ShopStats_T WHERE StatsID = 1")
+    row = cur.fetchone()
+    conn.close()
+    return dict(row)
+
+
+def sales_rollup(period, by, start=None, end=None):
+    """
+    Reads the rollups for the analytics page.
+    - period: 'day' or 'week'
+    - by: 'category' or 'state'
+    - start / end: optional YYYY-MM-DD bounds on the bucket start
+    Returns rows of (PeriodStart, Key, Orders, ItemsSold, Revenue),
+    newest bucket first. Touches only rollup rows, never Bill_T.
+    """
+    clauses = ["Period = ?"]
+    params = [period]
+    if by == "category":
+        clauses.append("PotionCategory <> '*'")
+        key = "PotionCategory"
+    else:
+        # whole-order rows, so each order counts once per state
+        clauses.append("PotionCategory = '*'")
+        key = "State"
+    if start:
+        clauses.append("PeriodStart >= ?")
+        params.append(start)
+    if end:
+        clauses.append("PeriodStart <= ?")
+        params.append(end)
+
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(
+        f"""
+        SELECT PeriodStart, {key} AS Key,
+               SUM(Orders) AS Orders, SUM(ItemsSold) AS ItemsSold, SUM(Revenue) AS Revenue
+        FROM SalesRollup_T
+        WHERE {" AND ".join(clauses)}
+        GROUP BY PeriodStart, {key}
+        ORDER BY PeriodStart DESC, {key}
+        """,
+        params,
+    )
+    rows = cur.fetchall()
+    conn.close()
+    return rows
+
+
+def pivot_rollup(rows, measure):
+    """
+    Pivots sales_rollup() rows in one pass: one line per bucket, one
+    column per key. Returns (columns, buckets, column_totals), where
+    each bucket is {"start", "values", "total"}.
+    """
+    columns = sorted({row["Key"] for row in rows})
+    table = {}
+    column_totals = dict.fromkeys(columns, 0)
+    for row in rows:
+        value = row[measure]
+        table.setdefault(row["PeriodStart"], dict.fromkeys(columns, 0))[row["Key"]] = value
+        column_totals[row["Key"]] += value
+
+    buckets = [
+        {"start": bucket, "values": [values[c] for c in columns], "total": sum(values.values())}
+        for bucket, values in table.items()
+    ]
+    return columns, buckets, [column_totals[c] for c in columns]
+
+
+# REBUILD <<<<<<<<<<
+_SHOP_TOTALS_SQL = """
+    SELECT
+        (SELECT COUNT(*) FROM Bill_T)                AS OrderCount,
+        (SELECT COALESCE(SUM(Total), 0) FROM Bill_T) AS Revenue,
+        (SELECT COUNT(*) FROM BillInventoryItem_T)   AS ItemsSold
+"""
+
+
+def rebuild_shop_stats(cur):
+    cur.execute(
+        f"""
+        INSERT OR REPLACE INTO ShopStats_T (StatsID, OrderCount, Revenue, ItemsSold)
+        SELECT 1, OrderCount, Revenue, ItemsSold FROM ({_SHOP_TOTALS_SQL})
+        """
+    )
+
+
+def rebuild_user_stats(cur):
+    cur.execute("DELETE FROM UserStats_T")
+    cur.execute(
+        """
+        INSERT INTO UserStats_T (UserID, OrderCount, LifetimeSpend, LastOrderDate)
+        SELECT UserID, COUNT(*), COALESCE(SUM(Total), 0), MAX(SalesDate)
+        FROM Bill_T
+        WHERE UserID IS NOT NULL
+        GROUP BY UserID
+        """
+    )
+
+
+def rebuild_sales_rollup(cur):
+    cur.execute("DELETE FROM SalesRollup_T")
+    cur.execute(
+        f"""
+        INSERT INTO SalesRollup_T (Period, PeriodStart, PotionCategory, State, Orders, ItemsSold, Revenue)
+        {_ROLLUP_SELECT_SQL.format(where="1")}
+        """
+    )
+
+
+REBUILDERS = {
+    "users": rebuild_user_stats,
+    "shop": rebuild_shop_stats,
+    "rollups": rebuild_sales_rollup,
+}
+
+
+def rebuild(names=None):
+    """
+    Recomputes the given stats tables (default: all) from Bill_T
+    in one write transaction, so checkouts wait rather than interleave.
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    for name in names or REBUILDERS:
+        REBUILDERS[name](cur)
+    conn.commit()
+    conn.close()
+
+
+# CLI: flask stats ... <<<<<<<<<<
+stats_cli = AppGroup("stats", help="Maintain the running stats tables.")
+
+
+@stats_cli.command("rebuild")
+@click.argument("names", nargs=-1, type=click.Choice(sorted(REBUILDERS)))
+def stats_rebuild(names):
+    """Recompute stats from Bill_T (default: all of them)."""
+    rebuild(names)
+    click.echo(f"Rebuilt: {', '.join(names or REBUILDERS)}")
+
+
+@stats_cli.command("reconcile")
+@click.option("--fix", is_flag=True, help="Rebuild the shop counters if they drifted.")
+def stats_reconcile(fix):
+    """Compare the shop counters with Bill_T (full scan)."""
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(_SHOP_TOTALS_SQL)
+    actual = dict(cur.fetchone())
+    conn.close()
+    stored = get_shop_stats()
+
+    drift = {
+        name: (stored[name], actual[name])
+        for name in actual
+        if abs(stored[name] - actual[name]) > 0.005
+    }
+    if not drift:
+        click.echo("Shop counters match Bill_T.")
+        return
+    for name, (have, want) in drift.items():
+        click.echo(f"{name}: counter={have} actual={want}")
+    if fix:
+        rebuild(["shop"])
+        click.echo("Shop counters rebuilt.")
@@ -0,0 +1,31 @@
+"""
+conftest.py
+Shared pytest setup: puts final-done/ on the import path, keeps
+rate limiting off, and gives each test its own scratch database.
+
+    cd final-done && python -m pytest -q tests
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("EE_RATELIMIT", "off")  # every test client shares one IP
+
+
+@pytest.fixture
+def app(tmp_path):
+    from app import create_app
+
+    app = create_app({"DATABASE": str(tmp_path / "EternalElixers.db")})
+    app.testing = True
+    return app
+
+
+@pytest.fixture
+def admin_client(app):
+    client = app.test_client()
+    client.post("/login", data={"username": "ejones", "password": "password1"})
+    return client
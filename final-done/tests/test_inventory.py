@@ -0,0 +1,49 @@
+"""
+test_inventory.py
+Bulk inventory edits (admin.inventory_bulk / db.reprice_inventory).
+"""
+
+import pytest
+
+from db import get_connection, reprice_inventory
+
+
+def _prices():
+    conn = get_connection()
+    prices = dict(conn.execute("SELECT ItemID, PotionCost FROM Inventory_T").fetchall())
+    conn.close()
+    return prices
+
+
+@pytest.mark.parametrize("amount", ["nan", "inf", "-inf", "1e400"])
+def test_reprice_rejects_non_finite_amounts(app, admin_client, amount):
+    with app.app_context():
+        before = _prices()
+
+    for mode in ("percent", "absolute"):
+        response = admin_client.post(
+            "/admin/inventory/bulk",
+            data={"action": "reprice", "scope": "filter", "mode": mode, "amount": amount},
+            follow_redirects=True,
+        )
+        assert b"Enter a non-zero percentage or amount." in response.data
+
+    with app.app_context():
+        assert _prices() == before
+        with pytest.raises(ValueError):
+            reprice_inventory("percent", float(amount))
+        assert _prices() == before
+
+
+def test_reprice_by_percent(app, admin_client):
+    with app.app_context():
+        before = _prices()
+
+    admin_client.post(
+        "/admin/inventory/bulk",
+        data={"action": "reprice", "scope": "filter", "mode": "percent", "amount": "10"},
+    )
+
+    with app.app_context():
+        after = _prices()
+    assert after == {item_id: max(0.01, round(cost * 1.1, 2)) for item_id, cost in before.items()}
@@ -0,0 +1,36 @@
+"""
+test_payments.py
+PaymentGateway / CircuitBreaker behaviour that needs no database.
+"""
+
+import pytest
+
+from payments import CircuitBreaker, PaymentGateway, PaymentUnavailable, StubProvider
+
+
+def _half_open_gateway():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    return PaymentGateway(StubProvider(), max_workers=1, breaker=breaker)
+
+
+def test_half_open_trial_rejected_for_capacity_is_given_back():
+    gateway = _half_open_gateway()
+
+    gateway._slots.acquire()  # the only slot is busy with another call
+    with pytest.raises(PaymentUnavailable, match="busy"):
+        gateway.authorize(10, "4111", "12/30", "123")
+    gateway._slots.release()
+
+    assert gateway.authorize(10, "4111", "12/30", "123").startswith("stub-")
+    assert gateway.breaker.state == "closed"
+
+
+def test_half_open_trial_rejected_by_shut_down_pool_is_given_back():
+    gateway = _half_open_gateway()
+    gateway._executor.shutdown()
+
+    with pytest.raises(PaymentUnavailable):
+        gateway.authorize(10, "4111", "12/30", "123")
+
+    assert gateway.breaker.allow()
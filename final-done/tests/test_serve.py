@@ -0,0 +1,94 @@
+"""
+test_serve.py
+PoolWSGIServer driven over real sockets, with the limits serve.py sets.
+"""
+
+import http.client
+import threading
+import time
+
+import pytest
+
+import ratelimit
+import serve
+
+
+@pytest.fixture
+def pool_server(app, monkeypatch):
+    """
+    Starts a 2-thread PoolWSGIServer for `app` on a free port, with
+    rate limiting on and admission sized the way serve.py does it.
+    Yields (port, started, release): /test/slow sets `started` and
+    returns once `release` is set.
+    """
+    monkeypatch.setattr(ratelimit, "ENABLED", True)
+    monkeypatch.setattr(ratelimit._admission, "max_inflight", ratelimit._admission.max_inflight)
+    ratelimit.init_app(app)
+
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(10)
+        return "done"
+
+    app.add_url_rule("/test/slow", "slow", slow)
+
+    listener = serve._listen_socket("127.0.0.1", 0, reuse_port=False)
+    listener.listen(16)
+    server = serve.PoolWSGIServer(listener, app, threads=2, keepalive=5.0)
+    ratelimit.set_max_inflight(server.threads)
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+
+    yield listener.getsockname()[1], started, release
+
+    release.set()
+    server.shutdown()
+    server.drain(5)
+    listener.close()
+
+
+def _get(port, path, conn=None):
+    keep = conn is not None
+    conn = conn or http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    conn.request("GET", path)
+    response = conn.getresponse()
+    response.read()
+    if not keep:
+        conn.close()
+    return response.status
+
+
+def test_admission_sheds_before_every_thread_is_busy(pool_server):
+    port, started, release = pool_server
+
+    slow = threading.Thread(target=_get, args=(port, "/test/slow"))
+    slow.start()
+    assert started.wait(5)
+
+    # One of two threads busy: "normal" and "bulk" are shed, "critical" still runs
+    assert _get(port, "/shop") == 503
+    assert _get(port, "/admin/sales-report") == 503
+    assert _get(port, "/checkout") == 302
+
+    release.set()
+    slow.join(5)
+    assert _get(port, "/shop") == 200
+
+
+def test_idle_keepalive_connections_hold_no_thread(pool_server):
+    port, _, _ = pool_server
+
+    # More idle keep-alive connections than the server has threads
+    idle = [http.client.HTTPConnection("127.0.0.1", port, timeout=5) for _ in range(4)]
+    assert [_get(port, "/shop", conn) for conn in idle] == [200] * 4
+
+    started = time.monotonic()
+    assert _get(port, "/shop") == 200
+    assert [_get(port, "/shop", conn) for conn in idle] == [200] * 4
+    assert time.monotonic() - started < 2  # not waiting out a 5 s keep-alive
+
+    for conn in idle:
+        conn.close()
@@ -0,0 +1,121 @@
+"""
+usernames.py
+Fast "is this username taken?" checks for registration.
+- BloomFilter: compact in-memory set with no false negatives
+- A per-process filter of every (lower-cased) Username in User_T,
+  built once from the database and kept up to date as users register
+
+If the filter says a name is free, it is free as far as this process
+knows, and the database lookup is skipped. "Maybe taken" falls back to
+the indexed lookup. Names registered through another worker are caught
+by the unique NOCASE index when the INSERT runs.
+"""
+
+import hashlib
+import math
+import threading
+
+from db import get_connection
+
+FALSE_POSITIVE_RATE = 0.01
+MIN_CAPACITY = 10_000
+
+
+class BloomFilter:
+    """
+    Classic Bloom filter over a bytearray, using double hashing
+    (two 64-bit halves of one blake2b digest) for the k positions.
+    """
+
+    def __init__(self, capacity, false_positive_rate=FALSE_POSITIVE_RATE):
+        self.capacity = capacity
+        self.num_bits = max(8, int(-capacity * math.log(false_positive_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+_filter = None
+_lock = threading.Lock()
+
+
+def _build():
+    """
+    Streams every username out of User_T into a new filter sized
+    for twice the current user count.
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM User_T")
+    total = cur.fetchone()[0]
+
+    bloom = BloomFilter(max(MIN_CAPACITY, total * 2))
+    cur.execute("SELECT Username FROM User_T")
+    while True:
+        rows = cur.fetchmany(5000)
+        if not rows:
+            break
+        for row in rows:
+            bloom.add(row["Username"].lower())
+    conn.close()
+    return bloom
+
+
+def _current():
+    global _filter
+    if _filter is None:
+        with _lock:
+            if _filter is None:
+                _filter = _build()
+    return _filter
+
+
+def maybe_taken(username):
+    """
+    False means the name is definitely free (in this process's view);
+    True means check the database.
+    """
+    return username.lower() in _current()
+
+
+def mark_taken(username):
+    """
+    Records a newly registered username. Rebuilds the filter once it
+    holds more names than it was sized for (false positives climb).
+    """
+    global _filter
+    bloom = _current()
+    with _lock:
+        bloom.add(username.lower())
+        if bloom.count > bloom.capacity:
+            _filter = None
+
+
+def is_taken(username):
+    """
+    Full availability check: the Bloom filter first, then the
+    NOCASE-indexed lookup only when the filter says "maybe".
+    """
+    if not maybe_taken(username):
+        return False
+
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT 1 FROM User_T WHERE Username = ? COLLATE NOCASE", (username,))
+    taken = cur.fetchone() is not None
+    conn.close()
+    return taken